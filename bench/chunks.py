@@ -0,0 +1,67 @@
+from __future__ import (absolute_import, print_function,
+                unicode_literals, division)
+
+import os
+import time
+import tempfile
+
+import numpy as np
+from sqlalchemy import orm
+
+from qlog import db
+
+
+def run(path, storage, points, period):
+    engine = db.connect("sqlite:///%s" % path)
+    db.Base.metadata.create_all(engine)
+    session = orm.sessionmaker(bind=engine)()
+    v = db.Variable("bench")
+    v.storage = storage
+    session.add(v)
+    session.commit()
+
+    # a slow sensor: jittered period, random walk quantized to 0.01
+    rs = np.random.RandomState(0)
+    t = np.cumsum(rs.randint(period - 10, period + 10, points))
+    t += 1000*db.chunk_span
+    x = np.round(20 + np.cumsum(rs.standard_normal(points))*.002, 2)
+    v.update_series(x, t)
+    session.commit()
+    t0 = time.time()
+    db.compact(session, now=int(t[-1]) + db.chunk_span)
+    session.commit()
+    pack = time.time() - t0
+    session.execute("VACUUM")
+
+    t0 = time.time()
+    n = len(db.fetch(session, [v])[v][0])
+    scan = time.time() - t0
+    assert n == points
+    session.close()
+    engine.dispose()
+    return pack, scan, os.path.getsize(path)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--points", type=int, default=500000)
+    parser.add_argument("-p", "--period", type=int, default=10**6)
+    args = parser.parse_args()
+
+    for storage in None, "chunk":
+        fd, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        try:
+            pack, scan, size = run(path, storage, args.points, args.period)
+        finally:
+            for suffix in "", "-wal", "-shm":
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+        print("%-6s pack %6.2f s, full scan %7.1f ms, %6.1f MB, "
+                "%5.1f B/point" % (storage or "rows", pack, scan*1e3,
+                    size/1e6, size/args.points))
+
+
+if __name__ == "__main__":
+    main()
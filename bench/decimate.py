@@ -0,0 +1,67 @@
+from __future__ import (absolute_import, print_function,
+                unicode_literals, division)
+
+import os
+import time
+import tempfile
+
+import numpy as np
+from sqlalchemy import orm
+
+from qlog import db
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--days", type=float, default=90)
+    parser.add_argument("-i", "--interval", type=float, default=10,
+            help="seconds between points")
+    parser.add_argument("-w", "--width", type=int, default=2000)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        engine = db.connect("sqlite:///%s" % path)
+        db.Base.metadata.create_all(engine)
+        session = orm.sessionmaker(bind=engine)()
+        n = int(args.days*86400/args.interval)
+        t = 1500000000*10**6 + np.arange(n)*int(args.interval*1e6)
+        x = np.cumsum(np.random.randn(n))
+        rows, chunks = db.Variable("rows"), db.Variable("chunks")
+        rollups = db.Variable("rollups")
+        chunks.storage = "chunk"
+        # minute rollups of all but the last day
+        rollups.aggregate_stamp = 60*10**6
+        rollups.aggregate_age = 86400*10**6
+        session.add_all([rows, chunks, rollups])
+        for v in rows, chunks, rollups:
+            v.update_series(x, t)
+        db.compact(session, now=int(t[-1]))
+        session.commit()
+        print("%i points over %g days, width %i" % (n, args.days,
+            args.width))
+
+        for v in rows, chunks, rollups:
+            for label, f in [
+                    ("raw", lambda: v.history_array()),
+                    ("m4", lambda: v.decimate(width=args.width)),
+                    ("lttb", lambda: v.decimate(width=args.width,
+                        mode="lttb")),
+                    ]:
+                t0 = time.time()
+                tv = f()
+                dt = time.time() - t0
+                print("%-7s %-5s %8i points %8.1f ms" % (v.name, label,
+                    len(tv[0]), dt*1e3))
+        session.close()
+        engine.dispose()
+    finally:
+        for suffix in "", "-wal", "-shm":
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+from __future__ import (absolute_import, print_function,
+                unicode_literals, division)
+
+import os
+import time
+import tempfile
+import tracemalloc
+
+import numpy as np
+from sqlalchemy import orm
+
+from qlog import db
+
+
+def measure(f):
+    # latency, then peak memory in a second run (tracing is slow)
+    t0 = time.time()
+    r = f()
+    dt = time.time() - t0
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return r, dt, peak
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--points", type=int, default=500000)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        engine = db.connect("sqlite:///%s" % path)
+        db.Base.metadata.create_all(engine)
+        session = orm.sessionmaker(bind=engine)()
+        v = db.Variable("bench")
+        session.add(v)
+        v.update_series(np.random.randn(args.points),
+                np.arange(args.points)*1000)
+        session.commit()
+
+        for name, f in [
+                ("orm", lambda: np.array(list(v.iterhistory())).T),
+                ("arrays", lambda: v.history_array()),
+                ]:
+            session.expire_all()
+            (t, x), dt, peak = measure(f)
+            assert len(t) == args.points
+            print("%-8s %8.1f ms, peak %7.1f MB" % (name, dt*1e3,
+                peak/1e6))
+            session.expunge_all()
+            v = session.query(db.Variable).get(v.id)
+        session.close()
+        engine.dispose()
+    finally:
+        for suffix in "", "-wal", "-shm":
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+from __future__ import (absolute_import, print_function,
+                unicode_literals, division)
+
+import os
+import time
+import json
+import tempfile
+
+import numpy as np
+
+from qlog import db
+from qlog.api import create_app
+
+
+def setup(database, names):
+    app = create_app(database)
+    for name in names:
+        app.db_session.add(db.Variable(name))
+    app.db_session.commit()
+    return app, app.test_client()
+
+
+def per_point(client, names, n):
+    t0 = int(time.time()*1e6)
+    for i in range(n):
+        client.post("/1/data/%s" % names[i % len(names)],
+                data={"value": i, "time": t0 + i})
+
+
+def bulk_json(client, names, n, batch):
+    t0 = int(time.time()*1e6)
+    for j in range(0, n, batch):
+        rows = [[names[i % len(names)], t0 + i, float(i)]
+                for i in range(j, min(n, j + batch))]
+        client.post("/1/update", data=json.dumps(rows),
+                content_type="application/json")
+
+
+def bulk_binary(client, names, n, batch):
+    t0 = int(time.time()*1e6)
+    m = n//len(names)
+    for name in names:
+        for j in range(0, m, batch):
+            l = np.empty(min(batch, m - j), db.record_dtype)
+            l["time"] = t0 + j + np.arange(l.shape[0])
+            l["value"] = l["time"]
+            client.post("/1/data/%s" % name, data=l.tobytes(),
+                    content_type="application/octet-stream")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--points", type=int, default=2000)
+    parser.add_argument("-b", "--batch", type=int, default=5000)
+    parser.add_argument("-m", "--variables", type=int, default=10)
+    args = parser.parse_args()
+
+    names = ["bench%i" % i for i in range(args.variables)]
+    runs = [
+        ("per-point", lambda c: per_point(c, names, args.points)),
+        ("bulk json", lambda c: bulk_json(c, names, args.points*50,
+            args.batch)),
+        ("bulk binary", lambda c: bulk_binary(c, names, args.points*50,
+            args.batch)),
+    ]
+    for label, run in runs:
+        fd, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        try:
+            app, client = setup("sqlite:///%s" % path, names)
+            t = time.time()
+            run(client)
+            t = time.time() - t
+            n = app.db_session.query(db.FloatValue).count()
+            print("%-12s %9i points %8.3f s %12.0f points/s" % (
+                label, n, t, n/t))
+        finally:
+            os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
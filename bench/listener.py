@@ -0,0 +1,111 @@
+from __future__ import (absolute_import, print_function,
+                unicode_literals, division)
+
+import os
+import time
+import socket
+import tempfile
+
+import numpy as np
+
+from qlog import db
+from qlog.api import create_app
+from qlog.listener import Listener, frame
+
+
+def setup(database, names):
+    app = create_app(database, write_behind=True)
+    for name in names:
+        app.db_session.add(db.Variable(name))
+    app.db_session.commit()
+    listener = Listener(app, "127.0.0.1", 0)
+    listener.start()
+    return app, listener
+
+
+def lines(names, n, batch):
+    t0 = int(time.time()*1e6)
+    for j in range(0, n, batch):
+        yield "".join("%s %r %i\n" % (names[i % len(names)], float(i),
+            t0 + i) for i in range(j, min(n, j + batch))).encode()
+
+
+def frames(names, n, batch):
+    t0 = int(time.time()*1e6)
+    m = n//len(names)
+    for j in range(0, m, batch):
+        t = t0 + j + np.arange(min(batch, m - j))
+        for name in names:
+            yield frame(name, t, np.random.randn(len(t)))
+
+
+def send_tcp(address, chunks):
+    s = socket.create_connection(address)
+    for c in chunks:
+        s.sendall(c)
+    s.close()
+
+
+def send_udp(address, chunks):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for c in chunks:
+        s.sendto(c, address)
+    s.close()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--points", type=int, default=500000)
+    parser.add_argument("-b", "--batch", type=int, default=500)
+    parser.add_argument("-m", "--variables", type=int, default=10)
+    args = parser.parse_args()
+
+    names = ["bench%i" % i for i in range(args.variables)]
+    runs = [
+        ("tcp lines", send_tcp, lambda: lines(names, args.points,
+            args.batch)),
+        ("tcp frames", send_tcp, lambda: frames(names, args.points,
+            args.batch)),
+        # datagrams of at most 64 KiB, lost when the queue is full
+        ("udp lines", send_udp, lambda: lines(names, args.points, 100)),
+    ]
+    for label, send, chunks in runs:
+        fd, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        try:
+            app, listener = setup("sqlite:///%s" % path, names)
+            chunks = list(chunks())
+            t = time.time()
+            send(listener.address, chunks)
+            # until everything arrived (or nothing for 5 s: lost
+            # datagrams) and is committed, TCP senders stall while the
+            # writer queue is full
+            last, idle = None, time.time()
+            while True:
+                s = listener.stats()
+                n = s["received"] + s["dropped"] + s["unknown"]
+                if n != last:
+                    last, idle = n, time.time()
+                if n >= args.points:
+                    idle = time.time()
+                    break
+                if time.time() - idle > 5:
+                    break
+                time.sleep(.01)
+            t += time.time() - idle
+            listener.stop()
+            app.writer.stop()
+            t = time.time() - t
+            n = app.db_session.query(db.FloatValue).count()
+            print("%-12s %9i points %8.3f s %12.0f points/s %6.1f%% lost" % (
+                label, n, t, n/t, 100*(1 - n/args.points)))
+            app.db_session.remove()
+        finally:
+            for suffix in "", "-wal", "-shm":
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+from __future__ import (absolute_import, print_function,
+                unicode_literals, division)
+
+import os
+import json
+import time
+import random
+import tempfile
+import threading
+
+import numpy as np
+import requests
+
+
+def worker(base, names, duration, ingest, batch, latencies):
+    s = requests.Session()
+    rs = random.Random()
+    stop = time.time() + duration
+    while time.time() < stop:
+        name = rs.choice(names)
+        t0 = time.time()
+        if rs.random() < ingest:
+            now = int(t0*1e6)
+            r = s.post("%s/data/%s" % (base, name), data=json.dumps(
+                [[now + i, rs.random()] for i in range(batch)]),
+                headers={"Content-Type": "application/json"})
+        else:
+            r = s.get("%s/data/%s?limit=100" % (base, name))
+        if r.status_code not in (200, 503):
+            r.raise_for_status()
+        latencies.append(time.time() - t0)
+
+
+def run(base, names, concurrency, duration, ingest, batch):
+    latencies = []
+    threads = [threading.Thread(target=worker, args=(base, names,
+        duration, ingest, batch, latencies)) for i in range(concurrency)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    l = np.array(latencies)
+    return len(l)/(time.time() - t0), np.median(l), np.percentile(l, 99)
+
+
+def local_server(database):
+    # threaded development server in this process
+    import logging
+    from werkzeug.serving import make_server
+    from qlog.api import create_app
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    app = create_app(database, pool_size=16)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return "http://127.0.0.1:%i/1" % server.server_port
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--base",
+            help="server to test, default: a local threaded one on sqlite")
+    parser.add_argument("-m", "--variables", type=int, default=10)
+    parser.add_argument("-c", "--concurrency", default="1,4,16,64")
+    parser.add_argument("-t", "--duration", type=float, default=5)
+    parser.add_argument("-i", "--ingest", type=float, default=.2,
+            help="fraction of requests that ingest")
+    parser.add_argument("-n", "--batch", type=int, default=10,
+            help="values per ingest request")
+    args = parser.parse_args()
+
+    path = None
+    base = args.base
+    if base is None:
+        fd, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        base = local_server("sqlite:///%s" % path)
+    try:
+        names = ["load%i" % i for i in range(args.variables)]
+        for name in names:
+            requests.post("%s/variable/%s" % (base, name),
+                    data={"name": name, "type": "float"})
+        for c in args.concurrency.split(","):
+            rate, p50, p99 = run(base, names, int(c), args.duration,
+                    args.ingest, args.batch)
+            print("concurrency %3i: %7.1f requests/s, "
+                    "p50 %6.1f ms, p99 %6.1f ms" % (int(c), rate,
+                        p50*1e3, p99*1e3))
+    finally:
+        if path is not None:
+            for suffix in "", "-wal", "-shm":
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+from __future__ import (absolute_import, print_function,
+                unicode_literals, division)
+
+import os
+import time
+import tempfile
+
+from sqlalchemy import desc
+
+from qlog import db
+from qlog.api import create_app
+
+
+def timeit(f, n):
+    f()
+    t0 = time.time()
+    for i in range(n):
+        f()
+    return (time.time() - t0)/n
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--variables", type=int, default=100)
+    parser.add_argument("-n", "--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        # no response caching, every request goes to the database
+        app = create_app("sqlite:///%s" % path, response_cache=0)
+        session = app.db_session
+        vs = [db.Variable("bench%i" % i) for i in range(args.variables)]
+        session.add_all(vs)
+        session.flush()
+        db.insert_values(session, ((v, t, float(t)) for v in vs
+            for t in range(100)))
+        session.commit()
+        name = vs[len(vs)//2].name
+        id = vs[len(vs)//2].id
+        session.remove()
+
+        raw = session.connection().connection
+        def dbapi():
+            c = raw.cursor()
+            c.execute("SELECT time, value FROM floatvalue "
+                    "WHERE variable_id = ? ORDER BY time DESC LIMIT 10",
+                    (id,))
+            c.fetchall()
+            c.close()
+
+        def orm():
+            s = session()
+            v = s.query(db.Variable).filter(db.Variable.name == name).first()
+            t = v.value_table
+            list(v.values.order_by(desc(t.time)).limit(10).values(
+                t.time, t.value))
+            session.remove()
+
+        def cached():
+            s = session()
+            v = db.lookup(s, name)
+            v.recent(limit=10)
+            session.remove()
+
+        client = app.test_client()
+        def request():
+            client.get("/1/data/%s?limit=10" % name)
+
+        info = session.session_factory.kw["info"]
+        for label, f in [("dbapi round trip", dbapi),
+                ("orm lookup + query", orm),
+                ("cached lookup + compiled", cached),
+                ("GET /1/data", request)]:
+            print("%-26s %7.1f us" % (label, timeit(f, args.repeat)*1e6))
+        info.pop("name_cache")
+        print("%-26s %7.1f us" % ("GET /1/data, no name cache",
+            timeit(request, args.repeat)*1e6))
+    finally:
+        for suffix in "", "-wal", "-shm":
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+from __future__ import (absolute_import, print_function,
+                unicode_literals, division)
+
+import os
+import time
+import tempfile
+
+from sqlalchemy import orm
+
+from qlog import db
+
+
+# the value tables created WITHOUT ROWID
+clustered = [t for t in db.Base.metadata.sorted_tables
+        if t.dialect_options["sqlite"]["with_rowid"] is False]
+
+
+def run(path, profile, variables, points, batch):
+    for t in clustered:
+        t.dialect_kwargs["sqlite_with_rowid"] = not profile
+    engine = db.connect("sqlite:///%s" % path, sqlite_profile=profile)
+    db.Base.metadata.create_all(engine)
+    session = orm.sessionmaker(bind=engine)()
+    vs = [db.Variable("bench%i" % i) for i in range(variables)]
+    session.add_all(vs)
+    session.commit()
+
+    # interleaved live-like ingest, one commit per batch
+    now = int(time.time()*1e6)
+    t0 = time.time()
+    for j in range(0, points, batch):
+        db.insert_values(session, ((vs[i % variables], now + i, float(i))
+            for i in range(j, min(points, j + batch))))
+        session.commit()
+    ingest = points/(time.time() - t0)
+
+    # range scans of a tenth of one variable
+    t0 = time.time()
+    n = 0
+    for k in range(10):
+        v = vs[k % variables]
+        start = now + k*points//10
+        for c in v.iterchunks(start, start + points//10):
+            n += len(c)
+    scan = (time.time() - t0)/10
+    session.close()
+    engine.dispose()
+    return ingest, scan, os.path.getsize(path)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--variables", type=int, default=20)
+    parser.add_argument("-n", "--points", type=int, default=200000)
+    parser.add_argument("-b", "--batch", type=int, default=100)
+    args = parser.parse_args()
+
+    for profile in False, True:
+        fd, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        try:
+            ingest, scan, size = run(path, profile, args.variables,
+                    args.points, args.batch)
+        finally:
+            for suffix in "", "-wal", "-shm":
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+        print("%-8s ingest %9.0f points/s, range scan %7.2f ms, %6.1f MB" % (
+            "tuned" if profile else "default", ingest, scan*1e3, size/1e6))
+
+
+if __name__ == "__main__":
+    main()
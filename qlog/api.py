@@ -4,17 +4,30 @@ from __future__ import (absolute_import, print_function,
 import time as pytime
 import logging
 import datetime
+import threading
+import collections
+import atexit
+import numbers
+import io
+import csv
+import json
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import numpy as np
 
-from flask import Flask, jsonify, request, current_app, abort
+from flask import (Flask, request, current_app, abort, Response,
+        stream_with_context)
 from flask.ext import restful
 from flask.ext.restful import reqparse
+from flask.ext.restful.representations import json as restful_json
 
-from sqlalchemy import create_engine, asc, desc
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.exc import DBAPIError
 
-from . import db
+from . import db, partition, metrics
 
 
 logger = logging.getLogger("qlog")
@@ -88,31 +101,35 @@ class Variable(restful.Resource):
     parser.add_argument("maximum", type=float)
     parser.add_argument("log_value_precision", type=float)
     parser.add_argument("time_precision", type=int)
-    parser.add_argument("time_gar", type=int)
+    parser.add_argument("time_gap", type=int)
     parser.add_argument("aggregate_stamp", type=int)
     parser.add_argument("aggregate_age", type=int)
     parser.add_argument("delete_age", type=int)
+    parser.add_argument("storage", type=str)
 
     def get(self, var):
-        v = current_app.db_session.query(db.Variable).filter(
-                db.Variable.name == var).first()
+        v = db.lookup(current_app.db_session, var)
         if not v:
             abort(404, "Not found: {}".format(var))
+        return conditional(v, lambda: self.render(v))
+
+    def render(self, v):
         d = to_json(v)
-        if v.current is not None:
-            d["current"] = {"time": v.current.time, "value": v.current.value}
-        return {var: d}
+        c = v.current
+        if c is not None:
+            d["current"] = {"time": c.time, "value": c.value}
+        return {v.name: d}
 
     def update(self, v, a):
         for k, q in a.items():
             if q is not None:
                 setattr(v, k, q)
         current_app.db_session.commit()
+        current_app.response_cache.forget(v.id)
 
     def put(self, var):
         args = self.parser.parse_args()
-        v = current_app.db_session.query(db.Variable).filter(
-                db.Variable.name == var).first()
+        v = db.lookup(current_app.db_session, var)
         if not v:
             abort(404, "Not found: {}".format(var))
         self.update(v, args)
@@ -130,12 +147,65 @@ class Variable(restful.Resource):
         return self.get(var)
 
     def delete(self, var):
-        v = current_app.db_session.query(db.Variable).filter(
-                db.Variable.name == var).first()
+        v = db.lookup(current_app.db_session, var)
         if not v:
             abort(404, "Not found: {}".format(var))
+        # partitioned value tables have no cascading foreign keys and
+        # SQLite does not enforce them
+        v.values.delete()
+        v.summary_values.delete()
+        v.aggregate_values.delete()
+        v.chunk_values.delete()
         current_app.db_session.delete(v)
         current_app.db_session.commit()
+        current_app.deadband.forget(v.id)
+        current_app.value_cache.forget(v.id)
+        current_app.response_cache.forget(v.id)
+
+
+_data_mimetypes = ["application/json", "application/octet-stream",
+        "application/x-npy", "application/vnd.apache.arrow.stream"]
+
+
+def _drain(f):
+    b = f.getvalue()
+    f.seek(0)
+    f.truncate()
+    return b
+
+
+def stream_array(l, mimetype, chunk=1 << 16):
+    # packed records, .npy or arrow ipc stream, in chunks of records
+    if mimetype == "application/vnd.apache.arrow.stream":
+        try:
+            import pyarrow as pa
+        except ImportError:
+            abort(406, "Arrow IPC not available")
+
+    def generate():
+        f = io.BytesIO()
+        if mimetype == "application/x-npy":
+            np.lib.format.write_array_header_1_0(f,
+                    np.lib.format.header_data_from_array_1_0(l))
+            yield _drain(f)
+        elif mimetype == "application/vnd.apache.arrow.stream":
+            w = pa.ipc.new_stream(f, pa.schema([("time", pa.int64()),
+                ("value", pa.float64())]))
+        for i in range(0, len(l), chunk):
+            c = l[i:i + chunk]
+            if mimetype == "application/vnd.apache.arrow.stream":
+                w.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array(c["time"]), pa.array(c["value"])],
+                    ["time", "value"]))
+                yield _drain(f)
+            else:
+                yield c.tobytes()
+        if mimetype == "application/vnd.apache.arrow.stream":
+            w.close()
+            yield _drain(f)
+
+    return Response(generate(), mimetype=mimetype,
+            headers={"X-Count": str(len(l))})
 
 
 class Data(restful.Resource):
@@ -146,105 +216,796 @@ class Data(restful.Resource):
     query.add_argument("limit", type=int, default=1000)
     query.add_argument("offset", type=int, default=0)
     query.add_argument("statistics", type=bool, default=False)
+    query.add_argument("since", type=int)
+    # decimated to plot width pixels instead of the limit newest values
+    query.add_argument("width", type=int)
+    query.add_argument("decimate", type=str, default="m4",
+            choices=("m4", "lttb"))
 
     update = reqparse.RequestParser()
     update.add_argument("value", type=float, required=True)
     update.add_argument("time", type=int)
 
-    def retrieve(self, var, query=False):
+    def parse_query(self):
         args = self.query.parse_args()
-        v = current_app.db_session.query(db.Variable).filter(
-            db.Variable.name == var).first()
+        if args["since"] is not None:
+            # strictly newer than the cursor
+            args["start"] = max(args["start"] or 0, args["since"] + 1)
+        return args
+
+    def retrieve(self, var, query=False):
+        args = self.parse_query()
+        v = db.lookup(current_app.db_session, var)
         if not v:
             abort(404, "Not found: {}".format(var))
+        if not query and args["width"]:
+            try:
+                t, x = v.decimate(args["start"], args["stop"],
+                        min(args["width"], 10000), args["decimate"])
+            except ValueError as e:
+                abort(400, "Can not decimate: {}".format(e))
+            return args, (t[::-1], x[::-1]), len(t)
+        if not query:
+            t, x = v.recent_array(args["start"], args["stop"],
+                    args["limit"], args["offset"])
+            return args, (t, x), len(t)
         l = v.values
         if args["start"]:
             l = l.filter(v.value_table.time >= args["start"])
         if args["stop"]:
             l = l.filter(v.value_table.time < args["stop"])
-        if query:
-            return l
-        l = l.order_by(desc(v.value_table.time))
-        l = l.limit(args["limit"]).offset(args["offset"])
-        t = v.value_table
-        n = l.count()
-        l = l.values(t.time, t.value)
-        return args, l, n
+        return l
+
+    def average(self, var, args):
+        v = db.lookup(current_app.db_session, var)
+        if not v:
+            abort(404, "Not found: {}".format(var))
+        keys = "time", "min", "max", "mean", "count"
+        try:
+            if not v.chunked:
+                l = v.aggregate(args["average"], args["start"], args["stop"])
+                l = l.limit(args["limit"]).offset(args["offset"]).all()
+                current_app.metrics.add("rows_read", len(l))
+                return dict((k, [r[i] for r in l])
+                        for i, k in enumerate(keys))
+        except DBAPIError:
+            logger.warning("falling back to numpy aggregation",
+                    exc_info=True)
+            current_app.db_session.rollback()
+        t, x = db.fetch(current_app.db_session, [v], args["start"],
+                args["stop"])[v]
+        current_app.metrics.add("rows_read", len(t))
+        l = db.aggregate_array(t, x.astype(float), args["average"])
+        i = slice(args["offset"], args["offset"] + args["limit"])
+        return dict((k, c[::-1][i].tolist()) for k, c in zip(keys, l))
+
+    def statistics(self, var, args):
+        v = db.lookup(current_app.db_session, var)
+        if not v:
+            abort(404, "Not found: {}".format(var))
+        d = v.statistics(args["start"], args["stop"])
+        # keep newly computed summaries
+        current_app.db_session.commit()
+        return d
 
     def get(self, var):
-        args, l, n = self.retrieve(var)
-        l = np.fromiter(l, [(str("time"), np.uint64), (str("value"), np.float32)], n)
+        v = db.lookup(current_app.db_session, var)
+        if not v:
+            abort(404, "Not found: {}".format(var))
+        return conditional(v, lambda: self.render(var), _data_mimetypes)
+
+    def render(self, var):
+        args = self.parse_query()
         if args["average"]:
-            pass
+            return {var: self.average(var, args)}
         if args["statistics"]:
-            return {
-                    "count": n,
-                    "time_min": float(l["time"].min()),
-                    "time_max": float(l["time"].max()),
-                    "time_mean": float(l["time"].mean()),
-                    "time_std": float(l["time"].std()),
-                    "value_min": float(l["value"].min()),
-                    "value_max": float(l["value"].max()),
-                    "value_mean": float(l["value"].mean()),
-                    "value_std": float(l["value"].std()),
-            }
-        else:
-            return {var: dict((int(a), float(b)) for a, b in l)}
+            return self.statistics(var, args)
+        args, (t, x), n = self.retrieve(var)
+        current_app.metrics.add("rows_read", n)
+        with current_app.metrics.timer("serialize"):
+            l = np.empty(n, db.record_dtype)
+            l["time"], l["value"] = t, x
+        mimetype = request.accept_mimetypes.best_match(_data_mimetypes,
+                _data_mimetypes[0])
+        if mimetype != "application/json":
+            return stream_array(l[::-1], mimetype)
+        return {var: dict(zip(l["time"].tolist(), l["value"].tolist()))}
 
     def put(self, var):
-        v = current_app.db_session.query(db.Variable).filter(
-            db.Variable.name == var).one()
+        v = db.lookup(current_app.db_session, var)
 
     def post(self, var):
-        args = self.update.parse_args()
-        v = current_app.db_session.query(db.Variable).filter(
-            db.Variable.name == var).first()
+        v = db.lookup(current_app.db_session, var)
         if not v:
             abort(404, "Not found: {}".format(var))
-        v.update(value=args["value"], time=args["time"])
-        current_app.db_session.commit()
+        if request.mimetype == "application/octet-stream":
+            try:
+                l = np.frombuffer(request.get_data(), db.record_dtype)
+            except ValueError as e:
+                abort(400, str(e))
+            rows = zip(l["time"].tolist(), l["value"].tolist())
+        elif request.mimetype == "application/json":
+            rows = json_rows("[[time, value], ...]", 2)
+        else:
+            args = self.update.parse_args()
+            rows = [(args["time"], args["value"])]
+        return {var: ingest((v, t, x) for t, x in rows)}
 
     def delete(self, var):
+        args = self.parse_query()
+        v = db.lookup(current_app.db_session, var)
+        if not v:
+            abort(404, "Not found: {}".format(var))
+        if v.chunked:
+            v.unpack(args["start"], args["stop"])
         self.retrieve(var, query=True).delete()
+        v.invalidate()
+        v.unroll(args["start"] or None, args["stop"] or None)
+        current_app.db_session.commit()
+        current_app.deadband.forget()
+        current_app.value_cache.forget()
+        current_app.response_cache.forget(v.id)
+
+
+def json_rows(shape, width):
+    # the JSON body if it is a list of rows of width, 400 otherwise
+    rows = request.get_json()
+    if not isinstance(rows, list) or not all(isinstance(r, list) and
+            len(r) == width for r in rows):
+        abort(400, "Need {}".format(shape))
+    return rows
+
+
+def checked(rows):
+    # [(variable, time, value)] with integer (or no) times and numeric
+    # values for numeric variables, 400 otherwise
+    l = []
+    for v, t, x in rows:
+        if t is not None and (not isinstance(t, numbers.Integral) or
+                isinstance(t, bool)):
+            abort(400, "Invalid time for {}: {!r}".format(v.name, t))
+        if v.type in ("float", "int", "bool"):
+            if (not isinstance(x, numbers.Real) or
+                    isinstance(x, bool) and v.type != "bool"):
+                abort(400, "Invalid value for {}: {!r}".format(v.name, x))
+            x = float(x)
+        l.append((v, t, x))
+    return l
+
+
+def ingest(rows):
+    # (variable, time, value), written now or handed to the write-behind
+    # writer
+    rows = checked(rows)
+    writer = current_app.writer
+    if writer is None:
+        stored = []
+        n = db.insert_values(current_app.db_session, rows, stored)
         current_app.db_session.commit()
+        for i in set(i for i, t, x in stored):
+            current_app.response_cache.forget(i)
+        current_app.notifier.publish(stored)
+        return n
+    now = int(pytime.time()*1e6)
+    rows = [(v.id, now if t is None else t, x) for v, t, x in rows]
+    if len(rows) > writer.size:
+        # retrying will not help
+        abort(413, "More than {} values".format(writer.size))
+    if not writer.put(rows):
+        abort(Response(json.dumps({"message": "Ingest queue full"}), 503,
+            {"Retry-After": "1"}, mimetype="application/json"))
+    return len(rows)
+
+
+class ResponseCache(object):
+    # rendered GET responses by (variable id, url, accept), evicted least
+    # recently used beyond size body bytes; each change to a variable
+    # bumps its generation and with it the ETag of its responses
+    def __init__(self, size=16*2**20):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.keys = collections.defaultdict(set)
+        self.used = 0
+        # ETags of earlier processes never match
+        self.epoch = int(pytime.time()*1e6)
+        self.generations = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def version(self, id):
+        return "{:x}-{:x}".format(self.epoch, self.generations[id])
+
+    def etag(self, id, time):
+        return "{}-{:x}".format(self.version(id), time or 0)
+
+    def get(self, key, etag):
+        with self.lock:
+            e = self.entries.pop(key, None)
+            if e is None or e[0] != etag:
+                self.misses += 1
+                if e is not None:
+                    self.drop(key, e)
+                return
+            self.entries[key] = e
+            self.hits += 1
+        etag, data, status, headers = e
+        return Response(data, status, headers)
+
+    def put(self, key, etag, response):
+        if response.is_streamed:
+            # generators are consumed by the client
+            return
+        data = response.get_data()
+        if len(data) > self.size:
+            return
+        with self.lock:
+            if not etag.startswith(self.version(key[0]) + "-"):
+                # changed while rendering
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.drop(key, old)
+            self.entries[key] = (etag, data, response.status_code,
+                    list(response.headers))
+            self.keys[key[0]].add(key)
+            self.used += len(data)
+            while self.used > self.size:
+                k = next(iter(self.entries))
+                self.drop(k, self.entries.pop(k))
+                self.evictions += 1
+
+    def drop(self, key, entry):
+        self.used -= len(entry[1])
+        self.keys[key[0]].discard(key)
+
+    def forget(self, id=None):
+        with self.lock:
+            if id is None:
+                self.epoch += 1
+                keys = list(self.entries)
+            else:
+                self.generations[id] += 1
+                keys = list(self.keys.pop(id, ()))
+            for k in keys:
+                e = self.entries.pop(k, None)
+                if e is not None:
+                    self.drop(k, e)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "size": len(self.entries),
+                "bytes": self.used}
+
+
+def conditional(v, render, mimetypes=("application/json",)):
+    # 304 if the client holds the current ETag of variable v in the
+    # negotiated one of mimetypes, else the cached or freshly rendered
+    # response
+    cache = current_app.response_cache
+    c = v.current
+    mimetype = request.accept_mimetypes.best_match(mimetypes, mimetypes[0])
+    etag = "{}-{}".format(cache.etag(v.id, c.time if c is not None else 0),
+            mimetype)
+    if request.if_none_match.contains(etag):
+        r = Response(status=304)
+    else:
+        key = v.id, request.full_path, mimetype
+        r = cache.get(key, etag)
+        if r is None:
+            r = render()
+            if not isinstance(r, Response):
+                r = output_json(r, 200)
+            cache.put(key, etag, r)
+    r.set_etag(etag)
+    r.vary.add("Accept")
+    return r
+
+
+def _json_list(a):
+    return [None if x != x else x for x in a.tolist()]
+
+
+def select_variables(args):
+    # the variables named by the names or collection arguments
+    session = current_app.db_session
+    if args["collection"]:
+        c = session.query(db.Collection).filter(
+                db.Collection.name == args["collection"]).first()
+        if not c:
+            abort(404, "Not found: {}".format(args["collection"]))
+        return c.variables()
+    if args["names"]:
+        names = [n.strip() for n in args["names"].split(",")]
+        variables = db.resolve(session, names)
+        for n in names:
+            if n not in variables:
+                abort(404, "Not found: {}".format(n))
+        return [variables[n] for n in names]
+    abort(400, "Need names or collection")
+
+
+class Query(restful.Resource):
+    query = reqparse.RequestParser()
+    query.add_argument("names", type=str)
+    query.add_argument("collection", type=str)
+    query.add_argument("start", type=int)
+    query.add_argument("stop", type=int)
+    query.add_argument("align", type=str,
+            choices=("previous", "nearest", "linear"))
+    query.add_argument("step", type=int)
+    query.add_argument("since", type=int)
+
+    def get(self):
+        args = self.query.parse_args()
+        session = current_app.db_session
+        variables = select_variables(args)
+        if args["since"] is not None:
+            args["start"] = max(args["start"] or 0, args["since"] + 1)
+        series = db.fetch(session, variables, args["start"], args["stop"])
+        current_app.metrics.add("rows_read", sum(len(t)
+            for t, x in series.values()))
+        if not args["align"]:
+            return dict((v.name, {"time": series[v][0].tolist(),
+                "value": series[v][1].tolist()}) for v in variables)
+        grid = None
+        if args["step"]:
+            start, stop = args["start"], args["stop"]
+            if start is None or stop is None:
+                abort(400, "Need start and stop for step")
+            grid = np.arange(start, stop, args["step"])
+        try:
+            grid, columns = db.align([series[v] for v in variables],
+                    args["align"], grid)
+        except ValueError as e:
+            abort(400, str(e))
+        if request.accept_mimetypes.best_match(["application/json",
+                "application/x-npy"]) == "application/x-npy":
+            l = np.empty(grid.shape, [(str("time"), "<i8")] +
+                    [(str(v.name), "<f8") for v in variables])
+            l["time"] = grid
+            for v, c in zip(variables, columns):
+                l[str(v.name)] = c
+            return stream_array(l, "application/x-npy")
+        return {"time": grid.tolist(), "values": dict((v.name,
+            _json_list(c)) for v, c in zip(variables, columns))}
+
+
+class Export(restful.Resource):
+    query = reqparse.RequestParser()
+    query.add_argument("start", type=int)
+    query.add_argument("stop", type=int)
+    query.add_argument("chunk", type=int, default=10000)
+
+    mimetypes = ["text/csv", "application/x-ndjson",
+            "application/octet-stream"]
+
+    def get(self, var):
+        args = self.query.parse_args()
+        v = db.lookup(current_app.db_session, var)
+        if not v:
+            abort(404, "Not found: {}".format(var))
+        mimetype = request.accept_mimetypes.best_match(self.mimetypes,
+                self.mimetypes[0])
+        chunks = v.iterchunks(args["start"], args["stop"], args["chunk"])
+
+        def generate():
+            f = io.StringIO()
+            w = csv.writer(f, lineterminator="\n")
+            if mimetype == "text/csv":
+                w.writerow(["time", var])
+                yield _drain(f)
+            for c in chunks:
+                if mimetype == "text/csv":
+                    w.writerows(c)
+                    yield _drain(f)
+                elif mimetype == "application/x-ndjson":
+                    yield "".join(json.dumps({"time": t, "value": x}) + "\n"
+                            for t, x in c)
+                else:
+                    yield np.array(c, db.record_dtype).tobytes()
+
+        return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+class Stream(restful.Resource):
+    # server-sent events of new values: one event per committed batch,
+    # {name: {"time": [...], "value": [...]}} as from Query, after the
+    # values newer than since
+    query = reqparse.RequestParser()
+    query.add_argument("names", type=str)
+    query.add_argument("collection", type=str)
+    query.add_argument("since", type=int)
+    query.add_argument("heartbeat", type=float, default=15.)
+
+    def get(self):
+        args = self.query.parse_args()
+        variables = select_variables(args)
+        for v in variables:
+            if v.type == "binary":
+                abort(400, "Can not stream binary: {}".format(v.name))
+        names = dict((v.id, v.name) for v in variables)
+        notifier = current_app.notifier
+        # subscribe before reading the backlog to not miss values
+        q = notifier.subscribe(names)
+        last = {}
+        backlog = {}
+        if args["since"] is not None:
+            series = db.fetch(current_app.db_session, variables,
+                    args["since"] + 1)
+            current_app.metrics.add("rows_read", sum(len(t)
+                for t, x in series.values()))
+            for v, (t, x) in series.items():
+                if len(t):
+                    backlog[v.name] = {"time": t.tolist(),
+                            "value": x.tolist()}
+                    last[v.id] = int(t[-1])
+        current_app.db_session.remove()
+
+        def generate():
+            try:
+                if backlog:
+                    yield "data: {}\n\n".format(json.dumps(backlog))
+                while not q.overflow:
+                    try:
+                        rows = q.get(timeout=args["heartbeat"])
+                    except queue.Empty:
+                        yield ": heartbeat\n\n"
+                        continue
+                    d = {}
+                    for i, t, x in rows:
+                        if t <= last.get(i, t - 1):
+                            continue
+                        e = d.setdefault(names[i], {"time": [],
+                            "value": []})
+                        e["time"].append(t)
+                        e["value"].append(x)
+                    if d:
+                        yield "data: {}\n\n".format(json.dumps(d))
+                # too slow a client, reconnect with since
+                yield "event: overflow\ndata: {}\n\n"
+            finally:
+                notifier.unsubscribe(q)
+
+        return Response(generate(), mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache"})
+
+
+class Notifier(object):
+    # fans committed (variable_id, time, value) rows out to the Stream
+    # subscribers, a subscriber whose queue of size batches is full is
+    # marked overflown and dropped
+    def __init__(self, size=1000):
+        self.size = size
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.published = 0
+        self.overflows = 0
+
+    def subscribe(self, ids):
+        q = queue.Queue(self.size)
+        q.overflow = False
+        with self.lock:
+            self.subscribers[q] = frozenset(ids)
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.pop(q, None)
+
+    def publish(self, rows):
+        if not rows or not self.subscribers:
+            return
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+        for q, ids in subscribers:
+            r = [row for row in rows if row[0] in ids]
+            if not r:
+                continue
+            try:
+                q.put_nowait(r)
+                self.published += len(r)
+            except queue.Full:
+                q.overflow = True
+                self.overflows += 1
+                self.unsubscribe(q)
+
+    def stats(self):
+        return {"subscribers": len(self.subscribers),
+                "published": self.published, "overflows": self.overflows}
 
 
 class Update(restful.Resource):
     def post(self, time=None):
-        if time is None:
-            time = int(pytime.time()*1e6)
-        for k, v in request.values.items():
-            v = float(v)
-            q = current_app.db_session.query(db.Variable).filter(
-                db.Variable.name == k).first()
-            if not q:
+        if request.mimetype == "application/json":
+            rows = json_rows("[[name, time, value], ...]", 3)
+            if not all(isinstance(r[0], type("")) for r in rows):
+                abort(400, "Need names")
+        elif request.mimetype == "application/octet-stream":
+            # binary frames of packed records per name, see listener
+            from .listener import parse
+            rows, tail, errors = parse(request.get_data(),
+                    int(pytime.time()*1e6))
+            if tail or tail is None or errors:
+                abort(400, "Malformed frames")
+        else:
+            if time is None:
+                time = int(pytime.time()*1e6)
+            rows = [(k, time, float(v)) for k, v in request.values.items()]
+        variables = db.resolve(current_app.db_session,
+                (k for k, t, v in rows))
+        for k, t, v in rows:
+            if k not in variables:
                 abort(404, "Not found: {}".format(k))
-            q.update(value=v, time=time)
-        current_app.db_session.commit()
+        return {"count": ingest((variables[k], t, v) for k, t, v in rows)}
+
 
+def output_json(data, code, headers=None):
+    with current_app.metrics.timer("serialize"):
+        return restful_json.output_json(data, code, headers)
+
+
+class Metrics(restful.Resource):
+    # GET: per endpoint request metrics, PUT: slow request profiling
+    # (rate 0 to disable, the directory is set on the command line)
+    update = reqparse.RequestParser()
+    update.add_argument("profile_slow", type=float)
+    update.add_argument("profile_rate", type=float)
 
-def create_app(database):
+    def get(self):
+        return current_app.metrics.stats()
+
+    def put(self):
+        args = self.update.parse_args()
+        m = current_app.metrics
+        if args["profile_slow"] is not None:
+            m.profile_slow = args["profile_slow"]
+        if args["profile_rate"] is not None:
+            m.profile_rate = args["profile_rate"]
+        return m.stats()["profile"]
+
+
+class Stats(restful.Resource):
+    def get(self):
+        d = {"deadband": current_app.deadband.stats(),
+                "value_cache": current_app.value_cache.stats(),
+                "name_cache": current_app.name_cache.stats(),
+                "response_cache": current_app.response_cache.stats(),
+                "notifier": current_app.notifier.stats()}
+        if current_app.writer is not None:
+            d["writer"] = current_app.writer.stats()
+        if current_app.listener is not None:
+            d["listener"] = current_app.listener.stats()
+        return d
+
+
+class Writer(threading.Thread):
+    # write-behind: batches of (variable_id, time, value) rows are
+    # group committed when batch rows are pending or deadline seconds
+    # after the oldest one arrived
+    def __init__(self, session_factory, size=100000, batch=10000,
+            deadline=.2, response_cache=None, notifier=None):
+        threading.Thread.__init__(self, name="writer")
+        self.daemon = True
+        self.session_factory = session_factory
+        self.response_cache = response_cache
+        self.notifier = notifier
+        self.size = size
+        self.batch = batch
+        self.deadline = deadline
+        self.pending = collections.deque()
+        self.depth = 0
+        self.since = None
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.rejected = 0
+        self.discarded = 0
+        self.written = 0
+        self.commits = 0
+        self.commit_time = 0.
+        self.commit_max = 0.
+
+    def put(self, rows):
+        with self.cond:
+            if self.stopped or self.depth + len(rows) > self.size:
+                self.rejected += len(rows)
+                return False
+            if not self.pending:
+                # starts the deadline
+                self.since = pytime.time()
+                self.cond.notify()
+            self.pending.append(rows)
+            self.depth += len(rows)
+            if self.depth >= self.batch:
+                self.cond.notify()
+        return True
+
+    def take(self):
+        with self.cond:
+            while not self.stopped:
+                if self.depth >= self.batch:
+                    break
+                if self.pending:
+                    wait = self.since + self.deadline - pytime.time()
+                    if wait <= 0:
+                        break
+                else:
+                    wait = None
+                self.cond.wait(wait)
+            batches = list(self.pending)
+            self.pending.clear()
+            self.depth = 0
+            return batches
+
+    def run(self):
+        while True:
+            batches = self.take()
+            if batches:
+                self.write(batches)
+            elif self.stopped:
+                break
+
+    def write(self, batches):
+        # one commit for all batches, each on its own if that fails so
+        # that a bad batch does not take the others down with it
+        t0 = pytime.time()
+        try:
+            self.commit([r for b in batches for r in b])
+        except Exception:
+            logger.warning("group commit of %i batches failed",
+                    len(batches), exc_info=True)
+            for rows in batches:
+                try:
+                    self.commit(rows)
+                except Exception:
+                    logger.exception("discarding %i values", len(rows))
+                    self.discarded += len(rows)
+        dt = pytime.time() - t0
+        self.commits += 1
+        self.commit_time += dt
+        self.commit_max = max(self.commit_max, dt)
+
+    def commit(self, rows):
+        session = self.session_factory()
+        try:
+            variables = dict((v.id, v) for v in session.query(
+                db.Variable).filter(db.Variable.id.in_(
+                    set(i for i, t, x in rows))))
+            stored = []
+            n = db.insert_values(session, ((variables[i], t, x)
+                for i, t, x in rows if i in variables), stored)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        self.written += n
+        if self.response_cache is not None:
+            for i in variables:
+                self.response_cache.forget(i)
+        if self.notifier is not None:
+            self.notifier.publish(stored)
+
+    def stop(self):
+        # flush pending rows and wait for the writer
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.join()
+
+    def stats(self):
+        return {"depth": self.depth, "size": self.size,
+                "rejected": self.rejected, "discarded": self.discarded,
+                "written": self.written, "commits": self.commits,
+                "commit_mean": self.commit_time/max(1, self.commits),
+                "commit_max": self.commit_max}
+
+
+class Compactor(threading.Thread):
+    def __init__(self, session_factory, interval, retention=None,
+            response_cache=None, partitioned=False):
+        threading.Thread.__init__(self, name="compactor")
+        self.daemon = True
+        self.session_factory = session_factory
+        self.interval = interval
+        self.retention = retention
+        self.partitioned = partitioned
+        self.response_cache = response_cache
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.compact()
+
+    def compact(self):
+        session = self.session_factory()
+        try:
+            rolled, deleted = db.compact(session)
+            session.commit()
+            logger.info("rolled up %i buckets, deleted %i values",
+                    rolled, deleted)
+            engine = session.get_bind()
+            if self.partitioned:
+                partition.ensure(engine)
+            if self.retention:
+                now = int(pytime.time()*1e6)
+                n = partition.expire(engine, now - int(self.retention*1e6))
+                logger.info("expired %i partitions/values", n)
+                cache = session.info.get("value_cache")
+                if cache is not None:
+                    cache.forget()
+            if self.response_cache is not None:
+                self.response_cache.forget()
+        except Exception:
+            logger.exception("compaction failed")
+            session.rollback()
+        finally:
+            session.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def create_app(database, compact=None, write_behind=False, retention=None,
+        response_cache=16*2**20, pool_size=None, profile_dir=None,
+        profile_slow=1., partitioned=False):
+    # partitioned (implied by retention): monthly partitions on MySQL,
+    # the value tables are rewritten the first time
     app = Flask(__name__)
     api = restful.Api(app)
+    api.representation("application/json")(output_json)
 
-    engine = create_engine(database, convert_unicode=True)
-    db_session = scoped_session(sessionmaker(autocommit=False,
-        autoflush=False, bind=engine))
+    engine = db.connect(database, pool_size=pool_size,
+            convert_unicode=True)
+    metrics.install(app, engine, metrics.Metrics(profile_dir, profile_slow))
+    app.deadband = db.Deadband()
+    app.value_cache = db.ValueCache()
+    app.name_cache = db.NameCache()
+    app.response_cache = ResponseCache(response_cache)
+    app.notifier = Notifier()
+    session_factory = sessionmaker(autocommit=False, autoflush=False,
+        bind=engine, info={"deadband": app.deadband,
+            "value_cache": app.value_cache,
+            "closure_cache": db.ClosureCache(),
+            "name_cache": app.name_cache})
+    db_session = scoped_session(session_factory)
     db.Base.query = db_session.query_property()
-    db.Base.metadata.create_all(engine)
+    db.create_schema(engine)
+    partitioned = partitioned or bool(retention)
+    if partitioned:
+        partition.ensure(engine)
     app.db_session = db_session
 
     api.add_resource(List, "/1/list/<string:type>")
     api.add_resource(Collection, "/1/collection/<string:coll>")
     api.add_resource(Variable, "/1/variable/<string:var>")
     api.add_resource(Data, "/1/data/<string:var>")
+    api.add_resource(Query, "/1/query")
+    api.add_resource(Export, "/1/export/<string:var>")
+    api.add_resource(Stream, "/1/stream")
     api.add_resource(Update, "/1/update")
+    api.add_resource(Stats, "/1/stats")
+    api.add_resource(Metrics, "/1/metrics")
 
     app.teardown_appcontext(shutdown_session)
+
+    if compact:
+        app.compactor = Compactor(db_session.session_factory, compact,
+                retention, app.response_cache, partitioned)
+        app.compactor.start()
+    app.writer = None
+    app.listener = None
+    if write_behind:
+        app.writer = Writer(db_session.session_factory,
+                response_cache=app.response_cache, notifier=app.notifier)
+        app.writer.start()
+        atexit.register(app.writer.stop)
     return app
 
 
-def main():
+def arguments():
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verbose", action="count", default=0)
@@ -252,15 +1013,56 @@ def main():
     parser.add_argument("-l", "--listen", default="0.0.0.0")
     parser.add_argument("-p", "--port", default="6881", type=int)
     parser.add_argument("-d", "--database", default="sqlite:///qlog.sqlite")
-    args = parser.parse_args()
+    parser.add_argument("-a", "--compact", default=600, type=float,
+            help="rollup/expiry interval in seconds (0 to disable)")
+    parser.add_argument("-w", "--write-behind", action="store_true",
+            help="queue ingested values and group commit them")
+    parser.add_argument("-r", "--retention", default=0, type=float,
+            help="drop raw values older than this many seconds "
+            "(whole monthly partitions on MySQL, 0 to keep all)")
+    parser.add_argument("--partition", action="store_true",
+            help="partition the value tables by month on MySQL "
+            "(implied by --retention, rewrites existing tables)")
+    parser.add_argument("-c", "--response-cache", default=16, type=float,
+            help="memory bound of the response cache in MiB")
+    parser.add_argument("-i", "--ingest-port", default=0, type=int,
+            help="also accept line protocol and binary frames over "
+            "TCP and UDP on this port (implies --write-behind)")
+    parser.add_argument("--profile-dir",
+            help="dump cProfile data of slow requests here")
+    parser.add_argument("--profile-slow", default=1., type=float,
+            help="profile dump threshold in seconds")
+    return parser
+
 
+def app_from_arguments(args, **kwargs):
     level = [logging.CRITICAL, logging.ERROR, logging.WARN, logging.INFO,
             logging.DEBUG][args.verbose - args.quiet + 3]
     logging.basicConfig(level=level)
 
-    app = create_app(args.database)
+    app = create_app(args.database, compact=args.compact,
+            write_behind=args.write_behind or bool(args.ingest_port),
+            retention=args.retention, partitioned=args.partition,
+            response_cache=int(args.response_cache*2**20),
+            profile_dir=args.profile_dir, profile_slow=args.profile_slow,
+            **kwargs)
+    if args.ingest_port:
+        from .listener import Listener
+        app.listener = Listener(app, args.listen, args.ingest_port)
+        app.listener.start()
+    return app
+
+
+def main():
+    parser = arguments()
+    parser.add_argument("-k", "--pool-size", default=8, type=int,
+            help="database connections, as many again on overflow")
+    args = parser.parse_args()
+    # a thread per request, streams block theirs: pooled connections
+    # shared across threads, not one per thread
+    app = app_from_arguments(args, pool_size=args.pool_size)
     app.run(host=args.listen, port=args.port,
-            debug=args.verbose > args.quiet)
+            debug=args.verbose > args.quiet, threaded=True)
 
 
 if __name__ == "__main__":
@@ -1,18 +1,36 @@
 from __future__ import (absolute_import, print_function,
                 unicode_literals, division)
 
-from qlog import *
+# imports are deferred to the actions that need them: most calls set or
+# read a few values from cron or shell loops and should start fast
 
 
-def main():
-    import argparse
-    import logging
+def parse_time(s):
+    # local date/time string to us
     import time
-
     import dateutil.parser
-    import numpy as np
+    t = dateutil.parser.parse(s)
+    return int(time.mktime(t.timetuple())*1e6) + t.microsecond
+
 
-    from sqlalchemy import create_engine, orm
+def names(actions):
+    # variable names referenced by the actions
+    for action in actions:
+        if "=" in action:
+            yield action.split("=")[0].strip()
+        elif action == "?":
+            pass
+        elif "," in action:
+            for n in action.split(","):
+                if n.strip():
+                    yield n.strip()
+        else:
+            yield action.rstrip("?").strip()
+
+
+def main():
+    import argparse
+    import logging
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--database", type=str,
@@ -20,10 +38,10 @@ def main():
     parser.add_argument("-c", "--collection", type=str, default="all")
     parser.add_argument("-v", "--verbose", action="count", default=0)
     parser.add_argument("-q", "--quiet", action="count", default=0)
-    parser.add_argument("-b", "--start", type=dateutil.parser.parse,
-            default=None)
-    parser.add_argument("-e", "--stop", type=dateutil.parser.parse,
-            default=None)
+    parser.add_argument("-b", "--start", type=str, default=None)
+    parser.add_argument("-e", "--stop", type=str, default=None)
+    parser.add_argument("-n", "--no-schema", action="store_true",
+            help="skip creating missing tables")
     parser.add_argument("actions", nargs="+")
     args = parser.parse_args()
 
@@ -32,33 +50,62 @@ def main():
     logging.basicConfig(level=level)
     #color_log_setup(level=level)
 
+    from sqlalchemy import orm
+    from . import db
+
+    start = parse_time(args.start) if args.start else None
+    stop = parse_time(args.stop) if args.stop else None
+
     echo = args.verbose - args.quiet > 0
-    engine = create_engine(args.database, echo=echo)
-    Base.metadata.create_all(engine)
+    engine = db.connect(args.database, echo=echo)
+    if not args.no_schema:
+        db.create_schema(engine)
     Session = orm.sessionmaker(bind=engine)
     session = Session()
-    collection = session.query(Collection).filter(
-            Collection.name == args.collection).first()
+    collection = session.query(db.Collection).filter(
+            db.Collection.name == args.collection).first()
     if collection is None:
-        collection = Collection(name=args.collection)
+        collection = db.Collection(name=args.collection)
         session.add(collection)
+        session.flush()
+
+    # one query for all named variables and one for the membership
+    variables = db.resolve(session, names(args.actions))
+    members = collection.variable_ids()
+
+    def get(n):
+        v = variables.get(n)
+        if v is None or v.id not in members:
+            raise KeyError("Not found in {}: {}".format(args.collection, n))
+        return v
 
+    # the last value per variable, they all get the same time
+    pending = {}
     for action in args.actions:
+        if "=" not in action and pending:
+            # make pending values visible to the reads
+            db.insert_values(session, [(var, None, x)
+                for var, x in pending.items()])
+            pending = {}
         if "=" in action:
             k, v = action.split("=")
-            collection.get(k.strip(), create=True).value = float(v)
+            k = k.strip()
+            var = variables.get(k)
+            if var is None:
+                var = variables[k] = db.Variable(k)
+                session.add(var)
+            if var.id is None or var.id not in members:
+                collection.primary_variables.append(var)
+                session.flush()
+                members = members | set([var.id])
+            pending[var] = float(v)
         elif action == "?":
-            print(", ".join("%s = %g" % (v.name, v.value) for v in 
+            print(", ".join("%s = %g" % (v.name, v.value) for v in
                     collection.variables()))
         elif action.endswith("?"):
             n = action.rstrip("?").strip()
             print("time, %s" % n)
-            var = collection.get(n)
-            if args.start:
-                args.start = time.mktime(args.start.timetuple())*1e6 + t.microsecond
-            if args.stop:
-                args.stop = time.mktime(args.stop.timetuple())*1e6 + t.microsecond
-            for t, v in var.iterhistory(args.start, args.stop):
+            for t, v in get(n).iterhistory(start, stop):
                 print("%s, %g" % (t, v))
         elif "," in action:
             import matplotlib.pyplot as plt
@@ -67,17 +114,20 @@ def main():
                 n = n.strip()
                 if not n:
                     continue
-                var = collection.get(n)
-                t, v = np.array(list(var.iterhistory(args.start, args.stop))).T
+                var = get(n)
+                # the envelope of a long range, not every value
+                t, v = var.decimate(start, stop, width=2000)
                 ax.plot(t, v, label=n)
-                if var.info.logarithmic:
+                if var.logarithmic:
                     ax.set_yscale("log")
             fig.autofmt_xdate()
             ax.legend()
             fig.savefig("%s_%s.pdf" % (args.collection, action))
         else:
-            k = action.strip()
-            print("%g" % collection.get(k).value)
+            print("%g" % get(action.strip()).value)
+    if pending:
+        db.insert_values(session, [(var, None, x)
+            for var, x in pending.items()])
     session.commit()
 
 if __name__ == "__main__":
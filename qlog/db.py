@@ -1,17 +1,48 @@
 from __future__ import (absolute_import, print_function,
                 unicode_literals, division)
 
-import time as pytime, datetime
+import time as pytime, math, itertools, zlib, threading
 
-from sqlalchemy import (Column, Integer, String, DateTime, Float,
-    ForeignKey, desc, asc, Boolean, Binary, Text, BigInteger)
+from sqlalchemy import (event, Column, Integer, String, DateTime, Float,
+    ForeignKey, desc, asc, Boolean, Binary, Text, BigInteger, func,
+    literal, select, cast, PrimaryKeyConstraint, LargeBinary, bindparam,
+    or_, union_all)
 from sqlalchemy.ext.declarative import (declarative_base, declared_attr,
         AbstractConcreteBase)
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm.collections import column_mapped_collection
 from sqlalchemy.ext.orderinglist import ordering_list
-from sqlalchemy.orm import relationship, backref, object_session
+from sqlalchemy.orm import (relationship, backref, object_session, synonym,
+        Session, validates, make_transient_to_detached, scoped_session,
+        aliased)
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.ext import baked
+
+
+# packed (time, value) records as exchanged with clients
+record_dtype = [(str("time"), "<i8"), (str("value"), "<f8")]
+
+# time span of a SummaryValue
+summary_segment = 3600*10**6
+
+# time span and maximum length of a ChunkValue
+chunk_span = 3600*10**6
+chunk_points = 4096
+
+# queries and Core statements built and compiled once
+bakery = baked.bakery()
+_compiled_cache = {}
+_statements = {}
+
+# applied to every new sqlite connection by connect()
+sqlite_pragmas = [
+        ("journal_mode", "WAL"), # readers do not block the writer
+        ("synchronous", "NORMAL"), # no fsync per commit under WAL
+        ("cache_size", -64*1024), # KiB
+        ("mmap_size", 256*1024*1024),
+        ("temp_store", "MEMORY"),
+]
 
 
 class Tablename(object):
@@ -23,6 +54,12 @@ Base = declarative_base(cls=Tablename)
 
 
 class Value(AbstractConcreteBase):
+    @declared_attr
+    def __table_args__(cls):
+        # clustered on (variable_id, time)
+        return (PrimaryKeyConstraint("variable_id", "time"),
+                {"sqlite_with_rowid": False})
+
     @declared_attr
     def variable_id(cls):
         return Column(Integer, ForeignKey("variable.id", ondelete="cascade"),
@@ -56,6 +93,63 @@ class BinaryValue(Value, Base):
     value = Column(Binary(65535))
 
 
+class AggregateValue(Base):
+    # rollup of raw values into buckets of Variable.aggregate_stamp
+    __table_args__ = {"sqlite_with_rowid": False}
+    variable_id = Column(Integer, ForeignKey("variable.id", ondelete="cascade"),
+            primary_key=True)
+    stamp = Column(BigInteger(), primary_key=True)
+    time = Column(BigInteger(), primary_key=True)
+    minimum = Column(Float)
+    maximum = Column(Float)
+    mean = Column(Float)
+    count = Column(Integer)
+    value = synonym("mean")
+
+
+class SummaryValue(Base):
+    # partial sums of a completed segment for Variable.statistics(),
+    # time sums are relative to the segment start, value sums to
+    # value_ref (the segment minimum)
+    __table_args__ = {"sqlite_with_rowid": False}
+    variable_id = Column(Integer, ForeignKey("variable.id", ondelete="cascade"),
+            primary_key=True)
+    time = Column(BigInteger(), primary_key=True)
+    count = Column(Integer)
+    value_min = Column(Float)
+    value_max = Column(Float)
+    value_ref = Column(Float)
+    value_sum = Column(Float)
+    value_sum2 = Column(Float)
+    time_min = Column(BigInteger())
+    time_max = Column(BigInteger())
+    time_sum = Column(Float)
+    time_sum2 = Column(Float)
+
+
+class ChunkValue(Base):
+    # compressed run of values of a chunk storage variable from time to
+    # stop (both inclusive) within one chunk_span, see encode_chunk()
+    __table_args__ = {"sqlite_with_rowid": False}
+    variable_id = Column(Integer, ForeignKey("variable.id", ondelete="cascade"),
+            primary_key=True)
+    time = Column(BigInteger(), primary_key=True)
+    stop = Column(BigInteger())
+    count = Column(Integer)
+    data = Column(LargeBinary(2**24 - 1))
+
+
+def _moments(t, ref, value_ref):
+    # summary columns over value table t, times relative to ref, values
+    # relative to value_ref
+    v = cast(t.value, Float)
+    dv = v - value_ref
+    dt = cast(t.time - ref, Float)
+    return [func.count(t.value), func.min(v), func.max(v), func.sum(dv),
+            func.sum(dv*dv), func.min(t.time), func.max(t.time),
+            func.sum(dt), func.sum(dt*dt)]
+
+
 class Variable(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(255), nullable=False, unique=True)
@@ -72,6 +166,13 @@ class Variable(Base):
     aggregate_stamp = Column(BigInteger)
     aggregate_age = Column(BigInteger)
     delete_age = Column(BigInteger)
+    # None: one row per value, "chunk": float and int values older than
+    # the current chunk_span are packed into ChunkValues by compact()
+    storage = Column(String(255))
+    # oldest value written into the rolled up range since the last
+    # rollup() and the time before which expire() deleted the raw values
+    rollup_late = Column(BigInteger)
+    expire_stop = Column(BigInteger)
 
     float_values = relationship(FloatValue, lazy="dynamic",
             cascade="all, delete-orphan", passive_deletes=True)
@@ -83,6 +184,12 @@ class Variable(Base):
             cascade="all, delete-orphan", passive_deletes=True)
     binary_values = relationship(BinaryValue, lazy="dynamic",
             cascade="all, delete-orphan", passive_deletes=True)
+    aggregate_values = relationship(AggregateValue, lazy="dynamic",
+            cascade="all, delete-orphan", passive_deletes=True)
+    summary_values = relationship(SummaryValue, lazy="dynamic",
+            cascade="all, delete-orphan", passive_deletes=True)
+    chunk_values = relationship(ChunkValue, lazy="dynamic",
+            cascade="all, delete-orphan", passive_deletes=True)
 
     def __init__(self, name, value=None, time=None, type="float"):
         self.name = name
@@ -100,7 +207,7 @@ class Variable(Base):
         elif t == "text":
             return TextValue
         elif t == "bool":
-            return BoolValue
+            return BooleanValue
         elif t == "binary":
             return BinaryValue
         else:
@@ -113,43 +220,750 @@ class Variable(Base):
             return self.float_values
         elif t == "int":
             return self.integer_values
-        elif t == "string":
+        elif t == "text":
             return self.string_values
         elif t == "bool":
-            return self.bool_values
+            return self.boolean_values
         elif t == "binary":
             return self.binary_values
         else:
             raise ValueError(t)
 
+    @property
+    def chunked(self):
+        return self.storage == "chunk" and self.type in ("float", "int")
+
+    @validates("storage")
+    def validate_storage(self, key, storage):
+        # leaving chunk storage moves the packed values back to rows
+        if (self.storage == "chunk" and storage != "chunk" and
+                object_session(self) is not None and self.id is not None):
+            self.unpack()
+        return storage
+
     def update(self, value=None, time=None):
         if time is None:
             time = int(pytime.time()*1e6)
+        session = object_session(self)
+        if session is not None and "deadband" in session.info:
+            if self.id is None:
+                session.flush()
+            if not session.info["deadband"].accept(self, time, value):
+                return
+            _uncommitted(session, self.id)
+        if session is not None and "value_cache" in session.info:
+            if self.id is None:
+                session.flush()
+            session.info["value_cache"].put(self.id, time, value)
+            _uncommitted(session, self.id)
+        if session is not None and self.id is not None:
+            self.invalidate(time)
         v = self.value_table(value, time)
         self.values.append(v)
         return v
 
-    def update_series(self, values, times):
-        for vi, ti in zip(values, times):
-            self.update(vi, ti)
+    def update_series(self, values, times, chunk=10000):
+        times = to_us(times)
+        session = object_session(self)
+        if session is None:
+            for vi, ti in zip(values, times.tolist()):
+                self.update(vi, ti)
+            return
+        if self.id is None:
+            session.flush()
+        insert_columns(session, self.value_table, [(self, values)],
+                times, chunk)
 
     def last(self):
         return self.values.order_by(desc(self.value_table.time))
 
-    def history(self, start=None, stop=None):
-        v = self.last()
-        if start:
-            v = v.filter(Value.time >= start)
-        if stop:
-            v = v.filter(Value.time < stop)
+    def latest(self):
+        # (time, value) of the newest value or None
+        v = self.last().first()
+        if v is not None:
+            v = v.time, v.value
+        if self.chunked:
+            c = self.chunk_values.order_by(desc(ChunkValue.time)).first()
+            if c is not None and (v is None or c.stop > v[0]):
+                t, x = decode_chunk(c.data, self.type)
+                v = int(t[-1]), x[-1].item()
         return v
 
-    def iterhistory(self, start=None, stop=None):
+    def rollup_split(self, resolution, start=None):
+        # end of the rollups if values at resolution are served from
+        # them for a range beginning at start (raw values after), or None
+        if (resolution is None or not self.aggregate_stamp or
+                resolution < self.aggregate_stamp):
+            return None
+        end = self.aggregated()
+        if end is not None and (start is None or start < end):
+            return end
+
+    def history(self, start=None, stop=None, resolution=None):
+        # query of values, newest first, at resolution the rollup means
+        # up to aggregated() and the raw values after; packed values are
+        # not rows, use iterhistory() or fetch() for chunk storage
+        if self.chunked:
+            raise ValueError("chunk storage")
+        split = self.rollup_split(resolution, start)
+        if split is None:
+            t = self.value_table
+            v = self.last()
+            if start is not None:
+                v = v.filter(t.time >= start)
+            if stop is not None:
+                v = v.filter(t.time < stop)
+            return v
+        if stop is not None:
+            split = min(split, stop)
+        t = self.value_table.__table__
+        raw = select([t.c.time, t.c.value]).where(
+                (t.c.variable_id == self.id) & (t.c.time >= split))
+        if stop is not None:
+            raw = raw.where(t.c.time < stop)
+        u = union_all(self._rolled(start, split), raw).alias()
+        return object_session(self).query(u.c.time, u.c.value).order_by(
+                desc(u.c.time))
+
+    def _rolled(self, start, stop):
+        # (time, mean) of the rollups in [start, stop)
+        a = AggregateValue.__table__
+        q = select([a.c.time, a.c.mean.label("value")]).where(
+                (a.c.variable_id == self.id) &
+                (a.c.stamp == self.aggregate_stamp) & (a.c.time < stop))
+        if start is not None:
+            q = q.where(a.c.time >= start)
+        return q
+
+    def recent(self, start=None, stop=None, limit=1000, offset=0):
+        # [(time, value)] newest first in [start, stop)
+        t, v = self.recent_array(start, stop, limit, offset)
+        return list(zip(t.tolist(), v.tolist()))
+
+    def recent_array(self, start=None, stop=None, limit=1000, offset=0):
+        # (times, values) arrays newest first in [start, stop)
+        if self.chunked:
+            import numpy as np
+            parts = []
+            n = 0
+            for t, v in self.windows(start, stop, reverse=True):
+                parts.append((t[::-1], v[::-1]))
+                n += len(t)
+                if n >= offset + limit:
+                    break
+            if not parts:
+                return (np.empty(0, np.int64),
+                        np.empty(0, _value_dtypes[self.type]))
+            i = slice(offset, offset + limit)
+            return (np.concatenate([t for t, v in parts])[i],
+                    np.concatenate([v for t, v in parts])[i])
+        return read_columns(execute(object_session(self),
+            recent_statement(self.value_table), id=self.id,
+            start=-2**63 if start is None else start,
+            stop=2**63 - 1 if stop is None else stop,
+            limit=limit, offset=offset),
+            ["i8", _value_dtypes.get(self.type, object)], limit)
+
+    def history_array(self, start=None, stop=None, size=10000):
+        # (int64 times, values) ascending in [start, stop), only the two
+        # columns through Core into arrays, no ORM object per row
+        if self.chunked:
+            import numpy as np
+            parts = list(self.windows(start, stop))
+            if not parts:
+                return (np.empty(0, np.int64),
+                        np.empty(0, _value_dtypes[self.type]))
+            return (np.concatenate([t for t, v in parts]),
+                    np.concatenate([v for t, v in parts]))
+        return read_columns(execute(object_session(self),
+            range_statement(self.value_table), id=self.id,
+            start=-2**63 if start is None else start,
+            stop=2**63 - 1 if stop is None else stop),
+            ["i8", _value_dtypes.get(self.type, object)], size)
+
+    def decimate(self, start=None, stop=None, width=1000, mode="m4",
+            size=100000):
+        # (int64 times, values) ascending in [start, stop) for a plot
+        # width pixels wide: "m4" keeps the first, last, minimum and
+        # maximum of each pixel column, "lttb" width points by largest
+        # triangle three buckets over an M4 of 4*width columns; the
+        # range streams through m4() in batches of size rows, from the
+        # rollups where columns span at least aggregate_stamp
+        import numpy as np
+        if mode not in ("m4", "lttb"):
+            raise ValueError(mode)
+        if self.type not in ("float", "int"):
+            raise ValueError(self.type)
+        buckets = width if mode == "m4" else 4*width
+        session = object_session(self)
+        if self.chunked:
+            t, v = fetch(session, [self], start, stop)[self]
+            parts = [(t, v)]
+            if len(t):
+                start = t[0] if start is None else start
+                stop = t[-1] + 1 if stop is None else stop
+        else:
+            table = self.value_table.__table__
+            q = select([table.c.time]).where(
+                    table.c.variable_id == self.id).limit(1)
+            if start is not None:
+                q = q.where(table.c.time >= start)
+            if stop is not None:
+                q = q.where(table.c.time < stop)
+            # one index lookup each, unlike min() and max() together
+            first = session.execute(q.order_by(asc(table.c.time))).scalar()
+            last = session.execute(q.order_by(desc(table.c.time))).scalar()
+            parts = []
+            if first is not None:
+                start, stop = first, last + 1
+                split = start
+                stamp = self.aggregate_stamp
+                if stamp and (stop - start)//buckets >= stamp:
+                    # the rollups grouped into columns (as the minimum
+                    # at the first and the maximum at the last rolled up
+                    # bucket of each), raw values after the rollups end
+                    end = self.aggregated()
+                    if end is not None and end > start:
+                        split = min(end, stop)
+                        step = (stop - start)//buckets
+                        step -= step % stamp
+                        a = AggregateValue.__table__
+                        b = a.c.time - (a.c.time - start) % step
+                        r = session.execute(select([func.min(a.c.time),
+                            func.max(a.c.time), func.min(a.c.minimum),
+                            func.max(a.c.maximum)]).where(
+                            (a.c.variable_id == self.id) &
+                            (a.c.stamp == stamp) & (a.c.time >= start) &
+                            (a.c.time < split)).group_by(b).order_by(b))
+                        t0, t1, lo, hi = read_columns(r,
+                                ["i8", "i8", "f8", "f8"])
+                        parts.append((np.c_[t0, t1].ravel(),
+                            np.c_[lo, hi].ravel().astype(
+                                _value_dtypes[self.type])))
+                if split < stop:
+                    for t, v in iter_columns(execute(session,
+                            range_statement(self.value_table), id=self.id,
+                            start=split, stop=stop),
+                            ["i8", _value_dtypes[self.type]], size):
+                        # M4 of the M4s of the parts is that of the whole
+                        i = m4(t, v, start, stop, buckets)
+                        parts.append((t[i], v[i]))
+        if not parts:
+            return (np.empty(0, np.int64),
+                    np.empty(0, _value_dtypes[self.type]))
+        t = np.concatenate([p[0] for p in parts])
+        v = np.concatenate([p[1] for p in parts])
+        i = m4(t, v, start, stop, buckets)
+        t, v = t[i], v[i]
+        if mode == "lttb":
+            i = lttb(t, v, width)
+            t, v = t[i], v[i]
+        return t, v
+
+    def aggregate(self, bucket, start=None, stop=None):
+        # (time, min, max, mean, count) per time bucket, newest first
+        # buckets that are multiples of aggregate_stamp are served from
+        # the rollups up to aggregated() (edges are then rounded to
+        # aggregate_stamp) and the raw values after, other buckets only
+        # see the raw rows of chunk storage variables
+        stamp = self.aggregate_stamp
+        split = None
+        if stamp and bucket % stamp == 0:
+            split = self.rollup_split(bucket, start)
+        if split is None:
+            t = self.value_table
+            b = (t.time - t.time % bucket).label("time")
+            v = object_session(self).query(b, func.min(t.value),
+                    func.max(t.value), func.avg(t.value),
+                    func.count(t.value)).filter(t.variable_id == self.id)
+            if start is not None:
+                v = v.filter(t.time >= start)
+            if stop is not None:
+                v = v.filter(t.time < stop)
+            return v.group_by(b).order_by(desc(b))
+        if stop is not None:
+            split = min(split, stop)
+        a = AggregateValue.__table__
+        rolled = select([a.c.time, a.c.minimum, a.c.maximum,
+                (a.c.mean*a.c.count).label("total"), a.c.count]).where(
+                (a.c.variable_id == self.id) & (a.c.stamp == stamp) &
+                (a.c.time < split))
+        if start is not None:
+            rolled = rolled.where(a.c.time >= start)
+        t = self.value_table.__table__
+        raw = select([t.c.time, t.c.value.label("minimum"),
+                t.c.value.label("maximum"), cast(t.c.value, Float),
+                literal(1)]).where((t.c.variable_id == self.id) &
+                (t.c.time >= split))
+        if stop is not None:
+            raw = raw.where(t.c.time < stop)
+        u = union_all(rolled, raw).alias()
+        b = (u.c.time - u.c.time % bucket).label("time")
+        v = object_session(self).query(b, func.min(u.c.minimum),
+                func.max(u.c.maximum),
+                func.sum(u.c.total)/func.sum(u.c.count),
+                func.sum(u.c.count))
+        return v.group_by(b).order_by(desc(b))
+
+    def aggregated(self):
+        # end of the rolled up time range
+        t = AggregateValue
+        v = object_session(self).query(func.max(t.time)).filter(
+                t.variable_id == self.id,
+                t.stamp == self.aggregate_stamp).scalar()
+        if v is not None:
+            return v + self.aggregate_stamp
+
+    def rollup(self, now=None):
+        # roll up raw values older than aggregate_age, resuming after the
+        # last rolled up bucket, buckets that late values were written
+        # into are rolled up again
+        if now is None:
+            now = int(pytime.time()*1e6)
+        stamp = self.aggregate_stamp
+        stop = now - self.aggregate_age
+        stop -= stop % stamp
+        start = self.aggregated()
+        n = 0
+        late, self.rollup_late = self.rollup_late, None
+        if late is not None and start is not None and late < start:
+            n += self.reroll(late, start)
+        if start is not None and start >= stop:
+            return n
+        r = object_session(self).execute(
+                AggregateValue.__table__.insert().from_select(["variable_id",
+                    "stamp", "time", "minimum", "maximum", "mean", "count"],
+                    self._rollup_query(start, stop)))
+        return n + r.rowcount
+
+    def _rollup_query(self, start, stop):
+        # (variable_id, stamp, bucket, min, max, mean, count) of the raw
+        # values in [start, stop)
+        stamp = self.aggregate_stamp
+        t = self.value_table
+        b = t.time - t.time % stamp
+        v = object_session(self).query(literal(self.id), literal(stamp), b,
+                func.min(t.value), func.max(t.value), func.avg(t.value),
+                func.count(t.value)).filter(t.variable_id == self.id,
+                t.time < stop)
+        if start is not None:
+            v = v.filter(t.time >= start)
+        return v.group_by(b).statement
+
+    def reroll(self, start, stop):
+        # delete and insert again the buckets of [start, stop): the late
+        # values before expire_stop (all that is left there) are merged
+        # into their buckets, the later buckets are computed anew
+        session = object_session(self)
+        stamp = self.aggregate_stamp
+        start -= start % stamp
+        a = AggregateValue.__table__
+        q = (a.c.variable_id == self.id) & (a.c.stamp == stamp)
+        split = min(max(start, self.expire_stop or start), stop)
+        params = []
+        n = 0
+        if start < split:
+            t = self.value_table
+            b = t.time - t.time % stamp
+            late = session.query(b, func.min(t.value), func.max(t.value),
+                    func.sum(t.value), func.count(t.value)).filter(
+                    t.variable_id == self.id, t.time >= start,
+                    t.time < split).group_by(b).all()
+            old = dict((r[0], r[1:]) for r in session.execute(select([
+                a.c.time, a.c.minimum, a.c.maximum, a.c.mean, a.c.count
+                ]).where(q & a.c.time.in_([r[0] for r in late]))))
+            for ti, lo, hi, total, count in late:
+                if ti in old:
+                    lo0, hi0, mean0, count0 = old[ti]
+                    lo, hi = min(lo, lo0), max(hi, hi0)
+                    total += mean0*count0
+                    count += count0
+                params.append({"variable_id": self.id, "stamp": stamp,
+                    "time": ti, "minimum": lo, "maximum": hi,
+                    "mean": total/count, "count": count})
+            session.execute(a.delete().where(q & a.c.time.in_(
+                [p["time"] for p in params])))
+        if split < stop:
+            session.execute(a.delete().where(q & (a.c.time >= split) &
+                (a.c.time < stop)))
+            if self.chunked:
+                # the packed values count as well
+                times, values = fetch(session, [self], split, stop)[self]
+                params.extend({"variable_id": self.id, "stamp": stamp,
+                    "time": ti, "minimum": lo, "maximum": hi,
+                    "mean": mean, "count": count}
+                    for ti, lo, hi, mean, count in zip(*(c.tolist() for c in
+                        aggregate_array(times, values, stamp))))
+            else:
+                n = session.execute(a.insert().from_select(["variable_id",
+                    "stamp", "time", "minimum", "maximum", "mean", "count"],
+                    self._rollup_query(split, stop))).rowcount
+        if params:
+            session.execute(a.insert(), params)
+        return n + len(params)
+
+    def unroll(self, start=None, stop=None):
+        # after the raw values in [start, stop) were deleted: drop the
+        # buckets inside where only the rollups are left (before
+        # expire_stop), compute the buckets after again
+        stamp = self.aggregate_stamp
+        end = self.aggregated() if stamp else None
+        if end is None:
+            return 0
+        lo = -2**63 if start is None else start
+        hi = end if stop is None else min(stop, end)
+        if lo >= hi:
+            return 0
+        split = min(max(lo, self.expire_stop or lo), hi)
+        n = 0
+        if lo < split:
+            a = AggregateValue.__table__
+            n += object_session(self).execute(a.delete().where(
+                (a.c.variable_id == self.id) & (a.c.stamp == stamp) &
+                (a.c.time >= lo) & (a.c.time + stamp <= hi) &
+                (a.c.time < split))).rowcount
+        if split < hi:
+            n += self.reroll(split, hi + (-hi) % stamp)
+        return n
+
+    def expire(self, now=None):
+        # delete raw values older than delete_age that have been rolled up
+        if now is None:
+            now = int(pytime.time()*1e6)
+        stop = now - self.delete_age
+        if self.aggregate_stamp and self.aggregate_age:
+            end = self.aggregated()
+            if end is None:
+                return 0
+            # whole buckets, see reroll()
+            stop = min(stop - stop % self.aggregate_stamp, end)
+            self.expire_stop = max(stop, self.expire_stop or stop)
+        t = self.value_table
+        n = object_session(self).execute(t.__table__.delete().where(
+            (t.variable_id == self.id) & (t.time < stop))).rowcount
+        if self.chunked:
+            # chunks straddling stop are kept whole
+            n += self.chunk_values.filter(ChunkValue.stop < stop).delete(
+                    synchronize_session=False)
+        if n and "value_cache" in object_session(self).info:
+            object_session(self).info["value_cache"].forget(self.id)
+        if n:
+            self.summary_values.filter(SummaryValue.time < stop).delete(
+                    synchronize_session=False)
+        return n
+
+    def pack(self, now=None, size=100000):
+        # move the raw values of completed (and rolled up, if configured)
+        # chunk spans into ChunkValues, size raw values at a time, the
+        # chunks of the spans that late values fall into are merged and
+        # rewritten
+        import numpy as np
+        if now is None:
+            now = int(pytime.time()*1e6)
+        stop = now - now % chunk_span
+        if self.aggregate_stamp and self.aggregate_age:
+            end = self.aggregated()
+            if end is None:
+                return 0
+            stop = min(stop, end - end % chunk_span)
+        session = object_session(self)
+        t = self.value_table.__table__
+        c = ChunkValue.__table__
+        raw = (t.c.variable_id == self.id) & (t.c.time < stop)
+        q = select([t.c.time, t.c.value]).order_by(t.c.time).limit(size)
+        n = 0
+        lo = -2**63
+        while True:
+            times, values = read_columns(session.execute(q.where(raw &
+                (t.c.time >= lo))), ["i8", _value_dtypes[self.type]], size)
+            if not len(times):
+                break
+            # the affected spans as ranges of consecutive ones
+            spans = np.unique(times - times % chunk_span)
+            edges = np.r_[0, np.flatnonzero(np.diff(spans) > chunk_span) +
+                    1, len(spans)]
+            old = (c.c.variable_id == self.id) & or_(*[
+                (c.c.time >= int(spans[i])) &
+                (c.c.time < int(spans[j - 1]) + chunk_span)
+                for i, j in zip(edges[:-1], edges[1:])])
+            parts = [decode_chunk(d, self.type) for d, in session.execute(
+                select([c.c.data]).where(old).order_by(c.c.time))]
+            session.execute(c.delete().where(old))
+            session.execute(t.delete().where(raw &
+                (t.c.time >= int(times[0])) & (t.c.time <= int(times[-1]))))
+            k, lo = len(times), int(times[-1]) + 1
+            times, values = merge_series(parts + [(times, values)])
+            spans = times - times % chunk_span
+            edges = np.r_[0, np.flatnonzero(np.diff(spans)) + 1, len(times)]
+            params = []
+            for i, j in zip(edges[:-1], edges[1:]):
+                for a in range(i, j, chunk_points):
+                    b = min(j, a + chunk_points)
+                    params.append({"variable_id": self.id,
+                        "time": int(times[a]), "stop": int(times[b - 1]),
+                        "count": int(b - a),
+                        "data": encode_chunk(times[a:b], values[a:b])})
+            session.execute(c.insert(), params)
+            n += k
+            if k < size:
+                break
+        return n
+
+    def unpack(self, start=None, stop=None):
+        # move the chunks overlapping [start, stop) back to raw rows
+        import numpy as np
+        session = object_session(self)
+        c = ChunkValue.__table__
+        q = c.c.variable_id == self.id
+        if start is not None:
+            q &= c.c.stop >= start
+        if stop is not None:
+            q &= c.c.time < stop
+        parts = [decode_chunk(d, self.type) for d, in session.execute(
+            select([c.c.data]).where(q).order_by(c.c.time))]
+        if not parts:
+            return 0
+        times, values = merge_series(parts)
+        # raw values win over packed ones at the same time
+        t = self.value_table.__table__
+        have = [r[0] for r in session.execute(select([t.c.time]).where(
+            (t.c.variable_id == self.id) & (t.c.time >= int(times[0])) &
+            (t.c.time <= int(times[-1]))))]
+        keep = ~np.isin(times, have)
+        session.execute(c.delete().where(q))
+        params = [{"variable_id": self.id, "time": ti, "value": vi}
+                for ti, vi in zip(times[keep].tolist(), values[keep].tolist())]
+        if params:
+            session.execute(t.insert(), params)
+        return len(params)
+
+    def invalidate(self, time=None, now=None):
+        # drop summaries of completed segments from time on (None: all),
+        # writes into the current segment need nothing, and remember
+        # writes old enough to have been rolled up for rollup()
+        if now is None:
+            now = int(pytime.time()*1e6)
+        if (time is not None and self.aggregate_stamp and
+                self.aggregate_age and time < now - self.aggregate_age and
+                (self.rollup_late is None or time < self.rollup_late)):
+            self.rollup_late = time
+        q = self.summary_values
+        if time is not None:
+            if time >= now - now % summary_segment:
+                return
+            q = q.filter(SummaryValue.time >=
+                    time - time % summary_segment)
+        q.delete(synchronize_session=False)
+
+    def summaries(self, start, stop):
+        # summaries of the segments in [start, stop), computing missing
+        # ones with one grouped query
+        S = summary_segment
+        have = dict((s.time, s) for s in self.summary_values.filter(
+            SummaryValue.time >= start, SummaryValue.time < stop))
+        missing = [i for i in range(start, stop, S) if i not in have]
+        if missing:
+            t = self.value_table
+            seg = t.time - t.time % S
+            q = (t.variable_id == self.id, t.time >= missing[0],
+                    t.time < missing[-1] + S)
+            ref = object_session(self).query(seg.label("time"),
+                    func.min(cast(t.value, Float)).label("value")).filter(
+                    *q).group_by(seg).subquery()
+            rows = dict((r[0], r[1:]) for r in object_session(self).query(
+                ref.c.time, ref.c.value, *_moments(t, ref.c.time,
+                    ref.c.value)).join(ref, ref.c.time == seg).filter(
+                    *q).group_by(ref.c.time, ref.c.value))
+            keys = ("value_ref", "count", "value_min", "value_max",
+                    "value_sum", "value_sum2", "time_min", "time_max",
+                    "time_sum", "time_sum2")
+            params = []
+            for i in missing:
+                p = dict(zip(keys, rows.get(i, (None, 0) + (None,)*8)))
+                p.update(variable_id=self.id, time=i)
+                params.append(p)
+            # concurrent requests may have stored the same summaries
+            object_session(self).execute(SummaryValue.__table__.insert(
+                ).prefix_with("OR IGNORE", dialect="sqlite").prefix_with(
+                "IGNORE", dialect="mysql"), params)
+            for p in params:
+                have[p["time"]] = SummaryValue(**p)
+        return [have[i] for i in range(start, stop, summary_segment)]
+
+    def statistics(self, start=None, stop=None, now=None):
+        # exact count/min/max/mean/std of time and value over [start,
+        # stop), completed segments are read from the summaries
+        if now is None:
+            now = int(pytime.time()*1e6)
+        session = object_session(self)
+        if self.chunked:
+            # scanning the chunks is cheap, no summaries
+            parts = []
+            for times, values in self.windows(start, stop):
+                ref = int(times[0])
+                v = values.astype(float)
+                dv = v - v.min()
+                dt = (times - ref).astype(float)
+                parts.append((ref, v.min().item(), len(v), v.min().item(),
+                    v.max().item(), dv.sum(), (dv*dv).sum(), ref,
+                    int(times[-1]), dt.sum(), (dt*dt).sum()))
+            if not parts:
+                return {"count": 0}
+            return combine_moments(parts, parts[0][0])
+        t = self.value_table
+        if start is None or stop is None:
+            lo, hi = session.query(func.min(t.time),
+                    func.max(t.time)).filter(t.variable_id == self.id).one()
+            if lo is None:
+                return {"count": 0}
+            if start is None:
+                start = lo
+            if stop is None:
+                stop = hi + 1
+        S = summary_segment
+        a = start + (-start) % S
+        b = min(stop, now)
+        b -= b % S
+        parts = []
+        edges = [(start, stop)]
+        if a < b:
+            parts.extend((s.time, s.value_ref, s.count, s.value_min,
+                s.value_max, s.value_sum, s.value_sum2, s.time_min,
+                s.time_max, s.time_sum, s.time_sum2)
+                for s in self.summaries(a, b))
+            edges = [(start, a), (b, stop)]
+        for i, j in edges:
+            if i < j:
+                # values relative to the first one
+                u = aliased(t)
+                ref = session.query(cast(u.value, Float)).filter(
+                        u.variable_id == self.id, u.time >= i,
+                        u.time < j).order_by(u.time).limit(1).as_scalar()
+                parts.append((i,) + tuple(session.query(ref,
+                    *_moments(t, i, ref)).filter(t.variable_id == self.id,
+                        t.time >= i, t.time < j).one()))
+        return combine_moments(parts, start)
+
+    def iterhistory(self, start=None, stop=None, resolution=None,
+            chunk=None):
+        # with chunk: ascending, constant memory, see iterchunks()
+        if chunk:
+            return (r for c in self.iterchunks(start, stop, chunk)
+                    for r in c)
+        if self.chunked:
+            split = self.rollup_split(resolution, start)
+            rolled = []
+            if split is not None:
+                split = split if stop is None else min(split, stop)
+                rolled = object_session(self).execute(self._rolled(start,
+                    split).order_by(desc("time")))
+                start = split
+            t, v = fetch(object_session(self), [self], start, stop)[self]
+            return itertools.chain(zip(t[::-1].tolist(), v[::-1].tolist()),
+                    (tuple(r) for r in rolled))
         return ((v.time, v.value) for v in
-                self.history(start, stop))
+                self.history(start, stop, resolution))
+
+    def iterchunks(self, start=None, stop=None, size=10000):
+        # lists of ascending (time, value) by keyset pagination on
+        # (variable_id, time), chunk storage a few chunks at a time
+        if self.chunked:
+            for t, v in self.windows(start, stop, size=size):
+                t, v = t.tolist(), v.tolist()
+                for i in range(0, len(t), size):
+                    yield list(zip(t[i:i + size], v[i:i + size]))
+            return
+        t = self.value_table.__table__
+        q = select([t.c.time, t.c.value]).where(
+                t.c.variable_id == self.id).order_by(
+                asc(t.c.time)).limit(size)
+        if stop is not None:
+            q = q.where(t.c.time < stop)
+        c = q
+        if start is not None:
+            c = q.where(t.c.time >= start)
+        while True:
+            rows = object_session(self).execute(c).fetchall()
+            if rows:
+                yield [tuple(r) for r in rows]
+            if len(rows) < size:
+                break
+            c = q.where(t.c.time > rows[-1][0])
+
+    def windows(self, start=None, stop=None, reverse=False, chunks=16,
+            size=100000):
+        # ascending (times, values) of a chunk storage variable over
+        # consecutive windows of [start, stop), oldest first (newest
+        # with reverse): chunks ChunkValues at a time by keyset on time
+        # merged with the raw values in their window, raw values beyond
+        # the chunks in pages of size
+        import numpy as np
+        session = object_session(self)
+        c = ChunkValue.__table__
+        t = self.value_table.__table__
+        dtypes = ["i8", _value_dtypes[self.type]]
+        lo = -2**63 if start is None else start
+        hi = 2**63 - 1 if stop is None else stop
+        q = select([c.c.time, c.c.stop, c.c.data]).where(
+                c.c.variable_id == self.id).limit(chunks)
+        while lo < hi:
+            if reverse:
+                page = session.execute(q.where((c.c.time < hi) &
+                    (c.c.stop >= lo)).order_by(desc(c.c.time))).fetchall()
+                a, b = max(lo, page[-1][0]) if page else lo, hi
+                page = page[::-1]
+            else:
+                page = session.execute(q.where((c.c.time < hi) &
+                    (c.c.stop >= lo)).order_by(asc(c.c.time))).fetchall()
+                a, b = lo, min(hi, page[-1][1] + 1) if page else hi
+            if not page:
+                # raw values only
+                if reverse:
+                    times, values = read_columns(execute(session,
+                        recent_statement(self.value_table), id=self.id,
+                        start=a, stop=b, limit=size, offset=0), dtypes,
+                        size)
+                    times, values = times[::-1], values[::-1]
+                else:
+                    times, values = read_columns(session.execute(select(
+                        [t.c.time, t.c.value]).where((t.c.variable_id ==
+                            self.id) & (t.c.time >= a) & (t.c.time < b)
+                        ).order_by(asc(t.c.time)).limit(size)), dtypes,
+                        size)
+                if not len(times):
+                    return
+                yield times, values
+                if len(times) < size:
+                    return
+                if reverse:
+                    hi = int(times[0])
+                else:
+                    lo = int(times[-1]) + 1
+                continue
+            raw = read_columns(execute(session,
+                range_statement(self.value_table), id=self.id, start=a,
+                stop=b), dtypes)
+            times, values = merge_series([decode_chunk(d, self.type)
+                for ti, si, d in page] + [raw])
+            i, j = np.searchsorted(times, [a, b])
+            if i < j:
+                yield times[i:j], values[i:j]
+            if reverse:
+                hi = a
+            else:
+                lo = b
 
     @hybrid_property
     def current(self):
+        session = object_session(self)
+        if (session is not None and self.id is not None and
+                "value_cache" in session.info):
+            return session.info["value_cache"].get(self)
+        if self.chunked:
+            v = self.latest()
+            if v is not None:
+                return self.value_table(v[1], v[0])
+            return
         return self.last().first()
 
     @current.setter
@@ -216,9 +1030,45 @@ class Collection(Base):
             cascade="all, delete-orphan", passive_deletes=True,
             backref="collection")
 
+    def closure(self):
+        # ids of this and all (transitively) right collections
+        session = object_session(self)
+        if session.new or session.dirty or session.deleted:
+            session.flush()
+        cc = CollectionCollection.__table__
+        tree = select([literal(self.id).label("id")]).cte("tree",
+                recursive=True)
+        return tree.union(select([cc.c.right_id]).where(
+            cc.c.left_id == tree.c.id))
+
     def variables(self):
-        return list(self.primary_variables) + sum((c.variables()
-            for c in self.right_collections), [])
+        if object_session(self) is None:
+            v = list(self.primary_variables)
+            for c in self.right_collections:
+                v.extend(c.variables())
+            return v
+        cv = CollectionVariable.__table__
+        tree = self.closure()
+        return object_session(self).query(Variable).join(cv,
+                cv.c.variable_id == Variable.id).filter(
+                cv.c.collection_id.in_(select([tree.c.id]))).distinct(
+                ).all()
+
+    def variable_ids(self):
+        session = object_session(self)
+        cache = session.info.get("closure_cache")
+        if cache is not None and self.id in cache.ids:
+            return cache.ids[self.id]
+        if cache is not None:
+            generation = cache.generation
+        cv = CollectionVariable.__table__
+        tree = self.closure()
+        ids = frozenset(r[0] for r in session.execute(select(
+            [cv.c.variable_id]).where(cv.c.collection_id.in_(
+                select([tree.c.id])))))
+        if cache is not None and generation == cache.generation:
+            cache.ids[self.id] = ids
+        return ids
 
     def get(self, name, create=False, add=False):
         v = object_session(self).query(Variable).filter(
@@ -228,25 +1078,766 @@ class Collection(Base):
                 return
             v = Variable(name=name)
             self.primary_variables.append(v)
-        if not v in self.variables():
+            return v
+        if not v.id in self.variable_ids():
             if not add:
                 return
             self.primary_variables.append(v)
         return v
 
-    def update_from_recarray(self, data, time_column="time"):
+    def history(self, start=None, stop=None):
+        # {name: (times, values)} of all variables, one query per table
+        return dict((v.name, tv) for v, tv in fetch(object_session(self),
+            self.variables(), start, stop).items())
+
+    def update_from_recarray(self, data, time_column="time", chunk=10000):
         # time must be utc localized or utc naive
-        time = data.field(time_column).astype("datetime64[us]")
-        time = time.astype(float)/1e6
-        time = map(datetime.datetime.fromtimestamp, time)
+        time = to_us(data.field(time_column))
+        tables = {}
         for name in data.dtype.names:
             if name == time_column:
                 continue
-            v = self.get(name, create=True)
-            v.update_series(data.field(name), time)
+            v = self.get(name, create=True, add=True)
+            tables.setdefault(v.value_table, []).append(
+                    (v, data.field(name)))
+        object_session(self).flush()
+        for table, columns in tables.items():
+            insert_columns(object_session(self), table, columns, time,
+                    chunk)
 
     @classmethod
-    def from_recarray(cls, data, time_column="time", **kwargs):
+    def from_recarray(cls, data, time_column="time", session=None,
+            chunk=10000, **kwargs):
         obj = cls(**kwargs)
-        obj.update_from_recarray(data, time_column=time_column)
+        if session is not None:
+            session.add(obj)
+        obj.update_from_recarray(data, time_column=time_column, chunk=chunk)
         return obj
+
+
+class Deadband(object):
+    # drops values within value_precision (log_value_precision for
+    # logarithmic variables) of the last stored value unless time_gap
+    # has passed since it, kept per variable id in memory
+    def __init__(self):
+        self.last = {}
+        self.stored = 0
+        self.dropped = 0
+
+    def accept(self, var, time, value):
+        last = self.last.get(var.id)
+        if last is not None and time < last[0]:
+            # backfill, always stored, does not move the reference
+            self.stored += 1
+            return True
+        if (last is not None and
+                (not var.time_gap or time - last[0] < var.time_gap) and
+                self.within(var, last[1], value)):
+            self.dropped += 1
+            return False
+        self.last[var.id] = time, value
+        self.stored += 1
+        return True
+
+    @staticmethod
+    def within(var, a, b):
+        try:
+            if var.logarithmic and var.log_value_precision:
+                if a <= 0 or b <= 0:
+                    return False
+                return (abs(math.log10(b) - math.log10(a)) <=
+                        var.log_value_precision)
+            if var.value_precision:
+                return abs(b - a) <= var.value_precision
+        except TypeError:
+            pass
+        return False
+
+    def forget(self, id=None):
+        if id is None:
+            self.last.clear()
+        else:
+            self.last.pop(id, None)
+
+    def stats(self):
+        n = self.stored + self.dropped
+        return {"stored": self.stored, "dropped": self.dropped,
+                "ratio": n/self.stored if self.stored else 1.}
+
+
+class ValueCache(object):
+    # last (time, value) per variable id, written through by the ingest
+    # paths, read on Variable.current; a miss is only stored if no write
+    # to the variable was made or committed while it was read
+    def __init__(self):
+        self.values = {}
+        self.reading = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, var):
+        try:
+            v = self.values[var.id]
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            token = object()
+            with self.lock:
+                self.reading[var.id] = token
+            v = var.latest()
+            with self.lock:
+                if self.reading.get(var.id) is token:
+                    del self.reading[var.id]
+                    self.values[var.id] = v
+        if v is not None:
+            return var.value_table(v[1], v[0])
+
+    def put(self, id, time, value):
+        # unknown ids stay unknown: the stored value may be newer
+        with self.lock:
+            self.reading.pop(id, None)
+            if id in self.values:
+                v = self.values[id]
+                if v is None or time >= v[0]:
+                    self.values[id] = time, value
+
+    def committed(self, id):
+        # reads of id in progress may have missed the write
+        with self.lock:
+            self.reading.pop(id, None)
+
+    def forget(self, id=None):
+        with self.lock:
+            if id is None:
+                self.values.clear()
+                self.reading.clear()
+            else:
+                self.values.pop(id, None)
+                self.reading.pop(id, None)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self.values)}
+
+
+class ClosureCache(object):
+    # Collection.variable_ids() per collection id, cleared whenever
+    # collection membership may have changed
+    def __init__(self):
+        self.ids = {}
+        self.generation = 0
+
+    def forget(self):
+        self.generation += 1
+        self.ids = {}
+
+
+class NameCache(object):
+    # detached Variables by name, merged into sessions without a query,
+    # all forgotten whenever a variable is created, changed or deleted
+    def __init__(self):
+        self.variables = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session, name):
+        d = self.variables.get(name)
+        if d is not None:
+            self.hits += 1
+            v = session.identity_map.get(
+                    Variable.__mapper__.identity_key_from_primary_key([d.id]))
+            if v is not None:
+                return v
+            return session.merge(d, load=False)
+        self.misses += 1
+        generation = self.generation
+        v = _by_name(session).params(name=name).first()
+        if v is None or v in session.dirty:
+            return v
+        d = Variable.__mapper__.class_manager.new_instance()
+        for p in Variable.__mapper__.column_attrs:
+            set_committed_value(d, p.key, getattr(v, p.key))
+        make_transient_to_detached(d)
+        if generation == self.generation:
+            self.variables[name] = d
+        return v
+
+    def forget(self):
+        self.generation += 1
+        self.variables = {}
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self.variables)}
+
+
+@event.listens_for(Session, "after_flush")
+def _forget_names(session, context):
+    cache = session.info.get("name_cache")
+    if cache is None:
+        return
+    for o in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(o, Variable) and (o in session.new or
+                o in session.deleted or
+                session.is_modified(o, include_collections=False)):
+            cache.forget()
+            session.info["name_cache_changed"] = True
+            return
+
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def _forget_names_bulk(context):
+    cache = context.session.info.get("name_cache")
+    if cache is not None and context.mapper.class_ is Variable:
+        cache.forget()
+        context.session.info["name_cache_changed"] = True
+
+
+def _uncommitted(session, id):
+    # ids whose deadband reference or cached value moved ahead of the
+    # database
+    session.info.setdefault("uncommitted", set()).add(id)
+
+
+@event.listens_for(Session, "after_commit")
+def _committed(session):
+    ids = session.info.pop("uncommitted", None)
+    cache = session.info.get("value_cache")
+    if ids and cache is not None:
+        for i in ids:
+            cache.committed(i)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _forget_uncommitted(session, transaction):
+    # rolled back or closed without commit
+    if transaction.parent is not None:
+        return
+    ids = session.info.pop("uncommitted", None)
+    for k in "deadband", "value_cache":
+        cache = session.info.get(k)
+        if ids and cache is not None:
+            for i in ids:
+                cache.forget(i)
+
+
+@event.listens_for(Session, "after_flush")
+def _forget_closures(session, context):
+    cache = session.info.get("closure_cache")
+    if cache is None:
+        return
+    for o in itertools.chain(session.new, session.dirty, session.deleted):
+        if (isinstance(o, (Collection, CollectionVariable,
+                CollectionCollection)) or
+                (isinstance(o, Variable) and o in session.deleted)):
+            cache.forget()
+            session.info["closure_cache_changed"] = True
+            return
+
+
+@event.listens_for(Session, "after_bulk_delete")
+def _forget_closures_bulk(context):
+    cache = context.session.info.get("closure_cache")
+    if cache is not None and context.mapper.class_ in (Collection,
+            Variable):
+        cache.forget()
+        context.session.info["closure_cache_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_changed(session, *args):
+    # other sessions may have cached the old rows between the flush and
+    # the end of the transaction, and this one its uncommitted ones
+    for k in "name_cache", "closure_cache":
+        if session.info.pop(k + "_changed", False):
+            session.info[k].forget()
+
+
+def combine_moments(parts, ref):
+    # merge (ref, value_ref, count, value_min, value_max, value_sum,
+    # value_sum2, time_min, time_max, time_sum, time_sum2) partial sums,
+    # values relative to the first value_ref
+    n = vs = vs2 = ts = ts2 = 0.
+    vmin = vmax = tmin = tmax = vref = None
+    for (r, pvref, pn, pvmin, pvmax, pvs, pvs2, ptmin, ptmax, pts,
+            pts2) in parts:
+        if not pn:
+            continue
+        if vref is None:
+            vref = pvref
+        o = float(r - ref)
+        p = pvref - vref
+        n += pn
+        vs += pvs + pn*p
+        vs2 += pvs2 + 2*p*pvs + pn*p*p
+        ts += pts + pn*o
+        ts2 += pts2 + 2*o*pts + pn*o*o
+        vmin = pvmin if vmin is None else min(vmin, pvmin)
+        vmax = pvmax if vmax is None else max(vmax, pvmax)
+        tmin = ptmin if tmin is None else min(tmin, ptmin)
+        tmax = ptmax if tmax is None else max(tmax, ptmax)
+    if not n:
+        return {"count": 0}
+    vm, tm = vs/n, ts/n
+    return {
+            "count": int(n),
+            "time_min": tmin,
+            "time_max": tmax,
+            "time_mean": ref + tm,
+            "time_std": math.sqrt(max(0., ts2/n - tm*tm)),
+            "value_min": vmin,
+            "value_max": vmax,
+            "value_mean": vref + vm,
+            "value_std": math.sqrt(max(0., vs2/n - vm*vm)),
+    }
+
+
+def to_us(times):
+    # datetime64 or integer microseconds to int64 microseconds
+    import numpy as np
+    times = np.asarray(times)
+    if times.dtype.kind == "M":
+        times = times.astype("datetime64[us]")
+    return times.astype(np.int64)
+
+
+def insert_columns(session, table, columns, times, chunk=10000):
+    # columns: (variable, values) sharing times, chunk rows per insert
+    import numpy as np
+    if not columns:
+        return 0
+    deadband = session.info.get("deadband")
+    cache = session.info.get("value_cache")
+    step = max(1, chunk//len(columns))
+    n = 0
+    for i in range(0, len(times), step):
+        t = times[i:i + step].tolist()
+        params = []
+        for var, values in columns:
+            v = np.asarray(values[i:i + step]).tolist()
+            rows = zip(t, v)
+            if deadband is not None:
+                rows = [(ti, vi) for ti, vi in rows
+                        if deadband.accept(var, ti, vi)]
+                _uncommitted(session, var.id)
+            else:
+                rows = list(rows)
+            if rows:
+                if cache is not None:
+                    cache.put(var.id, *max(rows, key=lambda r: r[0]))
+                    _uncommitted(session, var.id)
+                var.invalidate(min(rows)[0])
+            params.extend({"variable_id": var.id, "time": ti, "value": vi}
+                    for ti, vi in rows)
+        if params:
+            session.execute(table.__table__.insert(), params)
+        n += len(params)
+    return n
+
+
+def aggregate_array(times, values, bucket):
+    # numpy equivalent of Variable.aggregate() for ascending times
+    import numpy as np
+    if not len(times):
+        return times, values, values, values, times
+    b = times - times % bucket
+    i = np.r_[0, np.flatnonzero(np.diff(b)) + 1]
+    n = np.diff(np.r_[i, len(b)])
+    return (b[i], np.minimum.reduceat(values, i),
+            np.maximum.reduceat(values, i), np.add.reduceat(values, i)/n, n)
+
+
+def m4(times, values, start, stop, width):
+    # indices of the first, last, minimum and maximum value in each of
+    # width equal buckets of [start, stop), ascending times (M4)
+    import numpy as np
+    if not len(times):
+        return np.empty(0, np.intp)
+    step = max(1, -(-(stop - start)//width))
+    b = (times - start)//step
+    i = np.r_[0, np.flatnonzero(np.diff(b)) + 1]
+    n = np.diff(np.r_[i, len(b)])
+    keep = [i, i + n - 1]
+    for f in np.fmin, np.fmax:
+        k = np.flatnonzero(values == np.repeat(f.reduceat(values, i), n))
+        keep.append(k[np.r_[True, b[k][1:] != b[k][:-1]]])
+    return np.unique(np.concatenate(keep))
+
+
+def lttb(times, values, n):
+    # indices of n points by largest triangle three buckets
+    import numpy as np
+    m = len(times)
+    if n >= m or n < 3:
+        return np.arange(m)
+    x = (times - times[0]).astype(np.float64)
+    y = values.astype(np.float64)
+    edges = (np.arange(n - 1)*((m - 2)/(n - 2))).astype(np.intp) + 1
+    edges[-1] = m - 1
+    counts = np.diff(edges)
+    # centroids of the following bucket, the last point for the last one
+    cx = np.r_[np.add.reduceat(x[:-1], edges[:-1])[1:]/counts[1:], x[-1]]
+    cy = np.r_[np.add.reduceat(y[:-1], edges[:-1])[1:]/counts[1:], y[-1]]
+    keep = np.empty(n, np.intp)
+    keep[0], keep[-1] = 0, m - 1
+    a = 0
+    for k in range(n - 2):
+        j, l = edges[k], edges[k + 1]
+        area = np.abs((x[a] - cx[k])*(y[j:l] - y[a]) -
+                (x[a] - x[j:l])*(cy[k] - y[a]))
+        a = keep[k + 1] = j + np.argmax(area)
+    return keep
+
+
+def encode_chunk(times, values):
+    # delta-of-delta times and xor-ed (float) or delta (int) values as
+    # little endian 64 bit words, byte shuffled and deflated
+    import numpy as np
+    t = np.asarray(times, "<i8")
+    dd = np.diff(np.diff(t, prepend=0), prepend=0)
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        u = values.astype("<f8").view("<u8")
+        x = u ^ np.r_[np.uint64(0), u[:-1]].astype("<u8")
+    else:
+        x = np.diff(values.astype("<i8"), prepend=0).view("<u8")
+    w = np.concatenate([dd.view("<u8"), x]).view(np.uint8)
+    return zlib.compress(w.reshape(-1, 8).T.tobytes())
+
+
+def decode_chunk(data, type="float"):
+    # (int64 times, float64 or int64 values) from encode_chunk()
+    import numpy as np
+    w = np.frombuffer(zlib.decompress(data), np.uint8)
+    w = np.ascontiguousarray(w.reshape(8, -1).T).view("<u8").ravel()
+    dd, x = w[:len(w)//2], w[len(w)//2:]
+    times = np.cumsum(np.cumsum(dd.view("<i8"))).astype(np.int64)
+    if type == "float":
+        values = np.bitwise_xor.accumulate(x).view("<f8")
+    else:
+        values = np.cumsum(x.view("<i8"))
+    return times, values.astype(_value_dtypes[type])
+
+
+def merge_series(parts):
+    # ascending union of (times, values), later parts win on equal times
+    import numpy as np
+    times = np.concatenate([t for t, v in parts])
+    values = np.concatenate([v for t, v in parts])
+    i = np.argsort(times, kind="mergesort")
+    times, values = times[i], values[i]
+    last = np.r_[times[1:] != times[:-1], True]
+    return times[last], values[last]
+
+
+def compact(session, now=None):
+    # roll up, pack and expire all variables, the caller commits
+    if now is None:
+        now = int(pytime.time()*1e6)
+    rolled = deleted = 0
+    for v in session.query(Variable).filter(Variable.type.in_(
+            ("float", "int")), Variable.aggregate_stamp != None,
+            Variable.aggregate_age != None):
+        rolled += v.rollup(now)
+    for v in session.query(Variable).filter(Variable.storage == "chunk",
+            Variable.type.in_(("float", "int"))):
+        v.pack(now)
+    for v in session.query(Variable).filter(Variable.delete_age != None):
+        deleted += v.expire(now)
+    return rolled, deleted
+
+
+_value_dtypes = {"float": "f8", "int": "i8", "bool": "?"}
+
+
+def fetch(session, variables, start=None, stop=None):
+    # {variable: (times, values)} ascending, one query per value table,
+    # chunk storage variables merged with their decoded chunks
+    import numpy as np
+    tables = {}
+    for v in variables:
+        tables.setdefault(v.value_table, []).append(v)
+    series = {}
+    for table, vs in tables.items():
+        t = table.__table__
+        q = select([t.c.variable_id, t.c.time, t.c.value]).where(
+                t.c.variable_id.in_([v.id for v in vs])).order_by(
+                t.c.variable_id, t.c.time)
+        if start is not None:
+            q = q.where(t.c.time >= start)
+        if stop is not None:
+            q = q.where(t.c.time < stop)
+        ids, times, values = read_columns(session.execute(q),
+                ["i8", "i8", _value_dtypes.get(vs[0].type, object)])
+        for v in vs:
+            i, j = np.searchsorted(ids, [v.id, v.id + 1])
+            series[v] = times[i:j], values[i:j]
+    chunked = dict((v.id, v) for v in variables if v.chunked)
+    if chunked:
+        c = ChunkValue.__table__
+        q = select([c.c.variable_id, c.c.data]).where(
+                c.c.variable_id.in_(list(chunked))).order_by(
+                c.c.variable_id, c.c.time)
+        if start is not None:
+            q = q.where(c.c.stop >= start)
+        if stop is not None:
+            q = q.where(c.c.time < stop)
+        parts = {}
+        for id, data in session.execute(q):
+            parts.setdefault(id, []).append(decode_chunk(data,
+                chunked[id].type))
+        for id, p in parts.items():
+            v = chunked[id]
+            times, values = merge_series(p + [series[v]])
+            i, j = 0, len(times)
+            if start is not None:
+                i = np.searchsorted(times, start)
+            if stop is not None:
+                j = np.searchsorted(times, stop)
+            series[v] = times[i:j], values[i:j]
+    return series
+
+
+def align(series, method="previous", grid=None):
+    # resample [(times, values)] onto grid (default: union of all times)
+    # with previous/nearest/linear, nan outside the data
+    import numpy as np
+    if grid is None:
+        grid = np.unique(np.concatenate([t for t, v in series] or [[]]))
+    grid = np.asarray(grid, np.int64)
+    columns = []
+    for t, v in series:
+        v = np.asarray(v, np.float64)
+        if not len(t):
+            columns.append(np.full(grid.shape, np.nan))
+            continue
+        if method == "linear":
+            columns.append(np.interp(grid, t, v, np.nan, np.nan))
+            continue
+        i = np.searchsorted(t, grid, "right") - 1
+        if method == "nearest":
+            j = np.minimum(i + 1, len(t) - 1)
+            i = np.where((i < 0) | ((t[j] - grid) < (grid - t[i])), j, i)
+        elif method != "previous":
+            raise ValueError(method)
+        c = v[np.maximum(i, 0)]
+        c[i < 0] = np.nan
+        columns.append(c)
+    return grid, columns
+
+
+def connect(database, sqlite_profile=True, pool_size=None, **kwargs):
+    # pool_size: pooled, checked connections for that many concurrent
+    # requests, else the default pool of the backend
+    from sqlalchemy import create_engine
+    from sqlalchemy.engine.url import make_url
+    from sqlalchemy.pool import QueuePool, StaticPool
+    url = make_url(database)
+    sqlite = url.get_backend_name() == "sqlite"
+    if pool_size and sqlite:
+        connect_args = kwargs.setdefault("connect_args", {})
+        connect_args.setdefault("check_same_thread", False)
+        if url.database in (None, "", ":memory:"):
+            # one shared in-memory database
+            kwargs.setdefault("poolclass", StaticPool)
+        else:
+            # WAL: readers proceed, writers wait for the write lock
+            connect_args.setdefault("timeout", 30)
+            kwargs.setdefault("poolclass", QueuePool)
+            kwargs.setdefault("pool_size", pool_size)
+            kwargs.setdefault("max_overflow", pool_size)
+    elif pool_size:
+        kwargs.setdefault("pool_size", pool_size)
+        kwargs.setdefault("max_overflow", pool_size)
+        kwargs.setdefault("pool_timeout", 30)
+        # drop connections the server closed (MySQL wait_timeout)
+        kwargs.setdefault("pool_pre_ping", True)
+        kwargs.setdefault("pool_recycle", 3600)
+    engine = create_engine(database, **kwargs)
+    if sqlite_profile and sqlite:
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            c = dbapi_connection.cursor()
+            for k, v in sqlite_pragmas:
+                c.execute("PRAGMA {} = {}".format(k, v))
+            c.close()
+    return engine
+
+
+def create_schema(engine):
+    # the missing tables, and the missing (nullable) columns of tables
+    # created by an older version: create_all() does not alter them
+    from sqlalchemy import inspect
+    from sqlalchemy.schema import CreateColumn
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.format_table
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            have = set(c["name"] for c in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in have:
+                    continue
+                conn.execute("ALTER TABLE {} ADD COLUMN {}".format(
+                    quote(table), CreateColumn(column).compile(
+                        dialect=engine.dialect)))
+
+
+def _by_name(session):
+    if isinstance(session, scoped_session):
+        session = session()
+    q = bakery(lambda s: s.query(Variable))
+    q += lambda q: q.filter(Variable.name == bindparam("name"))
+    return q(session)
+
+
+def lookup(session, name):
+    # the Variable called name or None
+    cache = session.info.get("name_cache")
+    if cache is not None:
+        return cache.get(session, name)
+    return _by_name(session).params(name=name).first()
+
+
+def resolve(session, names):
+    names = set(names)
+    if not names:
+        return {}
+    cache = session.info.get("name_cache")
+    if cache is not None and len(names) <= 16:
+        variables = dict((n, cache.get(session, n)) for n in names)
+        return dict((n, v) for n, v in variables.items() if v is not None)
+    return dict((v.name, v) for v in session.query(Variable).filter(
+        Variable.name.in_(names)))
+
+
+def recent_statement(table):
+    # newest first (time, value) of variable :id in [:start, :stop)
+    s = _statements.get(("recent", table))
+    if s is None:
+        t = table.__table__
+        s = select([t.c.time, t.c.value]).where(
+                (t.c.variable_id == bindparam("id")) &
+                (t.c.time >= bindparam("start")) &
+                (t.c.time < bindparam("stop"))).order_by(
+                desc(t.c.time)).limit(bindparam("limit")).offset(
+                bindparam("offset"))
+        _statements[("recent", table)] = s
+    return s
+
+
+def range_statement(table):
+    # ascending (time, value) of variable :id in [:start, :stop)
+    s = _statements.get(("range", table))
+    if s is None:
+        t = table.__table__
+        s = select([t.c.time, t.c.value]).where(
+                (t.c.variable_id == bindparam("id")) &
+                (t.c.time >= bindparam("start")) &
+                (t.c.time < bindparam("stop"))).order_by(asc(t.c.time))
+        _statements[("range", table)] = s
+    return s
+
+
+def read_columns(result, dtypes, size=10000):
+    # the columns of a Core result as arrays of dtypes, fetched in
+    # batches of size rows straight from the DBAPI cursor into arrays
+    # grown by doubling
+    import numpy as np
+    columns = [np.empty(size, d) for d in dtypes]
+    n = 0
+    try:
+        cursor = result.cursor
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            m = n + len(rows)
+            if m > len(columns[0]):
+                k = max(m, 2*len(columns[0]))
+                for c in columns:
+                    c.resize(k, refcheck=False)
+            for c, r in zip(columns, zip(*rows)):
+                c[n:m] = r
+            n = m
+    finally:
+        result.close()
+    for c in columns:
+        c.resize(n, refcheck=False)
+    return columns
+
+
+def iter_columns(result, dtypes, size=10000):
+    # the columns of a Core result as arrays of dtypes, one list of
+    # columns per batch of up to size rows
+    import numpy as np
+    try:
+        cursor = result.cursor
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            yield [np.array(c, d) for c, d in zip(zip(*rows), dtypes)]
+    finally:
+        result.close()
+
+
+def execute(session, statement, **params):
+    # statements from _statements are compiled once per dialect
+    return session.connection().execution_options(
+            compiled_cache=_compiled_cache).execute(statement, params)
+
+
+def insert_values(session, rows, stored=None):
+    # rows: (variable, time, value), one executemany per value table,
+    # (variable_id, time, value) passing the deadband go to stored, the
+    # first value at a (variable, time) is kept
+    now = int(pytime.time()*1e6)
+    deadband = session.info.get("deadband")
+    cache = session.info.get("value_cache")
+    tables = {}
+    oldest = {}
+    seen = set()
+    for var, time, value in rows:
+        if var.id is None:
+            session.flush()
+        if time is None:
+            time = now
+        if (var.id, time) in seen:
+            continue
+        seen.add((var.id, time))
+        if deadband is not None:
+            if not deadband.accept(var, time, value):
+                continue
+            _uncommitted(session, var.id)
+        if cache is not None:
+            cache.put(var.id, time, value)
+            _uncommitted(session, var.id)
+        if stored is not None:
+            stored.append((var.id, time, value))
+        if time < oldest.get(var, now):
+            oldest[var] = time
+        tables.setdefault(var.value_table, []).append(
+                {"variable_id": var.id, "time": time, "value": value})
+    for var, time in oldest.items():
+        var.invalidate(time, now)
+    n = 0
+    for table, params in tables.items():
+        session.execute(insert_statement(table), params)
+        n += len(params)
+    return n
+
+
+def insert_statement(table):
+    # insert of values that skips (variable_id, time) already stored so
+    # that clients can retry writes that were committed
+    s = _statements.get(("insert", table))
+    if s is None:
+        s = table.__table__.insert().prefix_with("OR IGNORE",
+                dialect="sqlite").prefix_with("IGNORE", dialect="mysql")
+        _statements[("insert", table)] = s
+    return s
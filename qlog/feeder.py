@@ -0,0 +1,373 @@
+from __future__ import (absolute_import, print_function,
+                unicode_literals, division)
+
+# Polls many line-oriented (telnet) instruments concurrently and posts
+# their readings in batches to /1/update over one keep-alive session.
+# Batches that cannot be posted (connection errors, 5xx) go to a local
+# buffer file and are replayed in order once the server is back, batches
+# the server rejects (4xx) are logged and dropped, as is a buffered batch
+# that failed retries times while later ones went out. Python 3 (asyncio).
+#
+# Configuration (ini), one section per device:
+#
+#   [feeder]
+#   url = http://localhost:5000/1
+#   batch = 500
+#   deadline = 1
+#   buffer = /var/lib/qlog/feeder.buffer
+#   retries = 3
+#
+#   [igc100]
+#   host = 10.0.0.7
+#   port = 23
+#   interval = 5
+#   command = GDAT? 1
+#   variable = igc100_pressure
+#   timeout = 10
+
+import json
+import time
+import asyncio
+import logging
+import os
+
+
+logger = logging.getLogger("qlog")
+
+
+class Device(object):
+    # one instrument: command, answer terminated by "\r", float value
+    def __init__(self, name, host, port, interval, command="GDAT? 1",
+            variable=None, timeout=10.):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.command = command
+        self.variable = variable or name
+        self.timeout = timeout
+        self.reader = self.writer = None
+        self.readings = 0
+        self.errors = 0
+
+    async def read(self):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                    self.host, self.port)
+        self.writer.write(self.command.encode() + b"\r\n")
+        await self.writer.drain()
+        line = await self.reader.readuntil(b"\r")
+        return float(line.strip())
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def poll(self, queue):
+        # at a fixed rate, a slow or failing device only delays itself
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        k = 0
+        try:
+            while True:
+                read = asyncio.ensure_future(self.read())
+                try:
+                    await asyncio.wait([read], timeout=self.timeout)
+                finally:
+                    read.cancel()
+                try:
+                    if not read.done():
+                        raise asyncio.TimeoutError("no answer")
+                    value = read.result()
+                except (OSError, EOFError, ValueError,
+                        asyncio.IncompleteReadError,
+                        asyncio.TimeoutError) as e:
+                    self.errors += 1
+                    logger.warning("%s: %r", self.name, e)
+                    self.close()
+                else:
+                    self.readings += 1
+                    queue.put_nowait((self.variable, int(time.time()*1e6),
+                        value))
+                k = max(k + 1, int((loop.time() - start)/self.interval))
+                await asyncio.sleep(max(0, start + k*self.interval -
+                    loop.time()))
+        finally:
+            self.close()
+
+
+class Buffer(object):
+    # rows that could not be posted, one json list per batch and line
+    def __init__(self, path):
+        self.path = path
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            return sum(len(json.loads(l)) for l in f if l.strip())
+
+    def append(self, rows):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(rows) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def batches(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(l) for l in f if l.strip()]
+
+    def rewrite(self, batches):
+        with open(self.path + ".tmp", "w") as f:
+            for rows in batches:
+                f.write(json.dumps(rows) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.path + ".tmp", self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class Rejected(Exception):
+    # the server refused the batch, posting it again will not help
+    pass
+
+
+class Poster(object):
+    # keep-alive, pooled http session posting [[name, time, value], ...]
+    def __init__(self, url, timeout=10.):
+        import requests
+        self.url = url.rstrip("/") + "/update"
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=2))
+        self.session.mount("https://", requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=2))
+
+    def __call__(self, rows):
+        r = self.session.post(self.url, json=rows, timeout=self.timeout)
+        if 400 <= r.status_code < 500 and r.status_code not in (408, 429):
+            raise Rejected(r.status_code, r.text)
+        r.raise_for_status()
+        return r.json()["count"]
+
+
+class Feeder(object):
+    # polls devices and posts their readings: a batch goes out when batch
+    # rows are pending or deadline seconds after the oldest one arrived,
+    # post(rows) is blocking and runs in an executor thread
+    def __init__(self, devices, post, buffer=None, batch=500, deadline=1.,
+            retries=3):
+        self.devices = devices
+        self.post = post
+        self.buffer = buffer
+        self.batch = batch
+        self.deadline = deadline
+        self.retries = retries
+        # failed replays of the oldest buffered batch while others went out
+        self.stuck = 0
+        self.posts = 0
+        self.posted = 0
+        self.buffered = 0
+        self.failures = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    async def run(self):
+        # until stop(), then posts (or buffers) what is pending
+        self.queue = asyncio.Queue()
+        polls = [asyncio.ensure_future(d.poll(self.queue))
+                for d in self.devices]
+        try:
+            stopping = False
+            while not stopping:
+                rows, stopping = await self.collect()
+                if rows:
+                    await self.send(rows)
+        finally:
+            for p in polls:
+                p.cancel()
+            await asyncio.gather(*polls, return_exceptions=True)
+        rows = []
+        while not self.queue.empty():
+            r = self.queue.get_nowait()
+            if r is not None:
+                rows.append(r)
+        if rows:
+            await self.send(rows)
+
+    def stop(self):
+        self.queue.put_nowait(None)
+
+    async def collect(self):
+        # (rows, stopping)
+        rows = [await self.queue.get()]
+        loop = asyncio.get_event_loop()
+        end = loop.time() + self.deadline
+        while len(rows) < self.batch and rows[-1] is not None:
+            if not self.queue.empty():
+                rows.append(self.queue.get_nowait())
+                continue
+            # not wait_for(): it can drop an item racing the timeout
+            get = asyncio.ensure_future(self.queue.get())
+            await asyncio.wait([get], timeout=max(0, end - loop.time()))
+            if not get.done():
+                get.cancel()
+                break
+            rows.append(get.result())
+        if rows[-1] is None:
+            return rows[:-1], True
+        return rows, False
+
+    async def send(self, rows):
+        rows = [list(r) for r in rows]
+        if self.buffer is not None and self.buffered:
+            if not await self.replay():
+                # the server may be up and fail only the oldest batch
+                if await self.send_now(rows):
+                    self.skip()
+                else:
+                    self.keep(rows)
+                return
+        if not await self.send_now(rows):
+            self.keep(rows)
+
+    async def send_now(self, rows):
+        # False if the rows should be posted again later
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self.post, rows)
+        except Rejected as e:
+            self.reject(rows, e)
+        except Exception as e:
+            self.failures += 1
+            logger.warning("post failed: %r", e)
+            return False
+        else:
+            self.posts += 1
+            self.posted += len(rows)
+        return True
+
+    def skip(self):
+        # drop the oldest buffered batch once it failed retries times
+        # while later batches went out
+        self.stuck += 1
+        if self.stuck < self.retries:
+            return
+        batches = self.buffer.batches()
+        logger.error("dropped %i rows failing %i times", len(batches[0]),
+                self.stuck)
+        self.dropped += len(batches[0])
+        self.buffer.rewrite(batches[1:])
+        self.buffered -= len(batches[0])
+        self.stuck = 0
+
+    def reject(self, rows, e):
+        logger.error("dropped %i rejected rows: %s", len(rows), e)
+        self.rejected += len(rows)
+
+    def keep(self, rows):
+        if self.buffer is None:
+            logger.error("dropped %i rows", len(rows))
+            return
+        self.buffer.append(rows)
+        self.buffered += len(rows)
+
+    async def replay(self):
+        # the buffered batches in order, True if all went out
+        loop = asyncio.get_event_loop()
+        batches = self.buffer.batches()
+        for i, rows in enumerate(batches):
+            try:
+                await loop.run_in_executor(None, self.post, rows)
+            except Rejected as e:
+                self.reject(rows, e)
+                continue
+            except Exception as e:
+                self.failures += 1
+                logger.warning("replay failed: %r", e)
+                # keep what is left
+                self.buffer.rewrite(batches[i:])
+                self.buffered = sum(len(b) for b in batches[i:])
+                return False
+            self.posts += 1
+            self.posted += len(rows)
+            self.stuck = 0
+        self.buffer.clear()
+        self.buffered = 0
+        return True
+
+    def stats(self):
+        return {"posts": self.posts, "posted": self.posted,
+                "buffered": self.buffered, "failures": self.failures,
+                "rejected": self.rejected, "dropped": self.dropped,
+                "devices": dict((d.name, {"readings": d.readings,
+                    "errors": d.errors}) for d in self.devices)}
+
+
+def from_config(path, post=None):
+    from configparser import ConfigParser
+    c = ConfigParser()
+    c.read(path)
+    devices = []
+    for s in c.sections():
+        if s == "feeder":
+            continue
+        devices.append(Device(s, c.get(s, "host"), c.getint(s, "port"),
+            c.getfloat(s, "interval"),
+            c.get(s, "command") if c.has_option(s, "command")
+            else "GDAT? 1",
+            c.get(s, "variable") if c.has_option(s, "variable") else s,
+            c.getfloat(s, "timeout") if c.has_option(s, "timeout")
+            else 10.))
+    f = "feeder"
+    if post is None:
+        post = Poster(c.get(f, "url"))
+    buffer = None
+    if c.has_option(f, "buffer"):
+        buffer = Buffer(c.get(f, "buffer"))
+    feeder = Feeder(devices, post, buffer,
+            c.getint(f, "batch") if c.has_option(f, "batch") else 500,
+            c.getfloat(f, "deadline") if c.has_option(f, "deadline")
+            else 1.,
+            c.getint(f, "retries") if c.has_option(f, "retries") else 3)
+    # replay what an earlier run left
+    if buffer is not None:
+        feeder.buffered = len(buffer)
+    return feeder
+
+
+async def serve(feeder):
+    import signal
+    loop = asyncio.get_event_loop()
+    task = asyncio.ensure_future(feeder.run())
+    for sig in signal.SIGINT, signal.SIGTERM:
+        loop.add_signal_handler(sig, feeder.stop)
+    await task
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", action="count", default=0)
+    parser.add_argument("-q", "--quiet", action="count", default=0)
+    parser.add_argument("config")
+    args = parser.parse_args()
+
+    level = [logging.CRITICAL, logging.ERROR, logging.WARN, logging.INFO,
+            logging.DEBUG][args.verbose - args.quiet + 2]
+    logging.basicConfig(level=level)
+
+    feeder = from_config(args.config)
+    asyncio.run(serve(feeder))
+    logger.info("%s", feeder.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+from __future__ import (absolute_import, print_function,
+                unicode_literals, division)
+
+# High rate ingest next to the REST API: TCP streams and UDP datagrams of
+# text lines "name value [time]\n" (time in us, default now) and/or
+# binary frames MAGIC, <HI name length and record count, the name and
+# count packed record_dtype (time, value) records as served by /1/data.
+# Names map to variable ids through a local index and the rows go to the
+# write-behind Writer; unknown names are counted and dropped. Frames of
+# more than max_records records and lines longer than max_line are
+# malformed and close the connection.
+
+import time
+import socket
+import struct
+import logging
+import itertools
+import threading
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import numpy as np
+
+from . import db
+
+
+logger = logging.getLogger("qlog")
+
+
+MAGIC = b"QLB1"
+header = struct.Struct(str("<4sHI"))
+record_size = np.dtype(db.record_dtype).itemsize
+max_records = 1 << 20
+max_line = 1 << 16
+
+
+def parse(data, now):
+    # ([(name, time, value)], unparsed tail or None if the stream can
+    # not continue, malformed lines and frames)
+    rows = []
+    errors = 0
+    i, n = 0, len(data)
+    while i < n:
+        if data.startswith(MAGIC, i):
+            if n - i < header.size:
+                break
+            magic, k, count = header.unpack_from(data, i)
+            if count > max_records:
+                return rows, None, errors + 1
+            j = i + header.size + k + count*record_size
+            if j > n:
+                break
+            try:
+                name = data[i + header.size:i + header.size + k].decode()
+            except UnicodeDecodeError:
+                errors += 1
+                i = j
+                continue
+            r = np.frombuffer(data, db.record_dtype, count,
+                    i + header.size + k)
+            rows.extend(zip(itertools.repeat(name, count),
+                r["time"].tolist(), r["value"].tolist()))
+            i = j
+            continue
+        j = data.find(b"\n", i)
+        if j < 0:
+            if n - i > max_line:
+                return rows, None, errors + 1
+            break
+        f = data[i:j].split()
+        i = j + 1
+        if not f:
+            continue
+        try:
+            rows.append((f[0].decode(), int(f[2]) if len(f) > 2 else now,
+                float(f[1])))
+        except (ValueError, IndexError, UnicodeDecodeError):
+            errors += 1
+    return rows, data[i:], errors
+
+
+def needed(data):
+    # length of the frame data begins with, 0 if unknown or not a frame
+    if data.startswith(MAGIC) and len(data) >= header.size:
+        magic, k, count = header.unpack_from(data)
+        if count <= max_records:
+            return header.size + k + count*record_size
+    return 0
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class UDPServer(socketserver.UDPServer):
+    max_packet_size = 1 << 16
+
+    def server_bind(self):
+        # absorb bursts while a handler waits for the writer queue
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 23)
+        socketserver.UDPServer.server_bind(self)
+
+
+class Listener(object):
+    def __init__(self, app, host="0.0.0.0", port=6882, udp=True):
+        self.writer = app.writer
+        self.session_factory = app.db_session.session_factory
+        self.name_cache = app.name_cache
+        self.index = {}
+        self.generation = None
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.received = 0
+        self.unknown = 0
+        self.malformed = 0
+        self.dropped = 0
+
+        listener = self
+
+        class Stream(socketserver.StreamRequestHandler):
+            def handle(self):
+                # a large frame is parsed once it is complete
+                data = bytearray()
+                need = 0
+                while not listener.stopped:
+                    chunk = self.request.recv(1 << 16)
+                    if not chunk:
+                        break
+                    data += chunk
+                    if len(data) < need:
+                        continue
+                    rows, data, errors = parse(data, int(time.time()*1e6))
+                    listener.feed(rows, errors, block=True)
+                    if data is None:
+                        break
+                    need = needed(data)
+
+        class Datagram(socketserver.BaseRequestHandler):
+            def handle(self):
+                data = self.request[0]
+                if not data.endswith(b"\n") and not data.startswith(MAGIC):
+                    data += b"\n"
+                rows, tail, errors = parse(data, int(time.time()*1e6))
+                listener.feed(rows, errors + bool(tail), block=False)
+
+        self.tcp = TCPServer((host, port), Stream)
+        self.address = self.tcp.server_address
+        self.udp = None
+        if udp:
+            self.udp = UDPServer(self.address, Datagram)
+        self.threads = [threading.Thread(target=s.serve_forever,
+            name="listener") for s in (self.tcp, self.udp) if s]
+        for t in self.threads:
+            t.daemon = True
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+        logger.info("ingest on %s:%i", *self.address)
+
+    def stop(self):
+        self.stopped = True
+        for s in self.tcp, self.udp:
+            if s is not None:
+                s.shutdown()
+                s.server_close()
+
+    def ids(self, names):
+        # {name: variable id or None}, misses resolved in one query,
+        # all forgotten when the NameCache is
+        with self.lock:
+            if self.generation != self.name_cache.generation:
+                self.generation = self.name_cache.generation
+                self.index = {}
+            missing = [n for n in names if n not in self.index]
+            if missing:
+                session = self.session_factory()
+                try:
+                    variables = db.resolve(session, missing)
+                    for n in missing:
+                        v = variables.get(n)
+                        self.index[n] = None if v is None else v.id
+                finally:
+                    session.close()
+            return self.index
+
+    def feed(self, rows, errors=0, block=True):
+        # to the writer, TCP waits (back pressure), UDP drops on overflow
+        self.malformed += errors
+        if not rows:
+            return
+        ids = self.ids(set(r[0] for r in rows))
+        n = len(rows)
+        rows = [(ids[k], t, x) for k, t, x in rows if ids[k] is not None]
+        self.unknown += n - len(rows)
+        # in pieces the writer queue can take
+        size = self.writer.size
+        for i in range(0, len(rows), size):
+            piece = rows[i:i + size]
+            while not self.writer.put(piece):
+                if not block or self.stopped:
+                    self.dropped += len(rows) - i
+                    return
+                time.sleep(.01)
+            self.received += len(piece)
+
+    def stats(self):
+        return {"address": "%s:%i" % self.address[:2],
+                "received": self.received, "unknown": self.unknown,
+                "malformed": self.malformed, "dropped": self.dropped}
+
+
+def frame(name, times, values):
+    # a binary frame of (time, value) records for name
+    name = name.encode()
+    r = np.empty(len(times), db.record_dtype)
+    r["time"], r["value"] = times, values
+    return header.pack(MAGIC, len(name), len(r)) + name + r.tobytes()
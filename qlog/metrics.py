@@ -0,0 +1,188 @@
+from __future__ import (absolute_import, print_function,
+                unicode_literals, division)
+
+# Per endpoint request instrumentation for the API server: latency
+# histograms, SQL statement counts and time (engine events), rows read
+# and written and serialization time, plus optional cProfile dumps of
+# slow requests.
+
+import os
+import time
+import random
+import logging
+import threading
+import cProfile
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+
+logger = logging.getLogger("qlog")
+
+
+class Histogram(object):
+    # counts in buckets by upper bound, default 100 us * 2**i
+    def __init__(self, bounds=None):
+        if bounds is None:
+            bounds = [1e-4*2**i for i in range(18)]
+        self.bounds = bounds
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, x):
+        i = 0
+        while i < len(self.bounds) and x > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += x
+        self.max = max(self.max, x)
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q quantile
+        n = q*self.count
+        c = 0
+        for b, k in zip(self.bounds, self.counts):
+            c += k
+            if c >= n:
+                return b
+        return self.max
+
+    def stats(self):
+        return {"count": self.count, "sum": self.sum, "max": self.max,
+                "mean": self.sum/self.count if self.count else 0.,
+                "p50": self.quantile(.5), "p90": self.quantile(.9),
+                "p99": self.quantile(.99),
+                "buckets": dict(("{:g}".format(b), k) for b, k in zip(
+                    self.bounds + [float("inf")], self.counts) if k)}
+
+
+_counters = "sql_count", "sql_time", "rows_read", "rows_written", "serialize"
+
+
+class Metrics(object):
+    # totals and histograms per endpoint, SQL outside of requests
+    # (writer, compactor) is accounted to "background"
+    def __init__(self, profile_dir=None, profile_slow=1., profile_rate=.1):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.background = dict.fromkeys(_counters[:2] + ("rows_written",),
+                0)
+        self.profile_dir = profile_dir
+        self.profile_slow = profile_slow
+        self.profile_rate = profile_rate
+        self.profiling = threading.Lock()
+        self.profiles = 0
+
+    def start(self):
+        g.metrics = dict.fromkeys(_counters, 0)
+        g.metrics_start = time.time()
+        g.profile = None
+        if (self.profile_dir and random.random() < self.profile_rate and
+                self.profiling.acquire(False)):
+            # one profiled request at a time
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+
+    def finish(self, response):
+        m = getattr(g, "metrics", None)
+        if m is None:
+            return response
+        dt = time.time() - g.metrics_start
+        name = request.endpoint or "unknown"
+        p = self.stop_profile()
+        if p is not None and dt >= self.profile_slow:
+            self.dump(p, name, dt)
+        with self.lock:
+            e = self.endpoints.get(name)
+            if e is None:
+                e = self.endpoints[name] = {"latency": Histogram(),
+                        "statements": Histogram([2**i for i in range(11)]),
+                        "errors": 0}
+                e.update(dict.fromkeys(_counters, 0))
+            e["latency"].observe(dt)
+            e["statements"].observe(m["sql_count"])
+            if response.status_code >= 500:
+                e["errors"] += 1
+            for k in _counters:
+                e[k] += m[k]
+        g.metrics = None
+        return response
+
+    def stop_profile(self, exc=None):
+        p = getattr(g, "profile", None)
+        if p is not None:
+            p.disable()
+            self.profiling.release()
+            g.profile = None
+            return p
+
+    def dump(self, profile, name, dt):
+        path = os.path.join(self.profile_dir, "{}-{:.0f}ms-{}.prof".format(
+            name, dt*1e3, int(time.time()*1e6)))
+        profile.dump_stats(path)
+        self.profiles += 1
+        logger.info("slow request profile in %s", path)
+
+    def add(self, key, n):
+        # to the current request or the background totals
+        if has_request_context() and getattr(g, "metrics", None):
+            g.metrics[key] += n
+        else:
+            with self.lock:
+                self.background[key] = self.background.get(key, 0) + n
+
+    def timer(self, key):
+        return _Timer(self, key)
+
+    def stats(self):
+        with self.lock:
+            d = {}
+            for name, e in self.endpoints.items():
+                n = e["latency"].count
+                d[name] = {"requests": n, "errors": e["errors"],
+                        "latency": e["latency"].stats(),
+                        "statements": e["statements"].stats()}
+                d[name].update((k, e[k]) for k in _counters)
+            return {"endpoints": d, "background": dict(self.background),
+                    "profile": {"dir": self.profile_dir,
+                        "slow": self.profile_slow, "rate": self.profile_rate,
+                        "dumped": self.profiles}}
+
+
+class _Timer(object):
+    def __init__(self, metrics, key):
+        self.metrics = metrics
+        self.key = key
+
+    def __enter__(self):
+        self.t0 = time.time()
+
+    def __exit__(self, *exc):
+        self.metrics.add(self.key, time.time() - self.t0)
+
+
+def install(app, engine, metrics):
+    # request hooks and engine events
+    app.before_request(metrics.start)
+    app.after_request(metrics.finish)
+    # unhandled exceptions skip after_request
+    app.teardown_request(metrics.stop_profile)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_start", []).append(time.time())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        dt = time.time() - conn.info["metrics_start"].pop()
+        metrics.add("sql_count", 1)
+        metrics.add("sql_time", dt)
+        if (context is not None and cursor.rowcount > 0 and
+                (context.isinsert or context.isupdate or context.isdelete)):
+            metrics.add("rows_written", cursor.rowcount)
+
+    app.metrics = metrics
+    return metrics
@@ -0,0 +1,144 @@
+from __future__ import (absolute_import, print_function,
+                unicode_literals, division)
+
+# Monthly RANGE partitions of the value tables on MySQL. Range queries
+# on (variable_id, time) are pruned to the overlapping partitions by the
+# server and retention drops whole partitions. Other backends keep
+# single tables and expire() falls back to deleting rows.
+
+import time as pytime
+import calendar
+import datetime
+import logging
+
+from sqlalchemy import text
+
+from . import db
+
+
+logger = logging.getLogger("qlog")
+
+
+def value_tables():
+    return [t.__table__ for t in (db.FloatValue, db.IntegerValue,
+        db.BooleanValue, db.TextValue, db.BinaryValue)]
+
+
+def month(time, offset=0):
+    # start of the month containing time, plus offset months, in us
+    d = datetime.datetime.utcfromtimestamp(time//10**6)
+    m = d.year*12 + d.month - 1 + offset
+    return calendar.timegm((m//12, m % 12 + 1, 1, 0, 0, 0))*10**6
+
+
+def name(time):
+    return "p" + datetime.datetime.utcfromtimestamp(
+            time//10**6).strftime("%Y%m")
+
+
+def existing(conn, table):
+    # [(name, upper bound or None for MAXVALUE)], empty if unpartitioned
+    rows = conn.execute(text("SELECT PARTITION_NAME, PARTITION_DESCRIPTION "
+        "FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() "
+        "AND TABLE_NAME = :table ORDER BY PARTITION_ORDINAL_POSITION"),
+        table=table.name).fetchall()
+    return [(n, None if d == "MAXVALUE" else int(d))
+            for n, d in rows if n is not None]
+
+
+def foreign_keys(conn, table):
+    return [r[0] for r in conn.execute(text("SELECT CONSTRAINT_NAME "
+        "FROM information_schema.REFERENTIAL_CONSTRAINTS "
+        "WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = :table"),
+        table=table.name)]
+
+
+def create_ddl(table, parts, upto, now):
+    # statements adding monthly partitions until upto
+    if not parts:
+        # everything up to the end of this month goes into the first one
+        bound = month(now, 1)
+        defs = ["PARTITION {} VALUES LESS THAN ({})".format(name(now),
+            bound)]
+        while bound < upto:
+            defs.append("PARTITION {} VALUES LESS THAN ({})".format(
+                name(bound), month(bound, 1)))
+            bound = month(bound, 1)
+        defs.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+        return ["ALTER TABLE {} PARTITION BY RANGE (time) ({})".format(
+            table.name, ", ".join(defs))]
+    bound = max(b for n, b in parts if b is not None)
+    defs = []
+    while bound < upto:
+        defs.append("PARTITION {} VALUES LESS THAN ({})".format(
+            name(bound), month(bound, 1)))
+        bound = month(bound, 1)
+    if not defs:
+        return []
+    defs.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return ["ALTER TABLE {} REORGANIZE PARTITION pmax INTO ({})".format(
+        table.name, ", ".join(defs))]
+
+
+def expired(parts, before):
+    # names of the partitions entirely older than before
+    return [n for n, b in parts if b is not None and b <= before]
+
+
+def ensure(engine, ahead=2, now=None):
+    # partitions for this and the next ahead months
+    if engine.dialect.name != "mysql":
+        return
+    if now is None:
+        now = int(pytime.time()*1e6)
+    with engine.connect() as conn:
+        for table in value_tables():
+            parts = existing(conn, table)
+            if not parts:
+                # InnoDB does not partition tables with foreign keys,
+                # values of deleted variables are then deleted explicitly
+                for fk in foreign_keys(conn, table):
+                    conn.execute("ALTER TABLE {} DROP FOREIGN KEY {}".format(
+                        table.name, fk))
+            for ddl in create_ddl(table, parts, month(now, ahead + 1), now):
+                logger.info(ddl)
+                conn.execute(ddl)
+
+
+def expire(engine, before):
+    # drop (or delete where partitioning is unavailable) all values older
+    # than before, returns the number of dropped partitions or rows,
+    # summaries reaching back before it and older chunks are deleted and
+    # Variable.expire_stop moves up so that reroll() keeps the rollups
+    n = 0
+    upto = None
+    with engine.connect() as conn:
+        s = db.SummaryValue.__table__
+        conn.execute(s.delete().where(s.c.time < before))
+        c = db.ChunkValue.__table__
+        conn.execute(c.delete().where(c.c.stop < before))
+        for table in value_tables():
+            if engine.dialect.name != "mysql":
+                n += conn.execute(table.delete().where(
+                    table.c.time < before)).rowcount
+                upto = before
+                continue
+            parts = existing(conn, table)
+            names = expired(parts, before)
+            if names:
+                ddl = "ALTER TABLE {} DROP PARTITION {}".format(table.name,
+                        ", ".join(names))
+                logger.info(ddl)
+                conn.execute(ddl)
+                n += len(names)
+                bound = max(b for p, b in parts if p in names)
+                upto = bound if upto is None else min(upto, bound)
+        if upto is not None:
+            # the bucket straddling upto is rolled up again from what is
+            # left of it
+            v = db.Variable.__table__
+            stop = upto - upto % v.c.aggregate_stamp
+            conn.execute(v.update().where((v.c.aggregate_stamp > 0) & (
+                (v.c.expire_stop == None) | (v.c.expire_stop < stop))
+                ).values(expire_stop=stop))
+    return n
@@ -2,18 +2,57 @@ from __future__ import (absolute_import, print_function,
                 unicode_literals, division)
 
 import time
+import json
 import numpy as np
-import pandas as pd
 import requests
 from bokeh import plotting
 from bokeh.objects import ColumnDataSource
 
+from .db import record_dtype
+
+
+class Ring(object):
+    # the last n (time, value) in preallocated arrays
+    def __init__(self, n):
+        self.t = np.zeros(n, np.int64)
+        self.y = np.zeros(n, np.float64)
+        self.count = 0
+
+    def extend(self, t, y):
+        n = len(self.t)
+        t, y = t[-n:], y[-n:]
+        i = (self.count + np.arange(len(t))) % n
+        self.t[i] = t
+        self.y[i] = y
+        self.count += len(t)
+
+    @property
+    def last(self):
+        if self.count:
+            return int(self.t[(self.count - 1) % len(self.t)])
+
+    def view(self):
+        # ascending copies
+        n = len(self.t)
+        if self.count <= n:
+            return self.t[:self.count].copy(), self.y[:self.count].copy()
+        i = self.count % n
+        return np.r_[self.t[i:], self.t[:i]], np.r_[self.y[i:], self.y[:i]]
+
 
 class QlogPlot:
-    def __init__(self, base, name, limit, ds):
+    def __init__(self, base, name, limit, ds, width=None, start=None):
+        # width: start with the M4 decimated range since start (us)
+        # instead of the limit newest values
         self.name = name
+        self.ring = Ring(limit + 4*(width or 0))
+        self.created = int(time.time()*1e6)
         self.var = requests.get("%s/variable/%s" % (base, name)).json()[name]
         self.url = "%s/data/%s?limit=%i" % (base, name, limit)
+        if width:
+            self.url = "%s/data/%s?width=%i" % (base, name, width)
+            if start is not None:
+                self.url += "&start=%i" % start
         ds.add([], "%s value" % name)
         ds.add([], "%s time" % name)
         self.update(ds)
@@ -31,26 +70,110 @@ class QlogPlot:
                 legend="%s (%s)" % (self.name, unit), title="")
 
     def update(self, ds):
-        df = pd.read_json(self.url)
-        y = np.array(df)
+        r = requests.get(self.url,
+                headers={"Accept": "application/octet-stream"})
+        r.raise_for_status()
+        l = np.frombuffer(r.content, record_dtype)
+        self.extend(l["time"], l["value"])
+        self.set(ds)
+
+    def extend(self, t, y):
+        # new points only, ascending
+        last = self.ring.last
+        if last is not None:
+            i = np.searchsorted(t, last, "right")
+            t, y = t[i:], y[i:]
         if self.var["logarithmic"]:
             y = np.log10(y)
+        self.ring.extend(t, y)
+        return len(t)
+
+    @property
+    def cursor(self):
+        # time of the newest point, the creation time while there is none
+        last = self.ring.last
+        return self.created if last is None else last
+
+    def set(self, ds):
+        t, y = self.ring.view()
         ds.data["%s value" % self.name] = y
-        ds.data["%s time" % self.name] = df.index
+        ds.data["%s time" % self.name] = t/1e3 # ms for bokeh
+
+
+def cursors(plots):
+    # {cursor: [plot]}
+    groups = {}
+    for plot in plots:
+        groups.setdefault(plot.cursor, []).append(plot)
+    return groups
 
 
-def simple_line_plot(base, names, limit, interval):
+def add(plots, d):
+    # {name: {"time": [...], "value": [...]}} into the plots
+    n = 0
+    for plot in plots:
+        if plot.name in d:
+            n += plot.extend(np.array(d[plot.name]["time"], np.int64),
+                    np.array(d[plot.name]["value"], np.float64))
+    return n
+
+
+def update_plots(base, plots, ds):
+    # one request per cursor for the points after it, variables that
+    # stall do not hold back the others
+    n = 0
+    for since, group in cursors(plots).items():
+        r = requests.get("%s/query" % base, params={
+            "names": ",".join(plot.name for plot in group),
+            "since": since})
+        r.raise_for_status()
+        n += add(group, r.json())
+    if n:
+        for plot in plots:
+            plot.set(ds)
+        return True
+
+
+def stream_plots(base, plots, ds, interval):
+    # server-sent events, redrawn at most every interval, yields after
+    # each redraw, reconnects from the cursor when the stream ends
+    while True:
+        # one stream from the oldest cursor, add() skips what is known
+        params = {"names": ",".join(plot.name for plot in plots),
+                "since": min(plot.cursor for plot in plots)}
+        r = requests.get("%s/stream" % base, params=params, stream=True)
+        r.raise_for_status()
+        drawn = time.time()
+        n = 0
+        for line in r.iter_lines():
+            if line.startswith(b"data: "):
+                n += add(plots, json.loads(line[6:].decode()))
+            if n and time.time() - drawn >= interval:
+                for plot in plots:
+                    plot.set(ds)
+                drawn = time.time()
+                n = 0
+                yield
+
+
+def simple_line_plot(base, names, limit, interval, push=False, width=None,
+        start=None):
     plotting.output_server("QLog")
     plotting.hold()
     plotting.figure()
     ds = ColumnDataSource(data={})
-    plots = [QlogPlot(base, name, limit, ds) for name in names]
+    plots = [QlogPlot(base, name, limit, ds, width, start)
+            for name in names]
     plotting.show()
 
-    while True:
-        time.sleep(interval)
-        for plot in plots:
-            plot.update(ds)
+    def poll():
+        while True:
+            time.sleep(interval)
+            if update_plots(base, plots, ds):
+                yield
+
+    updates = stream_plots(base, plots, ds, interval) if push else poll()
+    for _ in updates:
         ds._dirty = True
         plotting.session().store_obj(ds)
 
@@ -62,11 +185,20 @@ def main():
             default="http://localhost:6881/1")
     parser.add_argument("-l", "--limit", type=int, default=100)
     parser.add_argument("-i", "--interval", type=float, default=5)
+    parser.add_argument("-s", "--stream", action="store_true",
+            help="push new values instead of polling")
+    parser.add_argument("-w", "--width", type=int,
+            help="start with the range decimated to this many pixels")
+    parser.add_argument("-d", "--days", type=float,
+            help="range for --width (default: all)")
     parser.add_argument("names", nargs="+")
     args = parser.parse_args()
 
+    start = None
+    if args.days:
+        start = int((time.time() - args.days*86400)*1e6)
     simple_line_plot(args.base, args.names, args.limit,
-            args.interval)
+            args.interval, push=args.stream, width=args.width, start=start)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,45 @@
+from __future__ import (absolute_import, print_function,
+                unicode_literals, division)
+
+# production serving: gevent WSGI server with a bounded greenlet pool
+# and a matching engine pool, run as "python -m qlog.serve"
+
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from sqlalchemy.engine.url import make_url
+
+from .api import arguments, app_from_arguments
+
+
+logger = logging.getLogger("qlog")
+
+
+def main():
+    parser = arguments()
+    parser.add_argument("-n", "--concurrency", default=64, type=int,
+            help="concurrent requests (greenlets)")
+    parser.add_argument("-k", "--pool-size", default=8, type=int,
+            help="database connections, as many again on overflow")
+    args = parser.parse_args()
+    if make_url(args.database).get_backend_name() == "sqlite":
+        # single writer: ingest goes through the write-behind queue,
+        # sqlite calls do not yield to other greenlets anyway
+        args.write_behind = True
+    app = app_from_arguments(args, pool_size=args.pool_size)
+    server = WSGIServer((args.listen, args.port), app,
+            spawn=Pool(args.concurrency), log=None)
+    logger.info("serving on %s:%i", args.listen, args.port)
+    try:
+        server.serve_forever()
+    finally:
+        if app.writer is not None:
+            app.writer.stop()
+
+
+if __name__ == "__main__":
+    main()
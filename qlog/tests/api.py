@@ -0,0 +1,414 @@
+import unittest
+
+import io
+import os
+import json
+import tempfile
+import threading
+import shutil
+
+import numpy as np
+from qlog import db
+from qlog.api import create_app
+from qlog.listener import frame
+
+
+def reject(session, value):
+    # make the database fail inserts of value
+    session.execute("CREATE TRIGGER reject BEFORE INSERT ON floatvalue "
+            "WHEN NEW.value = {} BEGIN SELECT RAISE(ABORT, 'rejected'); "
+            "END".format(value))
+    session.commit()
+
+
+class ApiCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("sqlite://")
+        self.session = self.app.db_session
+        for name in "va", "vb":
+            self.session.add(db.Variable(name))
+        self.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.session.remove()
+
+    def values(self, name):
+        v = self.session.query(db.Variable).filter(
+                db.Variable.name == name).one()
+        return sorted(v.iterhistory())
+
+    def post_json(self, url, data):
+        return self.client.post(url, data=json.dumps(data),
+                content_type="application/json")
+
+    def test_update_form(self):
+        r = self.client.post("/1/update", data={"va": 1, "vb": 2})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([v for t, v in self.values("va")], [1])
+        self.assertEqual([v for t, v in self.values("vb")], [2])
+
+    def test_update_json(self):
+        r = self.post_json("/1/update", [["va", 10, 1.], ["vb", 11, 2.],
+            ["va", 12, 3.]])
+        self.assertEqual(json.loads(r.data), {"count": 3})
+        self.assertEqual(self.values("va"), [(10, 1.), (12, 3.)])
+        self.assertEqual(self.values("vb"), [(11, 2.)])
+
+    def test_update_repeated(self):
+        # retried after a timeout, and repeated within a request
+        for i in range(2):
+            r = self.post_json("/1/update", [["va", 10, 1.], ["va", 12, 3.],
+                ["va", 10, 2.]])
+            self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.values("va"), [(10, 1.), (12, 3.)])
+
+    def test_update_malformed(self):
+        for url, data in [("/1/update", {"va": 1.}),
+                ("/1/update", [["va", 1]]), ("/1/update", [[1, 2, 3.]]),
+                ("/1/data/va", {"1": 2.}), ("/1/data/va", [[1, 2., 3]]),
+                ("/1/data/va", [1, 2.])]:
+            self.assertEqual(self.post_json(url, data).status_code, 400)
+        r = self.client.post("/1/update", data=frame("va", [1], [2.])[:-1],
+                content_type="application/octet-stream")
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(self.values("va"), [])
+
+    def test_update_binary(self):
+        r = self.client.post("/1/update", data=frame("va", [10, 12],
+            [1., 3.]) + frame("vb", [11], [2.]),
+            content_type="application/octet-stream")
+        self.assertEqual(json.loads(r.data), {"count": 3})
+        self.assertEqual(self.values("va"), [(10, 1.), (12, 3.)])
+        self.assertEqual(self.values("vb"), [(11, 2.)])
+
+    def test_update_missing(self):
+        r = self.post_json("/1/update", [["va", 10, 1.], ["vc", 11, 2.]])
+        self.assertEqual(r.status_code, 404)
+        self.assertEqual(self.values("va"), [])
+
+    def test_data_binary(self):
+        l = np.zeros(3, db.record_dtype)
+        l["time"] = [1, 2, 3]
+        l["value"] = [4, 5, 6]
+        r = self.client.post("/1/data/va", data=l.tobytes(),
+                content_type="application/octet-stream")
+        self.assertEqual(json.loads(r.data), {"va": 3})
+        self.assertEqual(self.values("va"), [(1, 4.), (2, 5.), (3, 6.)])
+
+    def test_data_json(self):
+        self.post_json("/1/data/va", [[1, 4.], [2, 5.]])
+        self.assertEqual(self.values("va"), [(1, 4.), (2, 5.)])
+
+    def test_average(self):
+        self.post_json("/1/data/va", [[t, float(t)] for t in range(25)])
+        r = self.client.get("/1/data/va?average=10")
+        self.assertEqual(json.loads(r.data), {"va": {
+            "time": [20, 10, 0], "min": [20., 10., 0.],
+            "max": [24., 19., 9.], "mean": [22., 14.5, 4.5],
+            "count": [5, 10, 10]}})
+
+    def test_delete_rollups(self):
+        v = db.lookup(self.session, "va")
+        v.aggregate_stamp, v.aggregate_age, v.delete_age = 10, 5, 30
+        self.session.commit()
+        self.post_json("/1/data/va", [[t, float(t)] for t in range(60)])
+        db.compact(self.session, now=60)
+        self.session.commit()
+        self.client.delete("/1/data/va?start=5&stop=45")
+        r = json.loads(self.client.get("/1/data/va?average=10").data)
+        self.assertEqual(r["va"]["time"], [50, 40, 0])
+        self.assertEqual(r["va"]["count"], [10, 5, 10])
+
+    def test_value_cache(self):
+        self.client.post("/1/update", data={"va": 1})
+        r = json.loads(self.client.get("/1/variable/va").data)
+        self.assertEqual(r["va"]["current"]["value"], 1)
+        self.client.post("/1/update", data={"va": 2})
+        r = json.loads(self.client.get("/1/variable/va").data)
+        self.assertEqual(r["va"]["current"]["value"], 2)
+        self.assertEqual(self.app.value_cache.misses, 1)
+        self.client.delete("/1/data/va")
+        r = json.loads(self.client.get("/1/variable/va").data)
+        self.assertNotIn("current", r["va"])
+        self.assertEqual(self.app.value_cache.misses, 2)
+
+    def test_failed_write(self):
+        self.session.query(db.Variable).filter(db.Variable.name == "va"
+                ).one().value_precision = .5
+        reject(self.session, 13.)
+        self.post_json("/1/data/va", [[100, 1.]])
+        r = self.post_json("/1/data/va", [[200, 5.], [300, 13.]])
+        self.assertEqual(r.status_code, 500)
+        r = json.loads(self.client.get("/1/variable/va").data)
+        self.assertEqual(r["va"]["current"], {"time": 100, "value": 1.})
+        r = self.post_json("/1/data/va", [[200, 5.]])
+        self.assertEqual(json.loads(r.data), {"va": 1})
+        self.assertEqual(self.values("va"), [(100, 1.), (200, 5.)])
+
+    def test_delete_variable(self):
+        S = db.summary_segment
+        self.post_json("/1/data/vb", [[t*S//10, 1.] for t in range(30)])
+        r = json.loads(self.client.get(
+            "/1/data/vb?statistics=true&start=0&stop=%i" % (3*S)).data)
+        self.assertEqual(r["count"], 30)
+        self.client.delete("/1/variable/vb")
+        self.client.post("/1/variable/vc", data={"name": "vc",
+            "type": "float"})
+        r = json.loads(self.client.get(
+            "/1/data/vc?statistics=true&start=0&stop=%i" % (3*S)).data)
+        self.assertEqual(r, {"count": 0})
+
+    def test_data_formats(self):
+        self.post_json("/1/data/va", [[1, 4.], [2, 5.], [3, 6.]])
+        r = self.client.get("/1/data/va",
+                headers={"Accept": "application/octet-stream"})
+        l = np.frombuffer(r.data, db.record_dtype)
+        self.assertEqual(l["time"].tolist(), [1, 2, 3])
+        self.assertEqual(l["value"].tolist(), [4., 5., 6.])
+        r = self.client.get("/1/data/va",
+                headers={"Accept": "application/x-npy"})
+        l = np.load(io.BytesIO(r.data))
+        self.assertEqual(l.shape, (3,))
+        self.assertEqual(l.dtype, np.dtype(db.record_dtype))
+
+    def test_chunk_storage(self):
+        self.client.put("/1/variable/va", data={"storage": "chunk"})
+        self.post_json("/1/data/va", [[t, t/2.] for t in range(25)])
+        db.compact(self.session, now=db.chunk_span)
+        self.session.commit()
+        r = json.loads(self.client.get("/1/data/va?start=3&limit=5").data)
+        self.assertEqual(r, {"va": dict((str(t), t/2.)
+            for t in range(20, 25))})
+        r = json.loads(self.client.get("/1/data/va?average=10").data)
+        self.assertEqual(r["va"]["mean"], [11., 7.25, 2.25])
+        self.client.delete("/1/data/va?start=10")
+        self.assertEqual(self.values("va"), [(t, t/2.) for t in range(10)])
+
+    def test_etag(self):
+        self.post_json("/1/data/va", [[1, 4.], [2, 5.]])
+        r = self.client.get("/1/data/va?limit=10")
+        etag = r.headers["ETag"]
+        self.assertEqual(json.loads(r.data), {"va": {"1": 4., "2": 5.}})
+        r = self.client.get("/1/data/va?limit=10",
+                headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 304)
+        r = self.client.get("/1/data/va?limit=10")
+        self.assertEqual(r.headers["ETag"], etag)
+        self.assertEqual(json.loads(r.data), {"va": {"1": 4., "2": 5.}})
+        self.assertEqual(self.app.response_cache.hits, 1)
+        self.post_json("/1/data/vb", [[3, 6.]])
+        self.assertEqual(self.client.get("/1/data/va?limit=10",
+            headers={"If-None-Match": etag}).status_code, 304)
+        self.post_json("/1/data/va", [[0, 6.]])
+        r = self.client.get("/1/data/va?limit=10",
+                headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.data)["va"]["0"], 6.)
+        # per representation
+        etag = r.headers["ETag"]
+        self.assertEqual(r.headers["Vary"], "Accept")
+        r = self.client.get("/1/data/va?limit=10", headers={
+            "If-None-Match": etag, "Accept": "application/octet-stream"})
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r.headers["ETag"], etag)
+        self.assertEqual(len(np.frombuffer(r.data, db.record_dtype)), 3)
+        self.app.response_cache.size = 50
+        self.client.get("/1/variable/va")
+        self.client.get("/1/data/vb")
+        self.assertLessEqual(self.app.response_cache.stats()["bytes"], 50)
+
+    def test_since(self):
+        self.post_json("/1/update", [["va", 10, 1.], ["vb", 15, 2.],
+            ["va", 20, 3.]])
+        r = json.loads(self.client.get("/1/query?names=va,vb&since=15").data)
+        self.assertEqual(r, {"va": {"time": [20], "value": [3.]},
+            "vb": {"time": [], "value": []}})
+        r = json.loads(self.client.get("/1/data/va?since=10").data)
+        self.assertEqual(r, {"va": {"20": 3.}})
+        r = json.loads(self.client.get("/1/data/va?average=1000&since=10"
+            ).data)
+        self.assertEqual(r["va"]["count"], [1])
+        r = json.loads(self.client.get("/1/data/va?statistics=true&since=10"
+            ).data)
+        self.assertEqual(r["count"], 1)
+
+    def test_decimate(self):
+        t = np.arange(1000)*10
+        x = np.sin(t/500.)
+        x[123] = 5.
+        self.post_json("/1/update", [["va", int(ti), float(xi)]
+            for ti, xi in zip(t, x)])
+        r = json.loads(self.client.get("/1/data/va?width=10").data)["va"]
+        self.assertLessEqual(len(r), 40)
+        self.assertEqual(r["1230"], 5.)
+        self.assertEqual(min(r.values()), x.min())
+        r = self.client.get("/1/data/va?width=10&decimate=lttb&start=100",
+                headers={"Accept": "application/octet-stream"})
+        l = np.frombuffer(r.data, db.record_dtype)
+        self.assertEqual(len(l), 10)
+        self.assertEqual((l["time"][0], l["time"][-1]), (100, 9990))
+        r = self.client.get("/1/data/va?width=10&decimate=nth")
+        self.assertEqual(r.status_code, 400)
+
+    def test_stream(self):
+        self.post_json("/1/update", [["va", 10, 1.], ["vb", 15, 2.]])
+        r = self.client.get("/1/stream?names=va,vb&since=10&heartbeat=.01")
+        events = iter(r.response)
+        self.assertEqual(json.loads(next(events)[6:]),
+                {"vb": {"time": [15], "value": [2.]}})
+        self.assertEqual(next(events), b": heartbeat\n\n")
+        self.post_json("/1/update", [["va", 20, 3.], ["vb", 12, 2.]])
+        self.assertEqual(json.loads(next(events)[6:]),
+                {"va": {"time": [20], "value": [3.]}})
+        self.assertEqual(self.app.notifier.stats()["subscribers"], 1)
+        r.close()
+        self.assertEqual(self.app.notifier.stats()["subscribers"], 0)
+
+    def test_name_cache(self):
+        self.client.get("/1/variable/va")
+        self.client.post("/1/data/va", data={"value": 1.})
+        self.assertEqual(self.app.name_cache.stats()["hits"], 1)
+        self.client.put("/1/variable/va", data={"unit": "V"})
+        r = json.loads(self.client.get("/1/variable/va").data)
+        self.assertEqual(r["va"]["unit"], "V")
+        self.client.delete("/1/variable/va")
+        self.assertEqual(self.client.get("/1/variable/va").status_code, 404)
+
+    def test_metrics(self):
+        self.post_json("/1/data/va", [[1, 4.], [2, 5.], [3, 6.]])
+        self.client.get("/1/data/va")
+        r = json.loads(self.client.get("/1/metrics").data)["endpoints"]
+        self.assertEqual(r["data"]["requests"], 2)
+        self.assertEqual(r["data"]["rows_written"], 3)
+        self.assertEqual(r["data"]["rows_read"], 3)
+        self.assertGreater(r["data"]["sql_count"], 0)
+        self.assertEqual(r["data"]["latency"]["count"], 2)
+        d = tempfile.mkdtemp()
+        try:
+            self.client.put("/1/metrics", data={"profile_dir": "/",
+                "profile_slow": 0, "profile_rate": 1})
+            self.assertIsNone(self.app.metrics.profile_dir)
+            self.app.metrics.profile_dir = d
+            self.client.get("/1/data/va")
+            self.assertEqual(len(os.listdir(d)), 1)
+        finally:
+            shutil.rmtree(d)
+
+    def test_export(self):
+        self.post_json("/1/data/va", [[t, t/2.] for t in range(25)])
+        r = self.client.get("/1/export/va?start=3&stop=20&chunk=4",
+                headers={"Accept": "text/csv"})
+        self.assertEqual(r.data.decode().splitlines(),
+                ["time,va"] + ["{},{}".format(t, t/2.)
+                    for t in range(3, 20)])
+        r = self.client.get("/1/export/va?chunk=5",
+                headers={"Accept": "application/x-ndjson"})
+        l = [json.loads(i) for i in r.data.decode().splitlines()]
+        self.assertEqual([i["time"] for i in l], list(range(25)))
+
+    def test_query(self):
+        self.post_json("/1/update", [["va", 10, 1.], ["vb", 15, 2.],
+            ["va", 20, 3.]])
+        r = json.loads(self.client.get("/1/query?names=va,vb").data)
+        self.assertEqual(r, {"va": {"time": [10, 20], "value": [1., 3.]},
+            "vb": {"time": [15], "value": [2.]}})
+        r = json.loads(self.client.get(
+            "/1/query?names=va,vb&align=previous").data)
+        self.assertEqual(r, {"time": [10, 15, 20],
+            "values": {"va": [1., 1., 3.], "vb": [None, 2., 2.]}})
+        r = json.loads(self.client.get("/1/query?names=va,vb"
+            "&align=linear&start=10&stop=25&step=5").data)
+        self.assertEqual(r, {"time": [10, 15, 20],
+            "values": {"va": [1., 2., 3.], "vb": [None, 2., None]}})
+
+
+class WriteBehindCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self.app = create_app("sqlite:///%s" % self.path, write_behind=True)
+        self.session = self.app.db_session
+        for name in "va", "vb":
+            self.session.add(db.Variable(name))
+        self.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.app.writer.stop()
+        self.session.remove()
+        os.unlink(self.path)
+
+    def values(self, name):
+        self.app.writer.stop()
+        v = self.session.query(db.Variable).filter(
+                db.Variable.name == name).one()
+        return sorted(v.iterhistory())
+
+    def test_update(self):
+        r = self.client.post("/1/update", data=json.dumps([["va", 10, 1.],
+            ["vb", 11, 2.], ["va", 12, 3.]]), content_type="application/json")
+        self.assertEqual(json.loads(r.data), {"count": 3})
+        self.assertEqual(self.values("va"), [(10, 1.), (12, 3.)])
+        self.assertEqual(self.app.writer.stats()["written"], 3)
+
+    def test_name_cache_commit(self):
+        a = self.session.session_factory()
+        v = a.query(db.Variable).filter(db.Variable.name == "va").one()
+        v.type = "int"
+        a.flush()
+        types = []
+
+        def read():
+            # another connection, from another thread
+            b = self.session.session_factory()
+            types.append(db.lookup(b, "va").type)
+            b.close()
+        t = threading.Thread(target=read)
+        t.start()
+        t.join()
+        self.assertEqual(types, ["float"])
+        a.commit()
+        a.close()
+        b = self.session.session_factory()
+        self.assertEqual(db.lookup(b, "va").type, "int")
+        b.close()
+
+    def test_bad_batch(self):
+        reject(self.session, 13.)
+        r = self.client.post("/1/update", data=json.dumps([["va", 10, 1.],
+            ["vb", 11, 2.]]), content_type="application/json")
+        self.assertEqual(r.status_code, 200)
+        r = self.client.post("/1/update", data=json.dumps([["va", 12, 13.]]),
+                content_type="application/json")
+        self.assertEqual(r.status_code, 200)
+        r = self.client.post("/1/update", data=json.dumps([["va", 5, "abc"]]),
+                content_type="application/json")
+        self.assertEqual(r.status_code, 400)
+        r = self.client.post("/1/update", data=json.dumps([["va", 5.5, 1.]]),
+                content_type="application/json")
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(self.values("va"), [(10, 1.)])
+        self.assertEqual(self.values("vb"), [(11, 2.)])
+        self.assertEqual(self.app.writer.stats()["discarded"], 1)
+
+    def test_queue_full(self):
+        self.app.writer.size = 2
+        r = self.client.post("/1/update", data=json.dumps([["va", 10, 1.],
+            ["vb", 11, 2.], ["va", 12, 3.]]), content_type="application/json")
+        # can never fit
+        self.assertEqual(r.status_code, 413)
+        r = self.client.post("/1/update", data=json.dumps([["va", 10, 1.],
+            ["vb", 11, 2.]]), content_type="application/json")
+        self.assertEqual(r.status_code, 200)
+        # within the deadline of the first
+        r = self.client.post("/1/update", data=json.dumps([["va", 12, 3.]]),
+                content_type="application/json")
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(r.headers["Retry-After"], "1")
+        self.app.writer.stop()
+        self.assertEqual(self.values("va"), [(10, 1.)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+# runs the cli and reports the heavy modules it loaded
+script = """
+import sys
+from qlog import cli
+cli.main()
+print(",".join(m for m in ("numpy", "dateutil", "matplotlib")
+    if m in sys.modules))
+"""
+
+
+class CliCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.database = "sqlite:///" + os.path.join(self.dir, "q.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_cli(self, *args):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+                [root] + env.get("PYTHONPATH", "").split(os.pathsep))
+        t0 = time.time()
+        out = subprocess.check_output([sys.executable, "-c", script,
+            "-d", self.database] + list(args), cwd=self.dir, env=env)
+        dt = time.time() - t0
+        lines = out.decode().splitlines()
+        return lines[:-1], lines[-1], dt
+
+    def test_write_read(self):
+        out, loaded, dt = self.run_cli("va=1", "vb=2", "va", "vb", "va=3",
+                "va", "?")
+        self.assertEqual(out[:3], ["1", "2", "3"])
+        self.assertEqual(sorted(out[3].split(", ")), ["va = 3", "vb = 2"])
+        self.assertEqual(loaded, "")
+        out, loaded, dt = self.run_cli("-n", "va?")
+        self.assertEqual(out[0], "time, va")
+        self.assertEqual([float(l.split(", ")[1]) for l in out[1:]],
+                [3., 1.])
+        self.assertEqual(loaded, "")
+
+    def test_repeated(self):
+        out, loaded, dt = self.run_cli("va=1", "va=2", "vb=3", "va", "vb")
+        self.assertEqual(out, ["2", "3"])
+
+    def test_not_found(self):
+        self.run_cli("va=1")
+        with open(os.devnull, "w") as null:
+            self.assertRaises(subprocess.CalledProcessError,
+                    subprocess.check_call, [sys.executable, "-m",
+                        "qlog.cli", "-d", self.database, "-c", "other",
+                        "va"], cwd=root, stderr=null)
+
+    def test_cold_start(self):
+        self.run_cli("va=1")
+        dt = min(self.run_cli("-n", "va=2", "va")[2] for i in range(3))
+        # about .3 s, mostly importing sqlalchemy
+        self.assertLess(dt, .5)
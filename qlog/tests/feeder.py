@@ -0,0 +1,187 @@
+import os
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+
+from qlog.feeder import Device, Buffer, Feeder, Rejected, from_config
+
+
+async def fake_instrument(value=b"1.5E-06", answer=True):
+    # a telnet instrument answering "GDAT? 1\r\n" with value "\r"
+    async def handle(reader, writer):
+        try:
+            while True:
+                line = await reader.readuntil(b"\n")
+                if answer and line.strip() == b"GDAT? 1":
+                    writer.write(value + b"\r")
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+def port(server):
+    return server.sockets[0].getsockname()[1]
+
+
+class Posts(object):
+    # records posted batches, fails while down or on failing times,
+    # rejects unknown names
+    def __init__(self, unknown=(), failing=()):
+        self.batches = []
+        self.down = False
+        self.unknown = set(unknown)
+        self.failing = set(failing)
+        self.lock = threading.Lock()
+
+    def __call__(self, rows):
+        if self.down:
+            raise IOError("server down")
+        if any(r[1] in self.failing for r in rows):
+            raise IOError("internal server error")
+        if any(r[0] in self.unknown for r in rows):
+            raise Rejected(404, "Not found")
+        with self.lock:
+            self.batches.append(rows)
+        return len(rows)
+
+    def rows(self):
+        return [r for b in self.batches for r in b]
+
+
+class FeederCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.dir)
+
+    def run_feeder(self, feeder, duration, during=None):
+        async def run():
+            task = asyncio.ensure_future(feeder.run())
+            await asyncio.sleep(duration)
+            if during is not None:
+                during()
+                await asyncio.sleep(duration)
+            feeder.stop()
+            await task
+        self.loop.run_until_complete(run())
+
+    def test_batched(self):
+        a = self.loop.run_until_complete(fake_instrument(b"1.5E-06"))
+        b = self.loop.run_until_complete(fake_instrument(b"2"))
+        posts = Posts()
+        feeder = Feeder([Device("a", "127.0.0.1", port(a), .01),
+            Device("b", "127.0.0.1", port(b), .02, variable="vb")],
+            posts, batch=1000, deadline=.1)
+        self.run_feeder(feeder, .5)
+        a.close()
+        b.close()
+        rows = posts.rows()
+        va = [v for k, t, v in rows if k == "a"]
+        vb = [v for k, t, v in rows if k == "vb"]
+        self.assertGreater(len(va), 20)
+        self.assertGreater(len(vb), 10)
+        self.assertEqual(set(va), set([1.5e-6]))
+        self.assertEqual(set(vb), set([2.]))
+        # readings of both devices share posts
+        self.assertLess(len(posts.batches), len(rows)/5)
+        self.assertEqual(feeder.stats()["posted"], len(rows))
+
+    def test_slow_device(self):
+        a = self.loop.run_until_complete(fake_instrument())
+        mute = self.loop.run_until_complete(fake_instrument(answer=False))
+        posts = Posts()
+        feeder = Feeder([Device("a", "127.0.0.1", port(a), .01),
+            Device("mute", "127.0.0.1", port(mute), .01, timeout=.05),
+            Device("gone", "127.0.0.1", 1, .01)],
+            posts, deadline=.05)
+        self.run_feeder(feeder, .3)
+        a.close()
+        mute.close()
+        s = feeder.stats()["devices"]
+        self.assertGreater(s["a"]["readings"], 15)
+        self.assertEqual(s["mute"]["readings"], 0)
+        self.assertGreater(s["mute"]["errors"], 2)
+        self.assertGreater(s["gone"]["errors"], 2)
+        self.assertEqual(set(k for k, t, v in posts.rows()), set(["a"]))
+
+    def test_buffer(self):
+        a = self.loop.run_until_complete(fake_instrument())
+        posts = Posts()
+        posts.down = True
+        buffer = Buffer(os.path.join(self.dir, "buffer"))
+        feeder = Feeder([Device("a", "127.0.0.1", port(a), .01)], posts,
+                buffer, deadline=.05)
+        self.run_feeder(feeder, .2)
+        self.assertEqual(posts.batches, [])
+        n = len(buffer)
+        self.assertGreater(n, 10)
+        self.assertEqual(feeder.buffered, n)
+
+        def up():
+            posts.down = False
+        feeder = Feeder([Device("a", "127.0.0.1", port(a), .01)], posts,
+                buffer, deadline=.05)
+        feeder.buffered = len(buffer)
+        self.run_feeder(feeder, .1, up)
+        a.close()
+        times = [t for k, t, v in posts.rows()]
+        self.assertGreater(len(times), n)
+        # replayed first, nothing lost or duplicated
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(len(set(times)), len(times))
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(feeder.buffered, 0)
+
+    def test_rejected(self):
+        a = self.loop.run_until_complete(fake_instrument())
+        posts = Posts(["a"])
+        buffer = Buffer(os.path.join(self.dir, "buffer"))
+        buffer.append([["a", 1, 1.]])
+        feeder = Feeder([Device("a", "127.0.0.1", port(a), .01)], posts,
+                buffer, deadline=.05)
+        feeder.buffered = len(buffer)
+        self.run_feeder(feeder, .2)
+        a.close()
+        self.assertEqual(posts.batches, [])
+        self.assertEqual(len(buffer), 0)
+        self.assertGreater(feeder.stats()["rejected"], 10)
+
+    def test_stuck(self):
+        # a buffered batch failing on its own does not hold up the others
+        posts = Posts(failing=[0])
+        buffer = Buffer(os.path.join(self.dir, "buffer"))
+        feeder = Feeder([], posts, buffer, retries=3)
+        for i in range(6):
+            self.loop.run_until_complete(feeder.send([["a", i, 1.]]))
+        s = feeder.stats()
+        self.assertEqual((s["posts"], s["buffered"], s["dropped"]),
+                (5, 0, 1))
+        self.assertEqual([t for k, t, v in posts.rows()], [1, 2, 3, 4, 5])
+        self.assertEqual(len(buffer), 0)
+
+    def test_config(self):
+        path = os.path.join(self.dir, "feeder.ini")
+        with open(path, "w") as f:
+            f.write("[feeder]\nurl = http://localhost:5000/1\n"
+                    "batch = 10\nbuffer = {}\nretries = 5\n\n"
+                    "[igc100]\nhost = 10.0.0.7\nport = 23\ninterval = 5\n"
+                    "variable = pressure\n".format(
+                        os.path.join(self.dir, "buffer")))
+        feeder = from_config(path, Posts())
+        self.assertEqual(feeder.batch, 10)
+        self.assertEqual(feeder.retries, 5)
+        d, = feeder.devices
+        self.assertEqual((d.name, d.host, d.port, d.interval, d.command,
+            d.variable), ("igc100", "10.0.0.7", 23, 5., "GDAT? 1",
+                "pressure"))
+
+
+if __name__ == "__main__":
+    unittest.main()
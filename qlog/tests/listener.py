@@ -0,0 +1,116 @@
+import os
+import time
+import socket
+import tempfile
+import unittest
+
+from qlog import db
+from qlog.api import create_app
+from qlog.listener import (Listener, parse, needed, frame, header, MAGIC,
+        max_records, max_line)
+
+
+class ParseCase(unittest.TestCase):
+    def test_lines(self):
+        rows, tail, errors = parse(b"va 1.5 100\nvb 2\n\nbad\nva x\nva 3", 7)
+        self.assertEqual(rows, [("va", 100, 1.5), ("vb", 7, 2.)])
+        self.assertEqual(tail, b"va 3")
+        self.assertEqual(errors, 2)
+
+    def test_frames(self):
+        f = frame("va", [1, 2, 3], [.5, 1.5, 2.5])
+        rows, tail, errors = parse(f + b"vb 1 4\n" + f[:20], 0)
+        self.assertEqual(rows, [("va", 1, .5), ("va", 2, 1.5),
+            ("va", 3, 2.5), ("vb", 4, 1.)])
+        self.assertEqual(tail, f[:20])
+        rows, tail, errors = parse(tail + f[20:], 0)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(tail, b"")
+        bad = header.pack(MAGIC, 2, 0) + b"\xff\xfe"
+        rows, tail, errors = parse(bad + f, 0)
+        self.assertEqual((len(rows), tail, errors), (3, b"", 1))
+        self.assertEqual(needed(f[:20]), len(f))
+        self.assertEqual(needed(b"va 1"), 0)
+
+    def test_limits(self):
+        f = header.pack(MAGIC, 2, max_records + 1) + b"va"
+        rows, tail, errors = parse(b"vb 1 4\n" + f, 0)
+        self.assertEqual((rows, tail, errors), ([("vb", 4, 1.)], None, 1))
+        rows, tail, errors = parse(b"v" * (max_line + 1), 0)
+        self.assertEqual((rows, tail, errors), ([], None, 1))
+
+
+class ListenerCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self.app = create_app("sqlite:///%s" % self.path, write_behind=True)
+        self.session = self.app.db_session
+        for name in "va", "vb":
+            self.session.add(db.Variable(name))
+        self.session.commit()
+        self.listener = Listener(self.app, "127.0.0.1", 0)
+        self.listener.start()
+
+    def tearDown(self):
+        self.listener.stop()
+        self.app.writer.stop()
+        self.session.remove()
+        os.unlink(self.path)
+
+    def values(self, name):
+        self.app.writer.stop()
+        v = self.session.query(db.Variable).filter(
+                db.Variable.name == name).one()
+        return sorted(v.iterhistory())
+
+    def wait(self, n):
+        t0 = time.time()
+        while (self.listener.received + self.listener.unknown < n and
+                time.time() - t0 < 5):
+            time.sleep(.01)
+
+    def test_tcp(self):
+        s = socket.create_connection(self.listener.address)
+        s.sendall(b"va 1 10\nvb 2 ")
+        s.sendall(b"20\nvc 3 30\n")
+        s.sendall(frame("va", [11, 12], [4., 5.]))
+        s.close()
+        self.wait(5)
+        self.assertEqual(self.values("va"), [(10, 1.), (11, 4.), (12, 5.)])
+        self.assertEqual(self.values("vb"), [(20, 2.)])
+        s = self.listener.stats()
+        self.assertEqual((s["received"], s["unknown"]), (4, 1))
+
+    def test_large_frame(self):
+        self.app.writer.size = 10
+        s = socket.create_connection(self.listener.address)
+        s.sendall(frame("va", range(25), range(25)))
+        s.close()
+        self.wait(25)
+        self.assertEqual(self.values("va"), [(i, float(i)) for i in range(25)])
+
+    def test_udp(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.sendto(b"va 1 10\nvb 2 20", self.listener.address)
+        s.sendto(frame("vb", [21], [3.]), self.listener.address)
+        s.close()
+        self.wait(3)
+        self.assertEqual(self.values("va"), [(10, 1.)])
+        self.assertEqual(self.values("vb"), [(20, 2.), (21, 3.)])
+
+    def test_new_variable(self):
+        s = socket.create_connection(self.listener.address)
+        s.sendall(b"vc 1 10\n")
+        self.wait(1)
+        self.assertEqual(self.listener.unknown, 1)
+        self.session.add(db.Variable("vc"))
+        self.session.commit()
+        s.sendall(b"vc 2 20\n")
+        s.close()
+        self.wait(2)
+        self.assertEqual(self.values("vc"), [(20, 2.)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+import calendar
+from sqlalchemy import create_engine, orm
+from qlog import partition
+from qlog.db import (Base, FloatValue, Variable, summary_segment,
+        compact)
+
+
+def us(*date):
+    return calendar.timegm(date + (1, 0, 0, 0))*10**6
+
+
+class PartitionCase(unittest.TestCase):
+    def test_create(self):
+        now = us(2014, 11) + 5
+        t = FloatValue.__table__
+        ddl, = partition.create_ddl(t, [], partition.month(now, 3), now)
+        self.assertEqual(ddl, "ALTER TABLE floatvalue PARTITION BY RANGE "
+            "(time) (PARTITION p201411 VALUES LESS THAN ({}), "
+            "PARTITION p201412 VALUES LESS THAN ({}), "
+            "PARTITION p201501 VALUES LESS THAN ({}), "
+            "PARTITION pmax VALUES LESS THAN MAXVALUE)".format(
+                us(2014, 12), us(2015, 1), us(2015, 2)))
+        parts = [("p201411", us(2014, 12)), ("p201412", us(2015, 1)),
+                ("pmax", None)]
+        self.assertEqual(partition.create_ddl(t, parts, us(2015, 1), now), [])
+        ddl, = partition.create_ddl(t, parts, us(2015, 2), now)
+        self.assertEqual(ddl, "ALTER TABLE floatvalue REORGANIZE PARTITION "
+            "pmax INTO (PARTITION p201501 VALUES LESS THAN ({}), "
+            "PARTITION pmax VALUES LESS THAN MAXVALUE)".format(us(2015, 2)))
+        self.assertEqual(partition.expired(parts, us(2015, 1) + 1),
+                ["p201411", "p201412"])
+        self.assertEqual(partition.expired(parts, us(2014, 12) - 1), [])
+
+    def test_expire_rows(self):
+        engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(engine)
+        session = orm.sessionmaker(bind=engine)()
+        va, vb = Variable("va"), Variable("vb")
+        vb.storage = "chunk"
+        session.add_all([va, vb])
+        S = summary_segment
+        for v in va, vb:
+            v.update_series([1., 2., 3.], [S + 10, S + 20, 3*S + 30])
+        compact(session, now=4*S)
+        self.assertEqual(va.statistics(0, 4*S, now=4*S)["count"], 3)
+        self.assertEqual(vb.chunk_values.count(), 2)
+        session.commit()
+        partition.ensure(engine)
+        self.assertEqual(partition.expire(engine, 3*S), 2)
+        session.expire_all()
+        for v in va, vb:
+            self.assertEqual(list(v.iterhistory()), [(3*S + 30, 3.)])
+            self.assertEqual(v.statistics(0, 4*S, now=4*S)["count"], 1)
+
+    def test_expire_rollups(self):
+        engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(engine)
+        session = orm.sessionmaker(bind=engine)()
+        va = Variable("va")
+        va.aggregate_stamp, va.aggregate_age, va.delete_age = 10, 20, 100
+        session.add(va)
+        va.update_series([float(t) for t in range(100)], list(range(100)))
+        compact(session, now=100)
+        session.commit()
+        partition.expire(engine, 65)
+        session.expire_all()
+        self.assertEqual(va.expire_stop, 60)
+        # late into an expired bucket and into the straddling one
+        va.update_series([100., 100.], [25, 61])
+        compact(session, now=100)
+        self.assertEqual(va.aggregate(10, 0, 80).all()[::-1],
+                [(0, 0., 9., 4.5, 10), (10, 10., 19., 14.5, 10),
+                 (20, 20., 100., 345/11., 11), (30, 30., 39., 34.5, 10),
+                 (40, 40., 49., 44.5, 10), (50, 50., 59., 54.5, 10),
+                 (60, 65., 100., 72.5, 6), (70, 70., 79., 74.5, 10)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,299 @@
+import unittest
+
+import numpy as np
+from sqlalchemy import create_engine, orm
+from qlog.db import (Variable, Collection, Base, aggregate_array,
+    compact, Deadband, insert_values, summary_segment, ClosureCache,
+    chunk_span, ChunkValue, m4, lttb, create_schema, ValueCache)
+
+
+class ValuesCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite:///:memory:", echo=False)
+        Base.metadata.create_all(self.engine)
+        Session = orm.sessionmaker(bind=self.engine)
+        self.session = Session()
+
+    def test_update_series(self):
+        va = Variable("va")
+        self.session.add(va)
+        va.update_series(np.arange(10.), np.arange(10)*1000, chunk=3)
+        self.assertEqual(sorted(va.iterhistory()),
+                [(i*1000, float(i)) for i in range(10)])
+
+    def test_update_series_datetime(self):
+        va = Variable("va")
+        self.session.add(va)
+        t = np.array(["2014-01-01T00:00:00.000001"], "datetime64[us]")
+        va.update_series([1.], t)
+        self.assertEqual(list(va.iterhistory()), [(1388534400000001, 1.)])
+
+    def test_from_recarray(self):
+        d = [["2014-01-01T00:00", 1, 2], ["2014-01-01T00:01", 3, 4]]
+        d = np.rec.fromrecords(d, dtype=[("time", "datetime64[us]"),
+                ("va", "f8"), ("vb", "f8")])
+        c = Collection.from_recarray(d, name="col", session=self.session,
+                chunk=3)
+        self.assertEqual(set(v.name for v in c.variables()),
+                set(("va", "vb")))
+        vb = c.get("vb")
+        self.assertEqual(vb.value, 4)
+        self.assertEqual(vb.current.time, 1388534460000000)
+        self.assertEqual(len(list(vb.iterhistory())), 2)
+
+    def test_aggregate(self):
+        va = Variable("va")
+        self.session.add(va)
+        t = np.arange(0, 100, 3)
+        v = np.sin(t)
+        va.update_series(v, t)
+        sql = np.array(va.aggregate(10).all()[::-1]).T
+        ref = aggregate_array(t, v, 10)
+        for a, b in zip(sql, ref):
+            np.testing.assert_allclose(a, b)
+
+    def test_rollup(self):
+        va = Variable("va")
+        va.aggregate_stamp = 10
+        va.aggregate_age = 50
+        va.delete_age = 70
+        self.session.add(va)
+        va.update_series(np.arange(100.), np.arange(100))
+        self.assertEqual(compact(self.session, now=100), (5, 30))
+        self.assertEqual(va.aggregated(), 50)
+        self.assertEqual(compact(self.session, now=120), (2, 20))
+        self.assertEqual(va.aggregated(), 70)
+        self.assertEqual(list(va.iterhistory(0, 30, resolution=10)),
+                [(20, 24.5), (10, 14.5), (0, 4.5)])
+        # rollups up to 70, raw values after
+        h = list(va.iterhistory(0, 90, resolution=10))
+        self.assertEqual(len(h), 7 + 20)
+        self.assertEqual(h[19:], [(70, 70.), (60, 64.5), (50, 54.5),
+            (40, 44.5), (30, 34.5), (20, 24.5), (10, 14.5), (0, 4.5)])
+        self.assertEqual(va.aggregate(20, 0, 40).all(),
+                [(20, 20., 39., 29.5, 20), (0, 0., 19., 9.5, 20)])
+        self.assertEqual(va.aggregate(20).all(),
+                [(80, 80., 99., 89.5, 20), (60, 60., 79., 69.5, 20),
+                 (40, 40., 59., 49.5, 20), (20, 20., 39., 29.5, 20),
+                 (0, 0., 19., 9.5, 20)])
+
+    def test_rollup_late(self):
+        va = Variable("va")
+        va.aggregate_stamp = 10
+        va.aggregate_age = 50
+        va.delete_age = 70
+        self.session.add(va)
+        t = np.r_[0:20, 30:35, 36:100]
+        va.update_series(t*1., t)
+        self.assertEqual(compact(self.session, now=100), (4, 20))
+        # late into an expired bucket and into a rolled up one
+        va.update_series(np.arange(20., 30.), np.arange(20, 30))
+        va.update(100., 35)
+        compact(self.session, now=120)
+        self.assertEqual(va.aggregate(10, 0, 70).all()[::-1],
+                [(0, 0., 9., 4.5, 10), (10, 10., 19., 14.5, 10),
+                 (20, 20., 29., 24.5, 10), (30, 30., 100., 41., 10),
+                 (40, 40., 49., 44.5, 10), (50, 50., 59., 54.5, 10),
+                 (60, 60., 69., 64.5, 10)])
+
+    def test_deadband(self):
+        deadband = Deadband()
+        self.session.info["deadband"] = deadband
+        va = Variable("va")
+        va.value_precision = .5
+        va.time_gap = 100
+        self.session.add(va)
+        va.update(1., 0)
+        va.update(1.4, 10)
+        va.update(1.6, 20)
+        va.update_series([1.7, 1.8], [30, 40])
+        insert_values(self.session, [(va, 150, 1.8), (va, 160, 1.8),
+            (va, 5, 0.)])
+        self.assertEqual(sorted(va.iterhistory()),
+                [(0, 1.), (5, 0.), (20, 1.6), (150, 1.8)])
+        self.assertEqual(deadband.stats(),
+                {"stored": 4, "dropped": 4, "ratio": 2.})
+
+    def test_value_cache(self):
+        cache = ValueCache()
+        va = Variable("va")
+        self.session.add(va)
+        va.update(1., 10)
+        self.session.commit()
+        latest = va.latest
+
+        def racing():
+            # a write lands while the miss is read
+            v = latest()
+            cache.put(va.id, 20, 2.)
+            return v
+        va.latest = racing
+        self.assertEqual(cache.get(va).value, 1.)
+        del va.latest
+        self.assertEqual(cache.stats()["size"], 0)
+        self.assertEqual(cache.get(va).value, 1.)
+        cache.put(va.id, 20, 2.)
+        self.assertEqual(cache.get(va).value, 2.)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 2, "size": 1})
+
+    def test_statistics(self):
+        va = Variable("va")
+        self.session.add(va)
+        S = summary_segment
+        t = np.arange(0, 5*S, S//7) + 1000*S
+        v = np.random.RandomState(0).standard_normal(len(t))
+        va.update_series(v, t)
+        now = t[-1] + 1
+        for i, j in [(0, len(t)), (3, 20), (10, 11), (0, 1)]:
+            d = va.statistics(int(t[i]), int(t[j - 1]) + 1, now=now)
+            self.assertEqual(d["count"], j - i)
+            self.assertEqual(d["time_min"], t[i])
+            self.assertEqual(d["time_max"], t[j - 1])
+            self.assertAlmostEqual(d["time_mean"], t[i:j].mean(), delta=1)
+            self.assertAlmostEqual(d["time_std"], t[i:j].std(), delta=1)
+            self.assertEqual(d["value_min"], v[i:j].min())
+            self.assertEqual(d["value_max"], v[i:j].max())
+            self.assertAlmostEqual(d["value_mean"], v[i:j].mean())
+            self.assertAlmostEqual(d["value_std"], v[i:j].std())
+        self.assertEqual(va.summary_values.count(), 4)
+        # no cancellation at large offsets
+        vb = Variable("vb")
+        self.session.add(vb)
+        vb.update_series(v + 1e9, t)
+        d = vb.statistics(now=now)
+        self.assertAlmostEqual(d["value_mean"], (v + 1e9).mean(), delta=1e-6)
+        self.assertAlmostEqual(d["value_std"], v.std(), delta=1e-6)
+        va.update(100., int(t[3]) + 1)
+        self.assertEqual(va.summary_values.count(), 0)
+        self.assertEqual(va.statistics(now=now)["value_max"], 100.)
+
+    def test_chunk_storage(self):
+        va, vb = Variable("va"), Variable("vb", type="int")
+        va.storage = vb.storage = "chunk"
+        self.session.add_all([va, vb])
+        S = chunk_span
+        t = np.arange(0, 3*S, S//5000) + 1000*S
+        v = np.sin(t/1e9)
+        va.update_series(v, t)
+        vb.update_series(np.arange(len(t))*3, t)
+        ref = sorted(va.iterhistory())
+        compact(self.session, now=int(t[-1]))
+        # 2 completed spans of 5000 values in chunks of <= 4096
+        self.assertEqual(va.chunk_values.count(), 4)
+        self.assertEqual(va.values.count(), 5000)
+        self.assertEqual(sorted(va.iterhistory()), ref)
+        self.assertRaises(ValueError, va.history)
+        self.assertEqual([x for ti, x in vb.iterhistory(int(t[0]), int(t[3]))],
+                [6, 3, 0])
+        self.assertEqual(va.value, v[-1])
+        self.assertEqual(va.recent(int(t[0]), int(t[-1]), limit=3,
+            offset=9998), ref[::-1][9999:10002])
+        self.assertEqual([r for c in va.iterchunks(size=3000) for r in c],
+                ref)
+        d = va.statistics()
+        self.assertEqual(d["count"], len(t))
+        self.assertAlmostEqual(d["value_mean"], v.mean())
+        va.update(5., int(t[0]) + 1)
+        compact(self.session, now=int(t[-1]))
+        self.assertEqual(va.values.count(), 5000)
+        self.assertEqual(list(va.iterhistory(int(t[0]), int(t[1]))),
+                [(t[0] + 1, 5.), (t[0], v[0])])
+        va.storage = None
+        self.assertEqual(va.chunk_values.count(), 0)
+        self.assertEqual(va.values.count(), len(t) + 1)
+
+    def test_history_array(self):
+        va, vb = Variable("va"), Variable("vb", type="int")
+        self.session.add_all([va, vb])
+        va.update_series(np.arange(25.), np.arange(25)*1000)
+        vb.update_series(np.arange(5), np.arange(5)*1000)
+        t, v = va.history_array(size=4)
+        self.assertEqual(t.dtype, np.int64)
+        self.assertEqual(v.dtype, np.float64)
+        np.testing.assert_equal(t, np.arange(25)*1000)
+        np.testing.assert_equal(v, np.arange(25.))
+        t, v = va.history_array(3000, 7000)
+        np.testing.assert_equal(t, [3000, 4000, 5000, 6000])
+        t, v = vb.history_array(1000)
+        self.assertEqual(v.dtype, np.int64)
+        np.testing.assert_equal(v, [1, 2, 3, 4])
+        t, v = va.recent_array(limit=3, offset=1)
+        np.testing.assert_equal(t, [23000, 22000, 21000])
+        t, v = va.history_array(10**9)
+        self.assertEqual((len(t), len(v)), (0, 0))
+        self.assertEqual(list(zip(*va.history_array(start=20000))),
+                sorted(va.iterhistory(start=20000)))
+
+    def test_decimate(self):
+        rng = np.random.RandomState(0)
+        t = np.cumsum(rng.randint(1, 100, 20000))
+        v = rng.randn(len(t))
+        i = m4(t, v, t[0], t[-1] + 1, 50)
+        step = -(-(t[-1] + 1 - t[0])//50)
+        b = (t - t[0])//step
+        for k in np.unique(b):
+            j = np.flatnonzero(b == k)
+            self.assertEqual(set(i[b[i] == k]), set([j[0], j[-1],
+                j[np.argmin(v[j])], j[np.argmax(v[j])]]))
+        i = lttb(t, v, 100)
+        self.assertEqual(len(i), 100)
+        self.assertEqual((i[0], i[-1]), (0, len(t) - 1))
+        self.assertTrue(np.all(np.diff(i) > 0))
+
+        va, vb = Variable("va"), Variable("vb")
+        vb.storage = "chunk"
+        self.session.add_all([va, vb])
+        va.update_series(v, t)
+        vb.update_series(v, t)
+        compact(self.session, now=int(t[-1]) + chunk_span)
+        self.assertGreater(vb.chunk_values.count(), 0)
+        for var in va, vb:
+            # streamed in small batches
+            tm, vm = var.decimate(width=50, size=1000)
+            i = m4(t, v, t[0], t[-1] + 1, 50)
+            np.testing.assert_equal(tm, t[i])
+            np.testing.assert_equal(vm, v[i])
+            tl, vl = var.decimate(int(t[100]), int(t[5000]), width=20,
+                    mode="lttb")
+            self.assertEqual(len(tl), 20)
+            self.assertEqual((tl[0], tl[-1]), (t[100], t[4999]))
+        self.assertRaises(ValueError, va.decimate, mode="nth")
+
+    def test_collection_tree(self):
+        self.session.info["closure_cache"] = ClosureCache()
+        c1, c2, c3, c4 = [Collection(name="c%i" % i) for i in range(4)]
+        self.session.add(c1)
+        c1.right_collections.extend([c2, c3])
+        c2.right_collections.append(c4)
+        c4.right_collections.append(c1) # cycle
+        va = c4.get("va", create=True)
+        vb = c3.get("vb", create=True)
+        self.assertEqual(set(c1.variables()), set((va, vb)))
+        self.assertEqual(c1.get("va"), va)
+        self.assertIsNone(c3.get("va"))
+        self.assertEqual(set(c2.variable_ids()), set((va.id, vb.id)))
+        c2.right_collections.remove(c4)
+        self.assertIsNone(c2.get("va"))
+        self.assertEqual(c3.get("va", add=True), va)
+        self.assertEqual(c2.variables(), [])
+        self.assertEqual(set(c1.variable_ids()), set((va.id, vb.id)))
+
+    def test_create_schema(self):
+        engine = create_engine("sqlite:///:memory:", echo=False)
+        engine.execute("CREATE TABLE variable (id INTEGER PRIMARY KEY, "
+                "name VARCHAR(255) NOT NULL UNIQUE, "
+                "type VARCHAR(255) NOT NULL, aggregate_stamp BIGINT)")
+        engine.execute("INSERT INTO variable (name, type) "
+                "VALUES ('va', 'float')")
+        create_schema(engine)
+        session = orm.sessionmaker(bind=engine)()
+        va = session.query(Variable).filter(Variable.name == "va").one()
+        self.assertIsNone(va.storage)
+        va.update_series([1., 2.], [0, 1000])
+        session.commit()
+        self.assertEqual(len(list(va.iterhistory())), 2)
+        create_schema(engine)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,6 +15,7 @@ setup(
             "Flask", "Flask-RESTful", "SQLAlchemy", "bokeh", "docopt",
             "pandas", "requests", "nose"],
         extras_require = {
+            "serve": ["gevent"],
             },
         dependency_links = [],
         packages = find_packages(),